@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the first-order Kerr/chi calculation:
+    the old per-mode-pair loop of Bbq.get_Hparams  vs.  bbq.epr_first_order
+batched over variations. Does not need a running HFSS.
+"""
+import time
+import numpy as np
+from bbq import epr_first_order, fact, nck, fluxQ
+from scipy.constants import hbar, pi
+
+def get_Hparams_loop(freqs, pjs, lj, modes):
+    ''' the original single-junction loop, kept here as the reference '''
+    Hparams = {}
+    fzpfs = []
+    for m in modes:
+        omega = 2*pi*freqs[m]
+        ej = fluxQ**2/lj
+        pj = pjs['pj_'+str(m)]
+        fzpf = np.sqrt(pj*hbar*omega/ej)
+        fzpfs.append(fzpf)
+        Hparams['fzpf_'+str(m)] = fzpf
+        alpha = 2*ej/fact(4)*nck(4,2)*(fzpf**4)/hbar
+        Hparams['alpha_'+str(m)] = alpha
+        Hparams['freq_'+str(m)]=(omega-alpha)/2/pi
+    for m in modes:
+        for n in modes:
+            if n<m:
+                Hparams['chi_'+str(m)+'_'+str(n)] = ej/hbar*(fzpfs[m]*fzpfs[n])**2
+    return Hparams
+
+if __name__ == '__main__':
+    nvariations, nmodes, lj = 500, 8, 10e-9
+    modes = range(nmodes)
+    freqs = 1e9*np.random.uniform(4, 10, (nvariations, nmodes))
+    pjs   = np.random.uniform(1e-4, 0.9, (nvariations, nmodes, 1))
+
+    t0 = time.time()
+    loop = [get_Hparams_loop(freqs[v], {'pj_'+str(m): pjs[v, m, 0] for m in modes}, lj, modes) for v in range(nvariations)]
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    CHI, fzpfs, omegas_1 = epr_first_order(2*pi*freqs, pjs, np.array([fluxQ**2/lj/hbar]))
+    t_vec = time.time() - t0
+
+    assert np.allclose([h['chi_1_0'] for h in loop],   CHI[:, 1, 0])
+    assert np.allclose([h['alpha_0'] for h in loop],   CHI[:, 0, 0])
+    assert np.allclose([h['freq_2']  for h in loop],   omegas_1[:, 2]/2/pi)
+    print '%d variations x %d modes' % (nvariations, nmodes)
+    print '  loop       : %8.2f ms' % (1e3*t_loop)
+    print '  vectorized : %8.2f ms   (x%.0f)' % (1e3*t_vec, t_loop/t_vec)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Cold-start cost of importing pyHFSS modules. Each measurement is a fresh
+interpreter, so nothing is cached between runs. Also reports which of the
+heavy dependencies got imported (they should only load on first use).
+    python bench_import.py [module ...]        (default: hfss bbq)
+"""
+import os, sys, subprocess
+
+HEAVY  = ['pandas', 'matplotlib', 'pint', 'sympy']
+REPEAT = 7
+PROBE  = ("import time; t = time.time(); import %s; t = time.time() - t; import sys; "
+          "print('%%f %%s' %% (t, ','.join(m for m in %r if m in sys.modules)))")
+
+def time_import(module, repeat = REPEAT):
+    ''' returns the import times in s of repeat cold starts and the heavy modules loaded '''
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    env  = dict(os.environ, PYTHONPATH = root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times, loaded = [], ''
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', PROBE % (module, HEAVY)], env = env)
+        t, _, loaded = out.decode().strip().partition(' ')
+        times.append(float(t))
+    return sorted(times), loaded
+
+if __name__ == '__main__':
+    for module in sys.argv[1:] or ['hfss', 'bbq']:
+        times, loaded = time_import(module)
+        print('%-6s  min %7.1f ms   median %7.1f ms   heavy modules loaded: %s'
+              % (module, 1e3*times[0], 1e3*times[len(times)//2], loaded or 'none'))
@@ -1,21 +1,19 @@
 from hfss import *
-from hfss import CalcObject
-import time, os, shutil, matplotlib.pyplot as plt, numpy as np, pandas as pd, warnings
+from hfss import CalcObject, LazyModule, ureg
+import time, os, re, shutil, numpy as np, warnings
 from stat import S_ISREG, ST_CTIME, ST_MODE
-from pandas import HDFStore, Series, DataFrame
-from scipy.constants import *; from scipy.constants import hbar, e as e_el, epsilon_0, pi;  # not sure what else ened sto be imported, idellay we should get rid of all *
+from scipy.constants import hbar, e as e_el, epsilon_0, pi, Planck
 from config_bbq      import root_dir, gseam, th, eps_r, tan_delta_surf, tan_delta_sapp
-from pint import UnitRegistry; 
+from vectfit         import vector_fit
 
 #==============================================================================
 # Utility functions and difinitions
 #==============================================================================
 
-ureg  = UnitRegistry(system='mks')
+# pandas and matplotlib are imported on first use; the unit registry is shared with hfss and also loaded on first use 
+pd    = LazyModule('pandas', on_import = lambda pd: warnings.filterwarnings('ignore', category=pd.io.pytables.PerformanceWarning))
 fluxQ = hbar / (2*e_el)
 
-warnings.filterwarnings('ignore', category=pd.io.pytables.PerformanceWarning)
-
 def fact(n):
     if n <= 1:
         return 1
@@ -40,6 +38,14 @@ def deprecated(func):
     return newFunc
 
 
+def get_magnitudes(exprs):
+    ''' magnitudes of value/unit strings in their own units; e.g. ['8.5nH', '9nH'] -> [8.5, 9.] '''
+    magnitudes = []
+    for expr in exprs:
+        parsed = parse_value_unit(expr)
+        magnitudes += [ parsed[0] if parsed is not None else ureg.Quantity(expr).magnitude ]
+    return np.array(magnitudes)
+
 def print_matrix(M, frmt = "{:7.2f}", append_row = ""):
     M = np.mat(M)
     for row in np.array(M.tolist()):
@@ -64,6 +70,87 @@ def print_color(text, style = 0, fg=24, bg = 43, newline = True):
     else: print s,
 
 
+#==============================================================================
+# Loss channels 
+#==============================================================================
+class SeamLoss(object):
+    ''' 
+    A seam line with finite conductance gseam (per Ohm meter).
+    ref: http://arxiv.org/pdf/1509.01119.pdf
+    '''
+    kind = 'seam'
+    def __init__(self, seam, gseam = gseam):
+        self.name  = seam
+        self.gseam = gseam
+
+    def sol_key(self, mode):
+        return 'Qseam_' + self.name + '_' + str(mode)
+
+    def calc_Q(self, bbq, lv, U_E, U_H, omega):
+        int_j_2_val = bbq.calc_seam_int_j2(lv, self.name)
+        yseam = int_j_2_val/U_H/omega
+        return self.gseam/yseam
+
+class DielectricLoss(object):
+    ''' A bulk dielectric volume with loss tangent tan_delta. '''
+    kind = 'dielectric'
+    def __init__(self, volume, tan_delta = tan_delta_sapp):
+        self.name      = volume
+        self.tan_delta = tan_delta
+
+    def sol_key(self, mode):
+        return 'Qdielectric_' + self.name + '_' + str(mode)
+
+    def calc_Q(self, bbq, lv, U_E, U_H, omega):
+        p_dielectric = bbq.calc_U_E(None, volume=self.name, lv=lv)/U_E
+        return 1/(p_dielectric*self.tan_delta)
+
+class SurfaceLoss(object):
+    ''' 
+    A lossy layer of dirt of thickness th and dielectric constant eps_r on a set of surfaces.
+    ref: http://arxiv.org/pdf/1509.01854.pdf
+    '''
+    kind = 'surface'
+    def __init__(self, surfaces = 'AllObjects', th = th, eps_r = eps_r, tan_delta = tan_delta_surf):
+        self.surfaces  = [surfaces] if isinstance(surfaces, basestring) else list(surfaces)
+        self.name      = ','.join(self.surfaces)
+        self.th, self.eps_r, self.tan_delta = th, eps_r, tan_delta
+
+    def sol_key(self, mode):
+        return 'Qsurf_' + str(mode) if self.surfaces == ['AllObjects'] else 'Qsurf_' + self.name + '_' + str(mode)
+
+    def calc_Q(self, bbq, lv, U_E, U_H, omega):
+        U_surf  = sum(bbq.calc_surf_E2(lv, surface) for surface in self.surfaces)
+        U_surf *= self.th*epsilon_0*self.eps_r
+        p_surf  = U_surf/U_E
+        return 1/(p_surf*self.tan_delta)
+
+def surface_participations(surf_E2, th = th, eps_r = eps_r, tan_delta_surf = tan_delta_surf):
+    '''
+    Per-surface participations from a stored surface breakdown (columns mode, surface, int_E2, U_E,
+    see Bbq.calc_surface_breakdown). No HFSS calls, so th, eps_r and tan_delta_surf can be varied freely.
+    returns p_surf   scipy.sparse.csr_matrix [mode x surface]
+            Qsurf    Series of the total surface Q per mode
+            modes, surfaces   labels of the rows and columns of p_surf
+    '''
+    from scipy.sparse import coo_matrix
+    modes    = np.unique(surf_E2['mode'])
+    surfaces = list(pd.unique(surf_E2['surface']))
+    rows     = np.searchsorted(modes, surf_E2['mode'])
+    cols     = surf_E2['surface'].map(dict(zip(surfaces, range(len(surfaces))))).values
+    p        = surf_E2['int_E2'].values*th*epsilon_0*eps_r/surf_E2['U_E'].values
+    p_surf   = coo_matrix((p, (rows, cols)), shape = (len(modes), len(surfaces))).tocsr()
+    Qsurf    = pd.Series(1/(np.asarray(p_surf.sum(axis=1)).ravel()*tan_delta_surf), index = modes)
+    return p_surf, Qsurf, modes, surfaces
+
+def make_loss_channels(seams = None, dielectrics = None, surface = False):
+    ''' loss channels for the do_eBBQ style arguments, using the values of config_bbq '''
+    channels  = [SeamLoss(seam) for seam in (seams or [])]
+    channels += [DielectricLoss(dielectric) for dielectric in (dielectrics or [])]
+    if surface is True: channels += [SurfaceLoss()]
+    return channels
+
+
 #==============================================================================
 # Main compuation class & interface with HFSS
 #==============================================================================
@@ -89,6 +176,11 @@ class Bbq(object):
         self.hfss_variables   = {}                             # container for eBBQ list of varibles  
         self.sols             = {}                             # container for eBBQ solutions; could make a Panel
         self.meta_data        = {}                             # container for eBBQ metadata
+        self.hparams          = {}                             # container for first-order Hamiltonian parameters
+        self.surface_E2       = {}                             # container for per-surface |E|^2 integrals
+        self.seam_cache       = {}                             # (seam, mode, variation) -> (omega, U_H, int_j_2)
+        self.Qseam_sweeps     = {}                             # (seam, mode, variable) -> table of get_Qseam_sweep
+        self.eigen_tables     = {}                             # solution name -> table of get_eigenmode_table
         
         self.setup_data()
         if self.verbose: print '       # Modes: ' + str(self.nmodes), '\n  # Variations: ' + str(self.nvariations)
@@ -133,11 +225,12 @@ class Bbq(object):
     def calc_p_j(self, modes=None, variation=None):
         '''
         Calculates the p_j for all the modes. 
-        Requires a calculator expression called P_J.
+        Uses the calculator expression P_J, added from participation_ratio.clc if missing.
         '''
         lv = self.get_lv(variation)
         if modes is None:
             modes = range(self.nmodes)
+        self.setup.get_fields().register_library(names = ['P_J'])
 
         pjs = {}
         for ii, m in enumerate(modes):
@@ -158,20 +251,112 @@ class Bbq(object):
         return pj
     
     def get_freqs_bare(self, variation):
-        #str(self.get_lv(variation))
+        ''' bare freqs [Hz] and Qs of a variation, from the cached get_eigenmode_table '''
         freqs_bare_vals = []
         freqs_bare_dict = {}
-        freqs, kappa_over_2pis = self.solutions.eigenmodes(self.get_lv_EM(variation))
+        table = self.get_eigenmode_table(variations = [variation]).loc[str(variation)]
         for m in range(self.nmodes):
-            freqs_bare_dict['freq_bare_'+str(m)] = 1e9*freqs[m]
-            freqs_bare_vals.append(1e9*freqs[m])
-            if kappa_over_2pis is not None:
-                freqs_bare_dict['Q_'+str(m)] = freqs[m]/kappa_over_2pis[m]
+            freqs_bare_dict['freq_bare_'+str(m)] = table.loc[m, 'freq']
+            freqs_bare_vals.append(table.loc[m, 'freq'])
+            if not np.isnan(table.loc[m, 'Q']):
+                freqs_bare_dict['Q_'+str(m)] = table.loc[m, 'Q']
         self.freqs_bare = freqs_bare_dict
         self.freqs_bare_vals = freqs_bare_vals
         return freqs_bare_dict, freqs_bare_vals
+
+    def get_eigenmode_table(self, variations = None, refresh = False):
+        ''' freq [Hz] and Q of every mode of the solved variations (default all), indexed by (variation, mode). 
+            Read from one eigenmode report over all variations, and cached per solution until refresh. 
+            Variations the report doesn't give (or all, if it can't be made) are read with one 
+            ExportEigenmodes each, only when asked for. 
+            Frequency / Q-only studies need nothing else. '''
+        key = self.setup.solution_name
+        if refresh or key not in self.eigen_tables:
+            try:
+                self.eigen_tables[key] = self._eigenmode_table_from_report()
+            except (ValueError, IOError, pythoncom.com_error) as e:
+                if self.verbose: print '  Eigenmode report failed (%s); exporting the eigenmodes per variation' % e
+                self.eigen_tables[key] = self._eigenmode_table([])
+        table = self.eigen_tables[key]
+        if variations is None:
+            variations = ['-1'] if self.listvariations == (u'',) else [str(i) for i in range(self.nvariations)]
+        missing = [str(v) for v in variations if str(v) not in table.index.get_level_values('variation')]
+        if missing:
+            table = self.eigen_tables[key] = pd.concat([table, self._eigenmode_table_from_exports(missing)]).sort_index()
+        return table
+
+    def _eigenmode_table(self, rows):
+        table = pd.DataFrame(rows, columns = ['variation', 'mode', 'freq', 'Q'])
+        return table.set_index(['variation', 'mode']).sort_index()
+
+    def _eigenmode_table_from_exports(self, variations):
+        rows = []
+        for variation in variations:
+            freqs, kappa_over_2pis = self.solutions.eigenmodes(self.get_lv_EM(None if variation == '-1' else variation))
+            for m in range(self.nmodes):
+                Q = freqs[m]/kappa_over_2pis[m] if kappa_over_2pis is not None else np.nan
+                rows.append((variation, m, 1e9*freqs[m], Q))
+        return self._eigenmode_table(rows)
+
+    def _eigenmode_table_from_report(self):
+        variation_values = lambda lv: dict((name, float('%.9g' % to_base_units(value))) 
+                                           for name, value in parse_variation(lv).items())
+        solved = [variation_values(lv) for lv in self.listvariations]
+        names  = sorted(set(sum([list(values) for values in solved], [])))
+        if not names:
+            raise ValueError('no swept variables')
+        x     = names[0]
+        exprs = sum([['re(Mode(%d))' % (m+1), 'Q(%d)' % (m+1)] for m in range(self.nmodes)], [])
+        data, units = self.design.reports.get_report_data(self.setup.solution_name, exprs, dict((v, 'All') for v in names),
+                                                          report_type = 'Eigenmode Parameters', domain = None, x = x, 
+                                                          with_units = True)
+        x_unit = units[(x, '')] if (x, '') in units else ''
+        rows = []
+        labels = {}                                            # header variables -> {their values: variation}
+        for variation in data.columns.get_level_values('variation').unique():
+            header = variation_values(variation)               # the report leaves out the constant variables
+            keys   = tuple(sorted(set(header) | set([x])))
+            if keys not in labels:
+                labels[keys] = {}
+                for i, values in enumerate(solved):
+                    if set(keys) <= set(values):
+                        match = tuple(values[k] for k in keys)
+                        labels[keys][match] = None if match in labels[keys] else str(i) # None: ambiguous
+            for x_value in data.index:
+                values = dict(header)
+                values[x] = float('%.9g' % to_base_units('%r%s' % (x_value, x_unit)))
+                label = labels[keys].get(tuple(values[k] for k in keys))
+                if label is None:
+                    continue                                   # not a solved variation 
+                for m in range(self.nmodes):
+                    freq_expr = 're(Mode(%d))' % (m+1)
+                    freq_unit = units.get((freq_expr, variation), 'GHz') or 'Hz'
+                    rows.append((label, m, to_base_units('%r%s' % (data.loc[x_value, (freq_expr, variation)], freq_unit)),
+                                 data.loc[x_value, ('Q(%d)' % (m+1), variation)]))
+        if not rows:
+            raise ValueError('no solved variation in the eigenmode report')
+        return self._eigenmode_table(rows)
         
         
+    def refresh_variations(self):
+        ''' re-reads the solved variations, e.g. after a parametric solve. New variations can shift the 
+            indices, so the cached seam integrals and surface breakdowns are moved to the new index of 
+            their variation string, or dropped if it is no longer solved. '''
+        old                 = list(self.listvariations)
+        self.listvariations = self.design._solutions.ListVariations(str(self.setup.solution_name))
+        self.nvariations    = np.size(self.listvariations)
+        self.eigen_tables   = {}
+        index   = dict((lv, str(i)) for i, lv in enumerate(self.listvariations))
+        new_var = lambda var: index.get(old[int(var)])
+        self.seam_cache = dict(((seam, mode, new_var(var)), value) for (seam, mode, var), value 
+                               in self.seam_cache.items() if new_var(var) is not None)
+        self.surface_E2 = dict((new_var(var), table) for var, table in self.surface_E2.items() if new_var(var) is not None)
+
+    def get_parametric_variations(self, parametric):
+        ''' the variations (as in do_eBBQ) of the rows of an hfss.HfssParametricSetup, None where not solved '''
+        self.refresh_variations()
+        return [None if i is None else str(i) for i in match_variations(parametric.rows, self.listvariations)]
+
     def get_lv(self, variation):
         ''' variation is a string #; e.g., '0'
             returns array of var names and var values '''
@@ -179,7 +364,7 @@ class Bbq(object):
             lv = self.nominalvariation
             lv = self.parse_listvariations(lv)
         else:
-            lv = self.listvariations[ ureg(variation) ]
+            lv = self.listvariations[ int(variation) ]
             lv = self.parse_listvariations(lv)
         return lv
     
@@ -188,7 +373,7 @@ class Bbq(object):
             lv = self.nominalvariation
             #lv = self.parse_listvariations_EM(lv)
         else:
-            lv = self.listvariations[ ureg(variation) ]
+            lv = self.listvariations[ int(variation) ]
             #lv = self.parse_listvariations_EM(lv)
         return str(lv)
     
@@ -223,49 +408,76 @@ class Bbq(object):
 #        for name, val in data.items():
 #            group[name] = val
    
+    def get_solver_stats(self, variation):
+        ''' solver profile (per task) and mesh statistics (per object) of a variation, see hfss.read_profile '''
+        lv = '' if variation == '-1' else self.listvariations[int(variation)]
+        return self.setup.get_profile(lv), self.setup.get_mesh_stats(lv)
+
     def get_Qseam(self, seam, mode, variation):
         '''
         caculate the contribution to Q of a seam, by integrating the current in
         the seam with finite conductance: set in the config file
         ref: http://arxiv.org/pdf/1509.01119.pdf
         '''
-        lv = self.get_lv(variation)
-        Qseam = {}
         print 'Calculating Qseam_'+ seam +' for mode ' + str(mode) + ' (' + str(mode) + '/' + str(self.nmodes-1) + ')'
+        channel = SeamLoss(seam)
+        Qseam   = channel.calc_Q(self, self.get_lv(variation), self.U_E, self.U_H, self.omega)
+        print channel.sol_key(mode) + str(' = ') + str(Qseam)
+        return pd.Series({channel.sol_key(mode) : Qseam})
+
+    def calc_seam_int_j2(self, lv, seam):
+        ''' line integral of |Jsurf|^2 along the seam '''
         j_2_norm = self.fields.Vector_Jsurf.norm_2() # overestimating the loss by taking norm2 of j, rather than jperp**2
         int_j_2 = j_2_norm.integrate_line(seam)
-        int_j_2_val = int_j_2.evaluate(lv=lv, phase=90)
-        yseam = int_j_2_val/self.U_H/self.omega
-        Qseam['Qseam_'+seam+'_'+str(mode)] = gseam/yseam
-        print 'Qseam_' + seam + '_' + str(mode) + str(' = ') + str(gseam/yseam)
-        return Series(Qseam)
-
-    def get_Qseam_sweep(self, seam, mode, variation, variable, values, unit, pltresult=True):
-        # values = ['5mm','6mm','7mm']
-        # ref: http://arxiv.org/pdf/1509.01119.pdf
+        return int_j_2.evaluate(lv=lv, phase=90)
+
+    def get_Qseam_sweep(self, seam, mode, variation, variable, values, unit, pltresult=True, solve_missing=False, **solve_kwargs):
+        '''
+        Qseam of a mode as variable is swept through values (in unit), e.g. values = [5,6,7], unit = 'mm'.
+        The values are mapped onto solved variations (ListVariations) whose other variables match 
+        those of variation; each of these is evaluated with its own frequency and U_H. The seam integrals 
+        are cached, and the table of the sweep is kept in self.Qseam_sweeps[seam, mode, variable].
+        With solve_missing, values without a solved variation are solved first, in one parametric setup 
+        (solve_kwargs go to HfssParametricSetup.solve, e.g. distributed = True).
+        ref: http://arxiv.org/pdf/1509.01119.pdf
+        '''
+        sweep_variations = self.get_variations_for(variable, values, unit, variation)
+        missing = [value for value, var in zip(values, sweep_variations) if var is None]
+        if missing and solve_missing:
+            base      = self.get_variables(variation)
+            sweeps    = [(k[1:], [v]) for k, v in base.items() if k != '_'+variable] + [(variable, ['%s%s' % (m, unit) for m in missing])]
+            parametric = self.design.create_parametric_setup(sweeps, setup = self.setup.name)
+            try:
+                parametric.solve(**solve_kwargs)
+            finally:
+                parametric.delete()                     # the solved variations stay
+            self.refresh_variations()
+            sweep_variations = self.get_variations_for(variable, values, unit, variation)
+            missing = [value for value, var in zip(values, sweep_variations) if var is None]
+        if missing:
+            raise ValueError('No solved variation with %s = %s %s; solve these first' % (variable, missing, unit))
         
+        print 'Calculating Qseam_'+ seam +' for mode ' + str(mode) + ' (' + str(mode) + '/' + str(self.nmodes-1) + ')' \
+              + ' over ' + str(len(set(sweep_variations))) + ' variations'
         self.solutions.set_mode(mode+1, 0)
         self.fields = self.setup.get_fields()
-        freqs_bare_dict, freqs_bare_vals = self.get_freqs_bare(variation)
-        self.omega = 2*np.pi*freqs_bare_vals[mode]
-        print variation
-        print type(variation)
-        print ureg(variation)
-        self.U_H = self.calc_U_H(variation)
-        lv = self.get_lv(variation)
-        Qseamsweep = []
-        print 'Calculating Qseam_'+ seam +' for mode ' + str(mode) + ' (' + str(mode) + '/' + str(self.nmodes-1) + ')'
-        for value in values:
-            self.design.set_variable(variable, str(value)+unit)
-            
-            j_2_norm = self.fields.Vector_Jsurf.norm_2() # overestimating the loss by taking norm2 of j, rather than jperp**2
-            int_j_2 = j_2_norm.integrate_line(seam)
-            int_j_2_val = int_j_2.evaluate(lv=lv, phase=90)
-            yseam = int_j_2_val/self.U_H/self.omega
-            Qseamsweep.append(gseam/yseam)
-#        Qseamsweep['Qseam_sweep_'+seam+'_'+str(mode)] = gseam/yseam
-            #Cprint 'Qseam_' + seam + '_' + str(mode) + str(' = ') + str(gseam/yseam)
+        gseam_ = SeamLoss(seam).gseam
+        rows = []
+        for value, var in zip(values, sweep_variations):
+            if (seam, mode, var) not in self.seam_cache:
+                lv = self.get_lv(var)
+                freqs_bare_dict, freqs_bare_vals = self.get_freqs_bare(var)
+                self.seam_cache[seam, mode, var] = (2*np.pi*freqs_bare_vals[mode], 
+                                                    self.calc_U_H(var, lv=lv), 
+                                                    self.calc_seam_int_j2(lv, seam))
+            omega, U_H, int_j_2_val = self.seam_cache[seam, mode, var]
+            yseam = int_j_2_val/U_H/omega
+            rows += [(value, var, omega/2/np.pi*10**-9, U_H, int_j_2_val, gseam_/yseam)]
+        table = pd.DataFrame(rows, columns = [variable, 'variation', 'freq', 'U_H', 'int_j_2', 'Qseam'])
+        self.Qseam_sweeps[seam, mode, variable] = table
+        Qseamsweep = table['Qseam'].values
         if pltresult:
+            import matplotlib.pyplot as plt
             fig, ax = plt.subplots()
             ax.plot(values,Qseamsweep)
             ax.set_yscale('log')
@@ -273,15 +485,29 @@ class Bbq(object):
             ax.set_ylabel('Q'+'_'+seam)
         return Qseamsweep
 
+    def get_variations_for(self, variable, values, unit, variation = None):
+        ''' Map each value (in unit) of variable onto a solved variation whose other variables 
+            are the same as in variation (default: nominal). None where no such variation exists. '''
+        base    = self.get_variables(variation)
+        others  = [k for k in base.keys() if k != '_'+variable]
+        matches = {}
+        for i in range(self.nvariations):
+            varz = self.get_variables(str(i))
+            if all(varz.get(k) == base[k] for k in others):
+                matches[extract_value_unit(varz['_'+variable], unit)] = str(i)
+        solved = np.array(sorted(matches.keys()))
+        sweep_variations = []
+        for value in values:
+            close = solved[np.isclose(solved, float(value), rtol = 1e-9, atol = 0)] if len(solved) else []
+            sweep_variations += [matches[close[0]] if len(close) else None]
+        return sweep_variations
+
     def get_Qdielectric(self, dielectric, mode, variation):
-        Qdielectric = {}
         print 'Calculating Qdielectric_'+ dielectric +' for mode ' + str(mode) + ' (' + str(mode) + '/' + str(self.nmodes-1) + ')'
-        
-        U_dielectric = self.calc_U_E(variation, volume=dielectric)
-        p_dielectric = U_dielectric/self.U_E
-        Qdielectric['Qdielectric_'+dielectric+'_'+str(mode)] = 1/(p_dielectric*tan_delta_sapp)
-        print 'p_dielectric'+'_'+dielectric+'_'+str(mode)+' = ' + str(p_dielectric)
-        return Series(Qdielectric)
+        channel     = DielectricLoss(dielectric)
+        Qdielectric = channel.calc_Q(self, self.get_lv(variation), self.U_E, self.U_H, self.omega)
+        print 'p_dielectric'+'_'+dielectric+'_'+str(mode)+' = ' + str(1/(Qdielectric*channel.tan_delta))
+        return pd.Series({channel.sol_key(mode) : Qdielectric})
 
     def get_Qsurface(self, mode, variation):
         '''
@@ -289,54 +515,121 @@ class Bbq(object):
         set the dirt thickness and loss tangent in the config file
         ref: http://arxiv.org/pdf/1509.01854.pdf
         '''
-        lv = self.get_lv(variation)
-        Qsurf = {}
         print 'Calculating Qsurface for mode ' + str(mode) + ' (' + str(mode) + '/' + str(self.nmodes-1) + ')'
-#        A = self.fields.Mag_E**2
-#        A = A.integrate_vol(name='AllObjects')
-#        U_surf = A.evaluate(lv=lv)
+        channel = SurfaceLoss()
+        Qsurf   = channel.calc_Q(self, self.get_lv(variation), self.U_E, self.U_H, self.omega)
+        print 'p_surf'+'_'+str(mode)+' = ' + str(1/(Qsurf*channel.tan_delta))
+        return pd.Series({channel.sol_key(mode) : Qsurf})
+
+    def calc_surf_E2(self, lv, surface = 'AllObjects'):
+        ''' surface integral of |E|^2; surface can be a list of names, in which case all 
+            of them are integrated in one calculator session and an array is returned '''
         calcobject=CalcObject([],self.setup)
         vecE=calcobject.getQty("E")
         A=vecE
         B=vecE.conj()
         A=A.dot(B)
         A=A.real()
-        A=A.integrate_surf(name='AllObjects')
-        U_surf = A.evaluate(lv=lv)
-        U_surf *= th*epsilon_0*eps_r
-        p_surf = U_surf/self.U_E
-        Qsurf['Qsurf_'+str(mode)] = 1/(p_surf*tan_delta_surf)
-        print 'p_surf'+'_'+str(mode)+' = ' + str(p_surf)
-        return Series(Qsurf)
+        if not isinstance(surface, basestring):
+            return A.evaluate_integrals(surface, kind="EnterSurf", lv=lv)
+        A=A.integrate_surf(name=surface)
+        return A.evaluate(lv=lv)
+
+    def get_surface_names(self):
+        ''' all the solids and sheets of the model '''
+        modeler = self.design.modeler
+        return modeler.get_objects_in_group("Solids") + modeler.get_objects_in_group("Sheets")
+
+    def calc_surface_breakdown(self, variation, surfaces = None, modes = None):
+        '''
+        |E|^2 integrated over every surface (default: all solids and sheets) for each mode, with 
+        one calculator session per mode. The sparse (mode, surface) table is cached in 
+        self.surface_E2[variation]; get_surface_participations then needs no HFSS calls.
+        '''
+        if surfaces is None: surfaces = self.get_surface_names()
+        if modes    is None: modes    = range(self.nmodes)
+        lv   = self.get_lv(variation)
+        rows = []
+        for mode in modes:
+            print 'Calculating surface breakdown for mode ' + str(mode) + ' (' + str(len(surfaces)) + ' surfaces)'
+            self.solutions.set_mode(mode+1, 0)
+            self.fields = self.setup.get_fields()
+            rows += self._surface_E2_rows(mode, lv, self.calc_U_E(variation, lv=lv), surfaces)
+        self.surface_E2[variation] = pd.DataFrame(rows, columns = ['mode', 'surface', 'int_E2', 'U_E'])
+        return self.surface_E2[variation]
+
+    def _surface_E2_rows(self, mode, lv, U_E, surfaces):
+        int_E2s = self.calc_surf_E2(lv, surfaces)
+        return [(mode, surface, int_E2, U_E) for surface, int_E2 in zip(surfaces, int_E2s) if int_E2 != 0]
+
+    def get_surface_participations(self, variation, th = th, eps_r = eps_r, tan_delta_surf = tan_delta_surf):
+        ''' see surface_participations; only calls HFSS if variation has no cached breakdown '''
+        if variation not in self.surface_E2: self.calc_surface_breakdown(variation)
+        return surface_participations(self.surface_E2[variation], th, eps_r, tan_delta_surf)
+
+    def calc_Qs_for_mode(self, channels, mode, lv, U_E, U_H, omega):
+        ''' Q of each loss channel for the current mode, sharing its energies and frequency '''
+        return pd.Series(dict((channel.sol_key(mode), channel.calc_Q(self, lv, U_E, U_H, omega)) for channel in channels))
+
+    def get_loss_budget(self, channels, variations = None, modes = None):
+        '''
+        Evaluate all loss channels for all modes of the given variations in one pass. 
+        The frequency, U_E and U_H of each mode are computed once and shared by all the channels.
+            channels   = [SeamLoss('seam1'), DielectricLoss('sapphire', 1e-6), SurfaceLoss(th=3e-9)] 
+            variations = ['0', '1']   (default: all)
+        returns a tidy DataFrame with columns variation, mode, kind, channel, Q; 
+        the 'total' rows hold 1/sum(1/Q) over the channels
+        '''
+        if variations is None:  variations = (['-1'] if self.listvariations == (u'',)  else [str(i) for i in range(self.nvariations)] )
+        if isinstance(variations, basestring): variations = [variations]
+        if modes      is None:  modes = range(self.nmodes)
+        rows = []
+        for variation in variations:
+            lv = self.get_lv(variation)
+            freqs_bare_dict, freqs_bare_vals = self.get_freqs_bare(variation)
+            for mode in modes:
+                self.solutions.set_mode(mode+1, 0)
+                self.fields = self.setup.get_fields()
+                omega = 2*np.pi*freqs_bare_vals[mode]
+                U_E   = self.calc_U_E(variation, lv=lv)
+                U_H   = self.calc_U_H(variation, lv=lv)
+                Qs    = [channel.calc_Q(self, lv, U_E, U_H, omega) for channel in channels]
+                rows += [(variation, mode, channel.kind, channel.name, Q) for channel, Q in zip(channels, Qs)]
+                rows += [(variation, mode, 'total', 'total', 1/np.sum(1/np.array(Qs, dtype=float)))]
+        return pd.DataFrame(rows, columns = ['variation', 'mode', 'kind', 'channel', 'Q'])
     
     def get_Hparams(self, freqs, pjs, lj):
-        Hparams = {}
-        fzpfs = []
-        
-        # calculate Kerr and fzpf
-        for m in self.modes:
-            omega = 2*pi*freqs[m]
-            ej = fluxQ**2/lj
-            pj = pjs['pj_'+str(m)]
-            fzpf = np.sqrt(pj*hbar*omega/ej)
-            fzpfs.append(fzpf)
-            Hparams['fzpf_'+str(m)] = fzpf
-            alpha = 2*ej/fact(4)*nck(4,2)*(fzpf**4)/hbar
-            Hparams['alpha_'+str(m)] = alpha
-            Hparams['freq_'+str(m)]=(omega-alpha)/2/pi
-
-        # calculate chi
-        for m in self.modes:
-            for n in self.modes:
-                if n<m:
-                    chi_mn = ej/hbar*(fzpfs[m]*fzpfs[n])**2
-                    Hparams['chi_'+str(m)+'_'+str(n)] = chi_mn
+        ''' First-order Hamiltonian parameters (rad/s) for self.modes.
+                freqs : bare frequencies in Hz, indexed by mode number
+                pjs   : {'pj_m' : p} of the single-junction method, or an array p_mj [len(self.modes) x njunc] 
+                lj    : junction inductance(s) in H; a scalar or one per junction 
+        '''
+        modes = list(self.modes)
+        if isinstance(pjs, dict):
+            PJ = np.array([[pjs['pj_'+str(m)]] for m in modes])
+        else:
+            PJ = np.asarray(pjs, dtype=float).reshape(len(modes), -1)
+        omegas = 2*pi*np.asarray(freqs, dtype=float)[modes]
+        ejs    = fluxQ**2/np.atleast_1d(np.asarray(lj, dtype=float))
+        CHI, fzpfs, omegas_1 = epr_first_order(omegas, PJ, ejs/hbar)
 
+        Hparams = {}
+        for i, m in enumerate(modes):
+            if PJ.shape[1] == 1:
+                Hparams['fzpf_'+str(m)] = fzpfs[i, 0]
+            else:
+                for j in range(PJ.shape[1]):
+                    Hparams['fzpf_'+str(m)+'_'+str(j)] = fzpfs[i, j]
+            Hparams['alpha_'+str(m)] = CHI[i, i]
+            Hparams['freq_'+str(m)]  = omegas_1[i]/2/pi
+            for k, n in enumerate(modes):
+                if n < m:
+                    Hparams['chi_'+str(m)+'_'+str(n)] = CHI[i, k]
         return Hparams
        
-    def calc_U_E(self, variation, volume=None):
+    def calc_U_E(self, variation, volume=None, lv=None):
         ''' This is 2 * the peak electric energy.(since we do not divide by 2, and use the peak phasors) '''
-        lv = self.get_lv(variation)
+        lv = self.get_lv(variation) if lv is None else lv
         if volume is None:
             volume = 'AllObjects'
         else:
@@ -351,8 +644,8 @@ class Bbq(object):
         A=A.__mul__(0.5)
         return A.evaluate(lv=lv)
         
-    def calc_U_H(self, variation, volume=None):
-        lv = self.get_lv(variation)
+    def calc_U_H(self, variation, volume=None, lv=None):
+        lv = self.get_lv(variation) if lv is None else lv
         if volume is None:
             volume = 'AllObjects'
         else:
@@ -427,7 +720,7 @@ class Bbq(object):
     def do_eBBQ(self, variations= None, plot_fig  = False, modes      = None,
                Pj_from_current  = True, junc_rect = [],    junc_lines = None,  junc_len = [],  junc_LJ_var_name = [],    
                dielectrics      = None, seams     = None,  surface    = False, 
-               calc_Hamiltonian = False,pJ_method =  'J_surf_mag'):
+               calc_Hamiltonian = False,pJ_method =  'J_surf_mag', surface_breakdown = False, solver_stats = False):
         """               
             Pj_from_current:
                 Multi-junction calculation of energy participation ratio matrix based on <I_J>. Current is integrated average of J_surf by default: (zkm 3/29/16)
@@ -446,6 +739,11 @@ class Bbq(object):
             
             Other parameters:
                 seams = ['seam1', 'seam2']  (seams needs to be a list of strings)
+            surface_breakdown = True   stores |E|^2 integrated over every surface under <variation>/surface_E2,
+                                       see surface_participations
+            solver_stats      = True   stores the solver profile and mesh statistics under <variation>/profile 
+                                       and <variation>/mesh_stats, see BbqAnalysis.get_solver_summary 
+                                       (two more exports per variation)
                 variations = ['0', '1']
             
             A variation is a combination of project/design variables in an optimetric sweep
@@ -460,6 +758,7 @@ class Bbq(object):
         if self.latest_h5_path is not None and self.append_analysis:shutil.copyfile(self.latest_h5_path, self.data_filename);
         self.h5file     = hdf = pd.HDFStore(self.data_filename); 
         self.variations = variations;  self.modes = modes; self.njunc = len(junc_rect)
+        loss_channels   = make_loss_channels(seams, dielectrics, surface)
         meta_data['junc_rect'] = junc_rect; meta_data['junc_lines'] = junc_lines; meta_data['junc_len'] = junc_len; meta_data['junc_LJ_var_name'] = junc_LJ_var_name; meta_data['pJ_method'] = pJ_method;
 
         for ii, variation in enumerate(variations):
@@ -473,20 +772,21 @@ class Bbq(object):
                                              = pd.Series(self.get_variables(variation=variation))
             freqs_bare_dict, freqs_bare_vals = self.get_freqs_bare(variation)   # get bare freqs from HFSS
 
-            self.pjs={}; var_sol_accum = [] 
+            self.pjs={}; var_sol_accum = []; surf_E2_accum = []
+            if surface_breakdown: surfaces = self.get_surface_names()
             for mode in modes:
-                sol = Series({'freq' : freqs_bare_vals[mode]*10**-9, 'modeQ' : freqs_bare_dict['Q_'+str(mode)] })
+                sol = pd.Series({'freq' : freqs_bare_vals[mode]*10**-9, 'modeQ' : freqs_bare_dict['Q_'+str(mode)] })
                 self.omega  = 2*np.pi*freqs_bare_vals[mode] # this should really be passed as argument  to the functions rather than a property of the calss I would say 
                 print ' Mode  \x1b[0;30;46m ' +  str(mode) + ' \x1b[0m / ' + str(self.nmodes-1)+'  calculating:'
                 self.solutions.set_mode(mode+1, 0)
                 self.fields = self.setup.get_fields()
 
-                print_NoNewLine('   U_H ...');     sol['U_H'] = self.U_H = self.calc_U_H(variation)
-                print_NoNewLine('   U_E');         sol['U_E'] = self.U_E = self.calc_U_E(variation)
+                print_NoNewLine('   U_H ...');     sol['U_H'] = self.U_H = self.calc_U_H(variation, lv=self.lv)
+                print_NoNewLine('   U_E');         sol['U_E'] = self.U_E = self.calc_U_E(variation, lv=self.lv)
                 print(  "   =>   U_L = %.3f%%" %( (self.U_E - self.U_H )/(2*self.U_E)) )
                 
                 if self.Pj_from_current:
-                    self.LJs    = [ ureg.Quantity(varz['_'+LJvar_nm]).to_base_units().magnitude  for LJvar_nm in junc_LJ_var_name]
+                    self.LJs    = [ to_base_units(varz['_'+LJvar_nm])  for LJvar_nm in junc_LJ_var_name]
                     meta_data['LJs'] = dict(zip(junc_LJ_var_name, self.LJs))
                     print '   I -> p_{mJ} ...'
                     sol_PJ = self.calc_Pjs_from_I_for_mode(variation, self.U_H, self.U_E, self.LJs, junc_rect, junc_len, 
@@ -500,15 +800,15 @@ class Bbq(object):
                     sol['pj1'] = self.get_p_j(mode)
                     self.pjs.update(sol['pj1'])        # convinience function for single junction case
                     
-                if seams is not None:           # get seam Q
-                    for seam in seams: sol = sol.append(self.get_Qseam(seam,mode,variation))
-
-                if dielectrics is not None:     # get Q dielectric      
-                    for dielectric in dielectrics: sol = sol.append(self.get_Qdielectric(dielectric, mode, variation))
-                               
-                if surface is True:             # get Q surface                              
-                    sol = sol.append( self.get_Qsurface(mode, variation) )
+                if loss_channels:               # get seam, dielectric and surface Qs 
+                    print_NoNewLine('   Q losses ...')
+                    sol_Q = self.calc_Qs_for_mode(loss_channels, mode, self.lv, self.U_E, self.U_H, self.omega)
+                    print '  ' + ', '.join('%s = %.3g' % kv for kv in sol_Q.iteritems())
+                    sol = sol.append(sol_Q)
                     
+                if surface_breakdown:           # get |E|^2 on every surface 
+                    surf_E2_accum += self._surface_E2_rows(mode, self.lv, self.U_E, surfaces)
+
                 var_sol_accum +=[sol]
             
             #TODO: add metadata to the Dataframe & save it
@@ -516,8 +816,22 @@ class Bbq(object):
             hdf[variation+'/eBBQ_solution']  = self.sols[variation]  \
                                              = pd.DataFrame(var_sol_accum, index = modes)            
             hdf[variation+'/meta_data']      = self.meta_data[variation]  \
-                                             = Series(meta_data)
-            if calc_Hamiltonian:  raise('Not implemented'); #for 1 junct: self.get_Hparams(freqs_bare_vals, self.pjs, lj))
+                                             = pd.Series(meta_data)
+            if surface_breakdown:
+                hdf[variation+'/surface_E2'] = self.surface_E2[variation] \
+                                             = pd.DataFrame(surf_E2_accum, columns = ['mode', 'surface', 'int_E2', 'U_E'])
+            if solver_stats:
+                try:
+                    profile, mesh_stats = self.get_solver_stats(variation)
+                    hdf[variation+'/profile']    = profile
+                    hdf[variation+'/mesh_stats'] = mesh_stats
+                except (IOError, pythoncom.com_error) as e: # e.g. not saved for this variation
+                    print_color('  Could not read the solver profile / mesh statistics: %s' % e)
+            if calc_Hamiltonian:
+                LJs = [ to_base_units(varz['_'+LJvar_nm])  for LJvar_nm in junc_LJ_var_name]
+                PJ  = self.sols[variation].loc[:, ['pJ_'+r for r in junc_rect]].values if self.Pj_from_current else self.pjs
+                hdf[variation+'/Hparams']        = self.hparams[variation] \
+                                                 = pd.Series(self.get_Hparams(freqs_bare_vals, PJ, LJs))
             
         self.h5file.close()
         self.bbq_analysis = BbqAnalysis(self.data_filename, variations=self.variations)
@@ -549,6 +863,119 @@ def eBBQ_ND(freqs, PJ, Om, EJ, LJs, SIGN, cos_trunc = 6, fock_trunc  = 7):
     CHI_ND= -1*CHI_ND *1E-6;
     return f1s, CHI_ND, fzpfs, f0s;
     
+def epr_first_order(freqs, PJ, EJs):
+    ''' First-order energy-participation Hamiltonian parameters, all in a single broadcasted expression.
+            freqs : [..., nmodes]          mode frequencies 
+            PJ    : [..., nmodes, njunc]   participation matrix p_mj
+            EJs   : [..., njunc]           junction energies, in the same units as freqs 
+        Leading dimensions broadcast, so a stack of variations is handled in one call.
+        returns CHI   [..., nmodes, nmodes]  cross-Kerr, with the anharmonicity alpha on the diagonal 
+                fzpfs [..., nmodes, njunc]   reduced zero-point fluctuations  
+                f1s   [..., nmodes]          frequencies dressed down by alpha
+    '''
+    freqs = np.asarray(freqs, dtype=float)
+    PJ    = np.asarray(PJ,    dtype=float)
+    EJs   = np.asarray(EJs,   dtype=float)
+    PJ_EJ = PJ / EJs[..., None, :]
+    fzpfs = np.sqrt(PJ_EJ * freqs[..., :, None])
+    CHI   = np.sum(PJ_EJ[..., :, None, :] * PJ[..., None, :, :], axis=-1) * freqs[..., :, None] * freqs[..., None, :]
+    diag  = np.arange(CHI.shape[-1])
+    CHI[..., diag, diag] /= 2                       # Make the diagonals alpha 
+    f1s   = freqs - CHI[..., diag, diag]            # 1st order PT expect freq to be dressed down by alpha 
+    return CHI, fzpfs, f1s
+
+def epr_perturbed(f0s, PJ, EJs, dLJ, dC = 0):
+    ''' Frozen-mode first-order perturbation of the junction inductances LJ_j -> LJ_j (1+dLJ_j) and of the mode 
+        capacitances C -> C (1+dC): the mode shapes are kept, only the inductive energies are reweighted, so 
+            w'^2/w^2 = (1 - sum_j p_mj dLJ_j/(1+dLJ_j)) / (1+dC),    p'_mj = p_mj/(1+dLJ_j) / (1 - sum_j p_mj dLJ_j/(1+dLJ_j))
+            f0s : [nmodes],  PJ : [nmodes, njunc],  EJs : [njunc],  dLJ : [..., njunc],  dC : scalar or [..., nmodes]
+        returns f0s [..., nmodes], PJ [..., nmodes, njunc], EJs [..., njunc], ready for epr_first_order
+    '''
+    dLJ   = np.asarray(dLJ, dtype=float)
+    PJ    = np.asarray(PJ,  dtype=float)
+    ratio = 1 - np.sum(PJ * (dLJ/(1+dLJ))[..., None, :], axis=-1)
+    PJs   = PJ / (1+dLJ)[..., None, :] / ratio[..., None]
+    f0s   = np.asarray(f0s, dtype=float) * np.sqrt(ratio / (1+np.asarray(dC, dtype=float)))
+    return f0s, PJs, np.asarray(EJs, dtype=float) / (1+dLJ)
+
+def _epr_monte_carlo_chunk(args):
+    ''' one block of samples of epr_monte_carlo (module level, so it can be sent to worker processes) '''
+    f0s, PJ, EJs, sigma_LJ, sigma_LJ_common, sigma_C, n, seed = args
+    rng = np.random.RandomState(seed)
+    dLJ = rng.normal(0, 1, (n, len(EJs))) * sigma_LJ + rng.normal(0, 1, (n, 1)) * sigma_LJ_common
+    dLJ = np.clip(dLJ, -0.9, None)                                          # keep LJ and C positive 
+    dC  = np.clip(rng.normal(0, 1, (n, 1)) * sigma_C, -0.9, None)
+    f0s, PJs, EJs = epr_perturbed(f0s, PJ, EJs, dLJ, dC)
+    CHI, _, f1s = epr_first_order(f0s, PJs, EJs)
+    return dLJ, f0s, f1s, CHI
+
+def _H_params_columns(f0, f1, CHI, PJ = None, junc_names = ()):
+    ''' (name, [n]) columns of a stack of first-order results: f0_<m>, f1_<m> [GHz], alpha_<m>, chi_<m>_<n> [MHz] 
+        and pJ_<m>_<junc> '''
+    nmodes   = CHI.shape[-1]
+    columns  = [('f0_%d' % m, f0[:, m]) for m in range(nmodes)] + [('f1_%d' % m, f1[:, m]) for m in range(nmodes)]
+    columns += [('alpha_%d' % m, 1000*CHI[:, m, m]) for m in range(nmodes)]
+    columns += [('chi_%d_%d' % (m, n), 1000*CHI[:, m, n]) for m in range(nmodes) for n in range(m+1, nmodes)]
+    if PJ is not None:
+        columns += [('pJ_%d_%s' % (m, j), PJ[:, m, i]) for m in range(nmodes) for i, j in enumerate(junc_names)]
+    return columns
+
+def epr_monte_carlo(f0s, PJ, LJs, sigma_LJ = 0.02, sigma_LJ_common = 0, sigma_C = 0, n_samples = 100000, 
+                    chunk_size = 100000, processes = None, seed = None, junc_names = None):
+    ''' Fabrication spread of the first-order Hamiltonian parameters of one solved variation, without new solves: 
+        relative Gaussian spreads of the junction inductances (sigma_LJ per junction, scalar or [njunc], plus a common 
+        wafer-level shift sigma_LJ_common) and of the capacitances (sigma_C, common to all modes) are propagated 
+        through the stored participations with epr_perturbed. 
+            f0s : [nmodes] in GHz,  PJ : [nmodes, njunc] (renormalized, as in eBBQ_Pmj_to_H_params),  LJs : [njunc] in H
+            chunk_size : samples per vectorized block;  processes : number of worker processes, default none 
+        returns DataFrame, one row per sample: dLJ_<junc> (as used, clipped at -0.9), f0_<m> and f1_<m> [GHz], 
+        alpha_<m> and chi_<m>_<n> [MHz]
+        e.g. epr_monte_carlo(...).describe(percentiles = [.05, .5, .95])
+    '''
+    LJs    = np.asarray(LJs, dtype=float)
+    EJs    = fluxQ**2/LJs/Planck*10**-9                                     # EJs in GHz
+    counts = [min(chunk_size, n_samples - start) for start in range(0, n_samples, chunk_size)]
+    seeds  = np.random.RandomState(seed).randint(0, 2**31 - 1, len(counts))
+    jobs   = [(f0s, PJ, EJs, sigma_LJ, sigma_LJ_common, sigma_C, n, s) for n, s in zip(counts, seeds)]
+    if processes:
+        import multiprocessing
+        pool   = multiprocessing.Pool(processes)
+        try:
+            chunks = pool.map(_epr_monte_carlo_chunk, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        chunks = map(_epr_monte_carlo_chunk, jobs)
+    dLJ, f0, f1, CHI = [np.concatenate(x) for x in zip(*chunks)]
+    junc_names = junc_names if junc_names is not None else [str(j) for j in range(len(LJs))]
+    columns    = [('dLJ_'+j, dLJ[:, i]) for i, j in enumerate(junc_names)] + _H_params_columns(f0, f1, CHI)
+    return pd.DataFrame(dict(columns), columns = [name for name, _ in columns])
+
+def epr_LJ_scan(f0s, PJ, LJs, LJ_grid, junc_names = None):
+    ''' Perturbative LJ scan from one solved variation (see epr_perturbed), instead of an eigenmode solve per LJ value.
+        The error grows with the relative LJ change (second order in dLJ for the frequencies); check it against 
+        solved points with BbqAnalysis.check_LJ_scan.
+            f0s : [nmodes] in GHz,  PJ : [nmodes, njunc],  LJs : [njunc] in H of the solved variation
+            LJ_grid : [npoints, njunc] in H
+        returns DataFrame, one row per grid point: LJ_<junc>, f0_<m>, f1_<m> [GHz], alpha_<m>, chi_<m>_<n> [MHz], pJ_<m>_<junc>
+    '''
+    LJs     = np.asarray(LJs, dtype=float)
+    LJ_grid = np.asarray(LJ_grid, dtype=float).reshape(-1, len(LJs))
+    f0, PJs, EJs = epr_perturbed(f0s, PJ, fluxQ**2/LJs/Planck*10**-9, LJ_grid/LJs - 1)
+    CHI, _, f1   = epr_first_order(f0, PJs, EJs)
+    junc_names   = junc_names if junc_names is not None else [str(j) for j in range(len(LJs))]
+    columns      = [('LJ_'+j, LJ_grid[:, i]) for i, j in enumerate(junc_names)] + _H_params_columns(f0, f1, CHI, PJs, junc_names)
+    return pd.DataFrame(dict(columns), columns = [name for name, _ in columns])
+
+def junction_order(meta_data):
+    ''' LJ variable names, junc_rect names and LJs [H] of the junctions, in the order given to do_eBBQ. 
+        meta_data['LJs'] is a dict and the pJ_/sign_ columns of a solution are sorted by junc_rect name, 
+        so neither can be used for the order. '''
+    names = [str(j) for j in meta_data['junc_LJ_var_name']]
+    rects = list(meta_data['junc_rect'])
+    return names, rects, np.array([meta_data['LJs'][j] for j in names], dtype = float)
+
 def eBBQ_Pmj_to_H_params(s, meta_data, cos_trunc = None, fock_trunc = None):
     '''   
     returns the CHIs as MHz with anharmonicity alpha as the diagonal  (with - sign)
@@ -557,31 +984,108 @@ def eBBQ_Pmj_to_H_params(s, meta_data, cos_trunc = None, fock_trunc = None):
         and an overcomplete set of matrcieis
         ask zkm for info.
     '''
-    import  scipy;    Planck  = scipy.constants.Planck
     f0s        = np.array( s['freq'] )
     Qs         = s['modeQ']
-    LJs        = np.array(meta_data['LJs'].values())                     # LJ in H
+    _, rects, LJs = junction_order(meta_data)                           # LJ in H
     EJs        = (fluxQ**2/LJs/Planck*10**-9).astype(np.float)        # EJs in GHz
-    PJ_Jsu     = s.loc[:,s.keys().str.contains('pJ')]  # EPR from Jsurf avg
+    PJ_Jsu     = s.loc[:,['pJ_'+r for r in rects]]  # EPR from Jsurf avg
     PJ_Jsu_sum = PJ_Jsu.apply(sum, axis = 1)           # sum of participations as calculated by avg surf current 
     PJ_glb_sum = (s['U_E'] - s['U_H'])/(2*s['U_E'])    # sum of participations as calculated by global UH and UE  
     diff       = (PJ_Jsu_sum-PJ_glb_sum)/PJ_glb_sum*100# debug
     if 1:  # Renormalize
         PJs = PJ_Jsu.divide(PJ_Jsu_sum, axis=0).mul(PJ_glb_sum,axis=0)
     else: PJs = PJ_Jsu
-    SIGN  = s.loc[:,s.keys().str.contains('sign_')]
+    SIGN  = s.loc[:,[c for c in ['sign_'+r for r in rects] if c in s]]
     PJ    = np.mat(PJs.values)
     Om    = np.mat(np.diagflat(f0s)) 
     EJ    = np.mat(np.diagflat(EJs))
-    CHI_O1= Om * PJ * EJ.I * PJ.T * Om * 1000       # MHz
-    CHI_O1= divide_diagonal_by_2(CHI_O1)            # Make the diagonals alpha 
-    f1s   = f0s - np.diag(CHI_O1)                   # 1st order PT expect freq to be dressed down by alpha 
+    CHI_O1, _, f1s = epr_first_order(f0s, PJs.values, EJs)
+    CHI_O1= np.mat(CHI_O1 * 1000)                   # MHz;  f1s stay in GHz, dressed down by alpha 
     if cos_trunc is not None:
         f1s, CHI_ND, fzpfs, f0s = eBBQ_ND(f0s, PJ, Om, EJ, LJs, SIGN, cos_trunc = cos_trunc, fock_trunc = fock_trunc)                
     else: CHI_ND, fzpfs = None, None
     return CHI_O1, CHI_ND, PJ, Om, EJ, diff, LJs, SIGN, f0s, f1s, fzpfs, Qs
     # the return could be made clener, or dictionary 
 
+def zBBQ_participations(fit, LJs, freq_range = None, pj_tol = 1e-4, min_Q = 1.):
+    ''' Participations from a Foster (vector) fit of the junction-port impedance matrix, Z_jk(s) = sum_m r_mjk/(s-p_m) + c.c.
+        Each pole is a parallel LC seen from the ports: C_m = 1/(2 Re r_mjj), so the fraction of the inductive energy 
+        in junction j is p_mj = 1/(w_m^2 LJ_j C_m) = 2 Re r_mjj / (w_m^2 LJ_j). The sign of junction j follows Re r_mjk 
+        relative to the junction with the largest participation.
+        A fit of higher order than the number of modes leaves extra poles with a vanishing or tiny residue, 
+        or a very low Q (background); these are not modes and are dropped.
+            fit : vectfit.VectorFit of Z [freq, junc, junc] in ohm, with the junctions (LJs) included 
+            pj_tol : keep poles whose total junction participation is above pj_tol times the largest one 
+            min_Q  : keep poles with Q above min_Q 
+        returns f0s [Hz], PJ [mode, junc], SIGN [mode, junc], Qs [mode]
+    '''
+    LJs   = np.asarray(LJs, dtype = float)
+    upper = fit.poles.imag > 0
+    poles = fit.poles[upper]
+    R     = fit.residues[upper].real.reshape(len(poles), len(LJs), len(LJs))
+    omega = poles.imag
+    f0s   = omega/(2*pi)
+    Qs    = omega/(2*np.abs(poles.real))
+    diag  = np.arange(len(LJs))
+    PJ    = np.clip(2*R[:, diag, diag] / (omega[:, None]**2 * LJs[None, :]), 0, None)
+    ref   = np.argmax(PJ, axis = 1)
+    SIGN  = np.where(R[np.arange(len(poles)), ref, :] < 0, -1, 1)
+    PJ_sum = PJ.sum(axis = 1)
+    keep  = (PJ_sum > pj_tol * (PJ_sum.max() if len(PJ_sum) else 0)) & (Qs > min_Q)   # left-over poles of the fit, not modes 
+    if freq_range is not None:
+        keep &= (f0s >= freq_range[0]) & (f0s <= freq_range[1])
+    order = np.argsort(f0s[keep])
+    return f0s[keep][order], PJ[keep][order], SIGN[keep][order], Qs[keep][order]
+
+def zBBQ_to_H_params(freq, Z, LJs, junc_names = None, lj_in_sweep = True, freq_range = None, pj_tol = 1e-4, min_Q = 1.,
+                     cos_trunc = None, fock_trunc = None, **fit_kwargs):
+    ''' Impedance BBQ: Hamiltonian parameters straight from the junction-port impedance of a driven sweep, 
+        without any field calculator integrals. Same return schema as eBBQ_Pmj_to_H_params (CHIs in MHz, f in GHz);
+        diff is the relative rms error of the fit in %. 
+            freq : [freq] in Hz,  Z : [freq, junc, junc] in ohm,  LJs : [junc] in H
+            lj_in_sweep : the junction inductances are part of the simulated model (e.g. a lumped port across 
+                          the junction's RLC boundary); otherwise they are added in parallel here
+            freq_range  : (fmin, fmax) in Hz of the modes to keep, default the sweep range  
+            pj_tol, min_Q : thresholds on the poles kept as modes, see zBBQ_participations 
+            fit_kwargs  : passed to vectfit.vector_fit, e.g. n_poles 
+    '''
+    freq  = np.asarray(freq, dtype = float)
+    Z     = np.asarray(Z,    dtype = complex).reshape(len(freq), len(LJs), len(LJs))
+    LJs   = np.asarray(LJs,  dtype = float)
+    if not lj_in_sweep:
+        Y = np.linalg.inv(Z) + np.eye(len(LJs)) / (2j*pi*freq[:, None, None]*LJs[None, None, :])
+        Z = np.linalg.inv(Y)
+    fit   = vector_fit(freq, Z, **fit_kwargs)
+    if not fit.ok:
+        print_color('  Impedance fit relative rms error %.2g, the Hamiltonian parameters may be off; try more poles' % fit.rel_error)
+    f0s, PJ, SIGN, Qs = zBBQ_participations(fit, LJs, (freq.min(), freq.max()) if freq_range is None else freq_range,
+                                            pj_tol = pj_tol, min_Q = min_Q)
+    f0s   = f0s * 10**-9                                                     # GHz, as in eBBQ 
+    EJs   = (fluxQ**2/LJs/Planck*10**-9).astype(np.float)                    # EJs in GHz
+    modes = range(len(f0s))
+    junc_names = junc_names if junc_names is not None else [str(j) for j in range(len(LJs))]
+    SIGN  = pd.DataFrame(SIGN, index = modes, columns = ['sign_'+j for j in junc_names])
+    Qs    = pd.Series(Qs, index = modes)
+    diff  = pd.Series(100*fit.rel_error, index = modes)
+    Om    = np.mat(np.diagflat(f0s))
+    EJ    = np.mat(np.diagflat(EJs))
+    CHI_O1, _, f1s = epr_first_order(f0s, PJ, EJs)
+    CHI_O1 = np.mat(CHI_O1 * 1000)                                          # MHz
+    PJ    = np.mat(PJ)
+    if cos_trunc is not None:
+        f1s, CHI_ND, fzpfs, f0s = eBBQ_ND(f0s, PJ, Om, EJ, LJs, SIGN, cos_trunc = cos_trunc, fock_trunc = fock_trunc)
+    else: CHI_ND, fzpfs = None, None
+    return CHI_O1, CHI_ND, PJ, Om, EJ, diff, LJs, SIGN, f0s, f1s, fzpfs, Qs
+
+def zBBQ_from_sweep(sweep, LJs, ports = None, z0 = None, **kwargs):
+    ''' zBBQ_to_H_params on the Z matrix of an HfssFrequencySweep; ports: indices of the junction ports 
+        (default all ports), in the order of LJs '''
+    freq, matrices = sweep.get_network_matrices("Z", z0 = z0)
+    Z = matrices["Z"]
+    if ports is not None:
+        Z = Z[:, ports][:, :, ports]
+    return zBBQ_to_H_params(freq, Z, LJs, **kwargs)
+
 
 #%%    
 class BbqAnalysis(object):
@@ -592,7 +1096,7 @@ class BbqAnalysis(object):
     def __init__(self, data_filename, variations=None):
         #raise('not implemented')
         self.data_filename = data_filename
-        with HDFStore(data_filename, mode = 'r') as hdf:  # = h5py.File(data_filename, 'r')        
+        with pd.HDFStore(data_filename, mode = 'r') as hdf:  # = h5py.File(data_filename, 'r')        
             # i think we should open & close the file here, i dont see why we need to keep it open & keep accessing it. It is small in memeory, just load it into the RAM.
             # all the data will be stored in 3 objects.        
             if variations is None:
@@ -605,21 +1109,36 @@ class BbqAnalysis(object):
             self.hfss_variables = {}
             self.sols           = {}
             self.meta_data      = {}
+            self.surface_E2     = {}
+            self.profiles       = {}
+            self.mesh_stats     = {}
             for variation in variations:
                 self.hfss_variables[variation] = hdf[variation+'/hfss_variables']
                 self.sols[variation]           = hdf[variation+'/eBBQ_solution']  
                 self.meta_data[variation]      = hdf[variation+'/meta_data']
+                if '/'+variation+'/surface_E2' in hdf.keys():
+                    self.surface_E2[variation] = hdf[variation+'/surface_E2']
+                if '/'+variation+'/profile' in hdf.keys():
+                    self.profiles[variation]   = hdf[variation+'/profile']
+                    self.mesh_stats[variation] = hdf[variation+'/mesh_stats']
             self.nmodes         = self.sols[variations[0]].shape[0] 
-            self.meta_data      = DataFrame(self.meta_data)
+            self.meta_data      = pd.DataFrame(self.meta_data)
     
+    def get_solver_summary(self, sort_by = 'real_time'):
+        ''' One row per variation: passes, real/cpu time [s], time per pass, peak memory [MB], tets (from the profile)
+            and the total tets of the mesh statistics, slowest variations first. '''
+        summary = pd.DataFrame({variation: profile_summary(profile) for variation, profile in self.profiles.items()}).T
+        summary['mesh_tets'] = pd.Series({variation: stats['num_tets'].sum() for variation, stats in self.mesh_stats.items()
+                                          if 'num_tets' in stats})
+        return summary.sort_values(sort_by, ascending = False)
+
     def get_solution_column(self, col_name, swp_var, sort = True): 
         ''' sort by variation -- must be numeric '''
         Qs, swp = [], []       
         for key, sol in self.sols.iteritems():
             Qs  += [ sol[col_name] ]
-            varz  = self.hfss_variables[key]
-            swp += [ ureg.Quantity(varz['_'+swp_var]).magnitude ] 
-        Qs  = DataFrame(Qs, index = swp)
+            swp += [ self.hfss_variables[key]['_'+swp_var] ]
+        Qs  = pd.DataFrame(Qs, index = get_magnitudes(swp))
         return Qs if not sort else Qs.sort_index() 
     
     def get_Qs(self, swp_var, sort = True):
@@ -628,6 +1147,105 @@ class BbqAnalysis(object):
     def get_Fs(self, swp_var, sort = True):
         return self.get_solution_column('freq', swp_var, sort)
         
+    def get_epr_inputs(self, variation = '0'):
+        ''' f0s [GHz], renormalized PJ [mode, junc] and LJs [H] of a variation, as used by eBBQ_Pmj_to_H_params '''
+        s          = self.sols[variation]
+        _, rects, LJs = junction_order(self.meta_data[variation])
+        PJ_Jsu     = s.loc[:,['pJ_'+r for r in rects]]
+        PJ_glb_sum = (s['U_E'] - s['U_H'])/(2*s['U_E'])
+        PJ         = PJ_Jsu.divide(PJ_Jsu.apply(sum, axis = 1), axis=0).mul(PJ_glb_sum,axis=0)
+        return np.array(s['freq']), PJ.values, LJs
+
+    def get_Hparams_O1(self, variations = None):
+        ''' First-order CHI [MHz] (alpha on the diagonal) and dressed freqs f1s [GHz] of many variations 
+            in one broadcasted call. The variations must share the same modes and junctions. 
+            returns CHI [nvariations, nmodes, nmodes], f1s [nvariations, nmodes] in the order of variations '''
+        variations = self.variations if variations is None else variations
+        f0s, PJs, EJs = [], [], []
+        for variation in variations:
+            f0, PJ, LJs = self.get_epr_inputs(variation)
+            f0s        += [ f0 ]
+            PJs        += [ PJ ]
+            EJs        += [ fluxQ**2/LJs/Planck*10**-9 ]
+        CHI, fzpfs, f1s = epr_first_order(np.array(f0s), np.array(PJs), np.array(EJs))
+        return CHI*1000, f1s
+
+    def monte_carlo(self, variation = '0', **kwargs):
+        ''' epr_monte_carlo on the stored participations of a variation; kwargs: sigma_LJ, sigma_C, n_samples, processes, ... '''
+        f0s, PJ, LJs = self.get_epr_inputs(variation)
+        junc_names   = junction_order(self.meta_data[variation])[0]
+        return epr_monte_carlo(f0s, PJ, LJs, junc_names = junc_names, **kwargs)
+
+    def scan_LJ(self, variation = '0', LJ_values = None, LJ_grid = None):
+        ''' epr_LJ_scan from the stored participations of a variation, over the product of 
+            LJ_values = {LJ variable: [values in H]} (the other junctions stay at their solved LJ), or an explicit LJ_grid '''
+        f0s, PJ, LJs = self.get_epr_inputs(variation)
+        junc_names   = junction_order(self.meta_data[variation])[0]
+        if LJ_grid is None:
+            axes    = [LJ_values.get(j, [LJ]) for j, LJ in zip(junc_names, LJs)]
+            LJ_grid = np.array(np.meshgrid(*axes, indexing = 'ij')).reshape(len(LJs), -1).T
+        return epr_LJ_scan(f0s, PJ, LJs, LJ_grid, junc_names)
+
+    def check_LJ_scan(self, variation = '0', variations = None):
+        ''' Error of the LJ scan from variation at the other solved variations that differ from it only in the LJ variables:
+            predicted - solved (first order, see get_Hparams_O1) of the frequencies, chis and participations (pJ_<m>_<junc>), 
+            one row per solved variation, with the relative LJ change. 
+            Modes are compared by index, so they should not cross between the variations. '''
+        f0s, PJ, LJs = self.get_epr_inputs(variation)
+        junc_names   = junction_order(self.meta_data[variation])[0]
+        others       = lambda v: self.hfss_variables[v].drop(['_'+j for j in junc_names], errors = 'ignore')
+        variations   = [v for v in (self.variations if variations is None else variations) if v != variation 
+                        and others(v).equals(others(variation))]
+        if not variations:
+            return pd.DataFrame()
+        LJ_grid      = np.array([[self.meta_data[v]['LJs'][j] for j in junc_names] for v in variations])
+        predicted    = epr_LJ_scan(f0s, PJ, LJs, LJ_grid, junc_names)
+        CHI, f1      = self.get_Hparams_O1(variations)
+        inputs       = [self.get_epr_inputs(v) for v in variations]
+        solved       = pd.DataFrame(dict(_H_params_columns(np.array([x[0] for x in inputs]), f1, CHI/1000., 
+                                                           np.array([x[1] for x in inputs]), junc_names)))
+        columns      = [c for c in predicted.columns if c in solved.columns]
+        errors       = pd.DataFrame(predicted[columns].values - solved[columns].values, index = variations, columns = columns)
+        for i, j in enumerate(junc_names):
+            errors.insert(i, 'dLJ_'+j, LJ_grid[:, i]/LJs[i] - 1)
+        return errors
+        
+    def get_results_table(self, variations = None):
+        ''' One row per variation: the numeric design variables (SI, without the leading _) and the first-order results,
+            f0_<m>, f1_<m> [GHz], alpha_<m>, chi_<m>_<n> [MHz], pJ_<m>_<junc> and Q_<m> '''
+        variables, results = self._results_tables(variations)
+        return variables.join(results)
+
+    def _results_tables(self, variations = None):
+        variations = self.variations if variations is None else variations
+        variables  = {}
+        for variation in variations:
+            for name, value in self.hfss_variables[variation].iteritems():
+                try:
+                    variables.setdefault(name.lstrip('_'), {})[variation] = to_base_units(str(value))
+                except Exception:
+                    pass                                               # non-numeric variable 
+        CHI, f1      = self.get_Hparams_O1(variations)
+        inputs       = [self.get_epr_inputs(v) for v in variations]
+        junc_names   = junction_order(self.meta_data[variations[0]])[0]
+        columns      = _H_params_columns(np.array([x[0] for x in inputs]), f1, CHI/1000., np.array([x[1] for x in inputs]), junc_names)
+        columns     += [('Q_%d' % m, np.array([self.sols[v]['modeQ'].values[m] for v in variations])) for m in range(CHI.shape[-1])]
+        results      = pd.DataFrame(dict(columns), index = variations, columns = [name for name, _ in columns])
+        return pd.DataFrame(variables).reindex(variations), results
+
+    def get_surrogate(self, outputs = None, variables = None, variations = None, bounds = None, **gp_kwargs):
+        ''' surrogate.Surrogate of the results table: outputs (default all result columns) as functions of 
+            variables (default the numeric variables that change between the variations) '''
+        from surrogate import Surrogate
+        X, Y      = self._results_tables(variations)
+        if variables is None:
+            variables = [c for c in X.columns if X[c].nunique() > 1]
+        return Surrogate(X[variables], Y if outputs is None else Y[outputs], bounds, **gp_kwargs)
+
+    def get_surface_participations(self, variation = '0', th = th, eps_r = eps_r, tan_delta_surf = tan_delta_surf):
+        ''' see surface_participations; requires do_eBBQ(..., surface_breakdown = True) '''
+        return surface_participations(self.surface_E2[variation], th, eps_r, tan_delta_surf)
+
     def get_junc_rect_names(self):
         return self.meta_data.loc['junc_rect',:]
         
@@ -729,6 +1347,7 @@ class BbqAnalysis(object):
     @deprecated
     def plot_Hparams(self, variable_name=None, modes=None):
         #TODO: needs to be updated to new standard; currently borken
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(2,2, figsize=(24,10))
 
         if variable_name == None:
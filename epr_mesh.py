@@ -0,0 +1,299 @@
+"""
+Offline EPR integrals on a tetrahedral mesh with nodal field values, e.g. the
+mesh-node export of field_export, so that energies, surface currents and line
+integrals can be (re)computed in bulk with NumPy instead of one calculator
+call each.
+
+Fields are taken as linear on each element (first-order basis), for which the
+quadratures below are exact:
+    tetrahedron  int |u|^2 = V/20 (sum |u_i|^2 + |sum u_i|^2)
+    triangle     int |u|^2 = A/12 (sum |u_i|^2 + |sum u_i|^2)
+    segment      int |u|^2 = L/6  (|u_0|^2 + |u_1|^2 + |u_0 + u_1|^2)
+and int u = V/4, A/3, L/2 times sum u_i. |u| itself is averaged over the nodes.
+
+Mesh exchange format (TetMesh.load / save, an .npz):
+    nodes [N x 3] in m, tets [M x 4] node indices, tet_object [M] index into
+    objects [n_obj] names, materials [n_obj] the material of each object,
+    and optionally, per named surface, "surface:<name>" [K x 3] node indices.
+The HFSS mesh comes from a mesh plot exported as an EnSight Gold case
+(TetMesh.from_ensight), which field_export.FieldExporter.export_mesh writes
+into the field archive, next to the fields on the same nodes.
+"""
+from __future__ import division
+import os
+import numpy
+from scipy.constants import epsilon_0, mu_0
+
+
+class TetMesh(object):
+    def __init__(self, nodes, tets, tet_object, objects, materials, surfaces=None):
+        self.nodes = numpy.asarray(nodes, dtype=float)
+        self.tets = numpy.asarray(tets, dtype=int)
+        self.tet_object = numpy.asarray(tet_object, dtype=int)
+        self.objects = list(objects)
+        self.materials = list(materials)
+        self.surfaces = dict((k, numpy.asarray(v, dtype=int)) for k, v in (surfaces or {}).items())
+        self._volumes = None
+
+    @classmethod
+    def load(cls, fn):
+        data = numpy.load(fn)
+        surfaces = dict((k[len("surface:"):], data[k]) for k in data.files if k.startswith("surface:"))
+        return cls(data["nodes"], data["tets"], data["tet_object"], data["objects"], data["materials"], surfaces)
+
+    @classmethod
+    def from_ensight(cls, fn, materials=None, length_scale=1.):
+        """
+        Mesh of an EnSight Gold (ASCII) case, e.g. an HFSS mesh plot exported with
+        ExportFieldPlot: parts with tetrahedra are the objects, parts with triangles
+        the named surfaces (sheets). Part descriptions are taken as object names.
+        :param materials: {object: material}, default "vacuum"
+        :param length_scale: m per coordinate unit of the export, e.g. 1e-3 for mm
+        """
+        parts = read_ensight(fn)
+        points = numpy.concatenate([part["coordinates"] for part in parts]) * length_scale
+        nodes, index = numpy.unique(points, axis=0, return_inverse=True)  # parts repeat their shared nodes
+        offsets = numpy.cumsum([0] + [len(part["coordinates"]) for part in parts])
+        objects, tets, tet_object, surfaces = [], [], [], {}
+        for part, offset in zip(parts, offsets):
+            if "tetra4" in part["elements"]:
+                tets.append(index[part["elements"]["tetra4"] + offset])
+                tet_object.append(numpy.full(len(tets[-1]), len(objects), dtype=int))
+                objects.append(part["name"])
+            if "tria3" in part["elements"]:
+                surfaces[part["name"]] = index[part["elements"]["tria3"] + offset]
+        if not tets:
+            raise ValueError("No tetrahedra in %s" % fn)
+        materials = materials or {}
+        return cls(nodes, numpy.concatenate(tets), numpy.concatenate(tet_object), objects,
+                   [materials.get(name, "vacuum") for name in objects], surfaces)
+
+    def save(self, fn):
+        arrays = dict(("surface:" + k, v) for k, v in self.surfaces.items())
+        numpy.savez(fn, nodes=self.nodes, tets=self.tets, tet_object=self.tet_object,
+                    objects=numpy.array(self.objects), materials=numpy.array(self.materials), **arrays)
+
+    @property
+    def volumes(self):
+        """ [M] tetrahedron volumes """
+        if self._volumes is None:
+            p = self.nodes[self.tets]
+            self._volumes = numpy.abs(numpy.einsum("ij,ij->i", p[:, 1] - p[:, 0],
+                                                   numpy.cross(p[:, 2] - p[:, 0], p[:, 3] - p[:, 0]))) / 6
+        return self._volumes
+
+    def mask(self, objects=None, materials=None):
+        """ [M] boolean mask of the tetrahedra in any of objects and any of materials (None: all) """
+        keep = numpy.ones(len(self.objects), dtype=bool)
+        if objects is not None:
+            keep &= numpy.in1d(self.objects, objects)
+        if materials is not None:
+            keep &= numpy.in1d(self.materials, materials)
+        return keep[self.tet_object]
+
+    def element_property(self, values, default=1.):
+        """ [M] per-element value of a {material: value} dict, e.g. relative permittivities """
+        per_object = numpy.array([values.get(m, default) for m in self.materials])
+        return per_object[self.tet_object]
+
+    def faces(self, mask=None):
+        """ unique [K x 3] triangles of the tetrahedra in mask, and the number of tetrahedra on each """
+        tets = self.tets if mask is None else self.tets[mask]
+        faces = numpy.concatenate([tets[:, [0, 1, 2]], tets[:, [0, 1, 3]], tets[:, [0, 2, 3]], tets[:, [1, 2, 3]]])
+        return numpy.unique(numpy.sort(faces, axis=1), axis=0, return_counts=True)
+
+    def boundary_faces(self, mask=None):
+        """ [K x 3] triangles bounding the tetrahedra in mask, e.g. the surface of an object """
+        unique, counts = self.faces(mask)
+        return unique[counts == 1]
+
+    def add_surface(self, name, points, tol=1e-9):
+        """
+        Names the mesh faces with all their nodes within tol [m] of points, e.g. the
+        export points of a sheet (FieldArchive.points(variation, sheet)); the sheet
+        must be conformal with the mesh, as HFSS meshes it, and convex.
+        """
+        from scipy.spatial import cKDTree
+        on_surface = cKDTree(numpy.asarray(points)).query(self.nodes)[0] <= tol
+        faces = self.faces()[0]
+        self.surfaces[name] = faces[numpy.all(on_surface[faces], axis=1)]
+        return self.surfaces[name]
+
+    def triangles(self, surface):
+        """ surface: a named surface, a [K x 3] array, or an object name (its boundary) """
+        if isinstance(surface, basestring) and surface in self.surfaces:
+            return self.surfaces[surface]
+        if isinstance(surface, basestring):
+            return self.boundary_faces(self.mask(objects=[surface]))
+        return numpy.asarray(surface, dtype=int)
+
+    # --- integrals; u is a nodal field [N] or [N x components], real or complex
+    def integrate_vol_sq(self, u, weight=None, mask=None):
+        """ int weight |u|^2 dV over the tetrahedra in mask; weight: scalar or [M] """
+        u = _as_vectors(u)[self.tets]                                   # [M x 4 x c]
+        sq = numpy.sum(numpy.abs(u)**2, axis=(1, 2)) + numpy.sum(numpy.abs(u.sum(axis=1))**2, axis=1)
+        return _masked_sum(self.volumes / 20 * sq * (1 if weight is None else weight), mask)
+
+    def integrate_vol(self, u, mask=None):
+        return _masked_sum(self.volumes[:, None] / 4 * _as_vectors(u)[self.tets].sum(axis=1), mask)
+
+    def integrate_surf_sq(self, u, surface):
+        tri = self.triangles(surface)
+        u = _as_vectors(u)[tri]
+        sq = numpy.sum(numpy.abs(u)**2, axis=(1, 2)) + numpy.sum(numpy.abs(u.sum(axis=1))**2, axis=1)
+        return numpy.sum(_areas(self.nodes, tri) / 12 * sq)
+
+    def integrate_surf_mag(self, u, surface):
+        """ int |u| dA, with |u| interpolated linearly between the nodes """
+        tri = self.triangles(surface)
+        mag = numpy.sqrt(numpy.sum(numpy.abs(_as_vectors(u))**2, axis=1))
+        return numpy.sum(_areas(self.nodes, tri) / 3 * mag[tri].sum(axis=1))
+
+    def area(self, surface):
+        return numpy.sum(_areas(self.nodes, self.triangles(surface)))
+
+    def integrate_line_tangent(self, u, line):
+        """ int u . dl along the polyline of node indices line """
+        line = numpy.asarray(line, dtype=int)
+        dl = self.nodes[line[1:]] - self.nodes[line[:-1]]
+        u = _as_vectors(u)
+        return numpy.sum((u[line[1:]] + u[line[:-1]]) / 2 * dl)
+
+    def integrate_line_sq(self, u, line):
+        line = numpy.asarray(line, dtype=int)
+        L = numpy.linalg.norm(self.nodes[line[1:]] - self.nodes[line[:-1]], axis=1)
+        u0, u1 = _as_vectors(u)[line[:-1]], _as_vectors(u)[line[1:]]
+        sq = numpy.sum(numpy.abs(u0)**2 + numpy.abs(u1)**2 + numpy.abs(u0 + u1)**2, axis=1)
+        return numpy.sum(L / 6 * sq)
+
+    # --- EPR quantities, in the conventions of Bbq.calc_U_E / calc_U_H / calc_avg_current_J_surf_mag
+    def U_E(self, E, eps_r=None, mask=None):
+        """ 0.5 Re int eps |E|^2 dV (2x the peak energy); eps_r: {material: relative permittivity} """
+        eps = epsilon_0 * (1 if eps_r is None else numpy.real(self.element_property(eps_r)))
+        return 0.5 * self.integrate_vol_sq(E, eps, mask)
+
+    def U_H(self, H, mu_r=None, mask=None):
+        mu = mu_0 * (1 if mu_r is None else numpy.real(self.element_property(mu_r)))
+        return 0.5 * self.integrate_vol_sq(H, mu, mask)
+
+    def avg_current(self, Jsurf, junc_rect, junc_len):
+        """ peak junction current, as Bbq.calc_avg_current_J_surf_mag: int |Jsurf| dA / junc_len """
+        return self.integrate_surf_mag(Jsurf, junc_rect) / junc_len
+
+
+# nodes per element of the EnSight Gold element types; second-order elements keep their corner nodes
+ENSIGHT_ELEMENTS = {"point": 1, "bar2": 2, "bar3": 3, "tria3": 3, "tria6": 6, "quad4": 4, "quad8": 8,
+                    "tetra4": 4, "tetra10": 10, "pyramid5": 5, "pyramid13": 13, "penta6": 6, "penta15": 15,
+                    "hexa8": 8, "hexa20": 20}
+ENSIGHT_LINEAR = {"bar3": "bar2", "tria6": "tria3", "quad8": "quad4", "tetra10": "tetra4", "pyramid13": "pyramid5",
+                  "penta15": "penta6", "hexa20": "hexa8"}
+
+def read_ensight(fn):
+    """
+    Reads the geometry of an EnSight Gold ASCII case (.case, or the .geo it names).
+    returns [{"name": part description, "coordinates": [n x 3],
+              "elements": {type: [k x nodes] 0-based indices into the part's coordinates}}]
+    """
+    if fn.lower().endswith(".case"):
+        with open(fn) as f:
+            model = [line for line in f if line.strip().lower().startswith("model:")]
+        if not model:
+            raise ValueError("No geometry (model:) in %s" % fn)
+        fn = os.path.join(os.path.dirname(fn), model[0].split()[-1])
+    with open(fn) as f:
+        lines = f.read().splitlines()
+    if "binary" in lines[0].lower():
+        raise ValueError("%s is a binary EnSight file; export the mesh as ASCII" % fn)
+    numbers = lambda start, n: numpy.fromstring(" ".join(lines[start:start + n]), sep=" ")
+    node_ids = lines[2].split()[-1].lower() in ("given", "ignore")
+    element_ids = lines[3].split()[-1].lower() in ("given", "ignore")
+    i = 4
+    if lines[i].strip().lower() == "extents":
+        i += 4
+    parts = []
+    while i < len(lines):
+        if not lines[i].strip():
+            i += 1
+            continue
+        keyword = lines[i].strip().lower()
+        if keyword == "part":
+            parts.append({"name": lines[i + 2].strip(), "coordinates": numpy.zeros((0, 3)), "elements": {}})
+            i += 3
+        elif keyword == "coordinates":
+            n = int(lines[i + 1])
+            i += 2 + (n if node_ids else 0)
+            parts[-1]["coordinates"] = numbers(i, 3*n).reshape(3, n).T
+            i += 3*n
+        elif keyword in ENSIGHT_ELEMENTS:
+            n = int(lines[i + 1])
+            i += 2 + (n if element_ids else 0)
+            k = ENSIGHT_ELEMENTS[keyword]
+            connectivity = numbers(i, n).astype(int).reshape(n, k) - 1
+            linear = ENSIGHT_LINEAR.get(keyword, keyword)
+            connectivity = connectivity[:, :ENSIGHT_ELEMENTS[linear]]
+            elements = parts[-1]["elements"]
+            elements[linear] = numpy.concatenate([elements[linear], connectivity]) if linear in elements else connectivity
+            i += n
+        else:
+            raise ValueError("Unsupported EnSight geometry entry %r in %s" % (lines[i], fn))
+    return parts
+
+def match_nodes(nodes, points, tol=1e-9):
+    """
+    Indices into points of each mesh node (to line up a field export with the mesh);
+    raises ValueError if a node has no export point within tol [m].
+    """
+    from scipy.spatial import cKDTree
+    dist, index = cKDTree(points).query(nodes)
+    if numpy.any(dist > tol):
+        raise ValueError("%d mesh nodes have no field point within %g m" % (numpy.sum(dist > tol), tol))
+    return index
+
+def nodal_field(mesh, archive, variation, mode, quantity="E", surface=None, tol=1e-9):
+    """
+    Field of a field_export.FieldArchive exported on the mesh nodes, reordered to
+    mesh.nodes. With surface, the export on that surface, zero off the surface.
+    """
+    points, values = archive.points(variation, surface), archive.field(variation, mode, quantity, surface)
+    nodes = numpy.arange(len(mesh.nodes)) if surface is None else numpy.unique(mesh.triangles(surface))
+    index = match_nodes(mesh.nodes[nodes], numpy.asarray(points), tol)
+    field = numpy.zeros((len(mesh.nodes),) + values.shape[1:], dtype=values.dtype)
+    field[nodes] = values[index]
+    return field
+
+def cross_check(mesh, archive, sol, variation, modes=None, eps_r=None, mu_r=None,
+                junc_rects=(), junc_lens=(), LJs=()):
+    """
+    Compares the mesh integrals with the calculator values of an eBBQ_solution
+    DataFrame (sol, one row per mode): U_E, U_H and pJ_<junc_rect> where present.
+    mesh: a TetMesh, or None for the mesh exported with the fields (FieldArchive.mesh)
+    returns DataFrame [mode x quantity] with columns calc, mesh and rel_diff
+    """
+    import pandas as pd
+    if mesh is None:
+        mesh = archive.mesh(variation)
+    rows = []
+    for mode in (archive.modes(variation) if modes is None else modes):
+        E, H = nodal_field(mesh, archive, variation, mode, "E"), nodal_field(mesh, archive, variation, mode, "H")
+        values = {"U_E": mesh.U_E(E, eps_r), "U_H": mesh.U_H(H, mu_r)}
+        if junc_rects:
+            for rect, length, LJ in zip(junc_rects, junc_lens, LJs):
+                J = nodal_field(mesh, archive, variation, mode, "Jsurf", rect)
+                values["pJ_" + rect] = LJ * mesh.avg_current(J, rect, length)**2 / (2 * values["U_E"])
+        for name, value in values.items():
+            if name in sol.columns:
+                calc = sol.loc[mode, name]
+                rows.append((mode, name, calc, value, (value - calc) / calc))
+    return pd.DataFrame(rows, columns=["mode", "quantity", "calc", "mesh", "rel_diff"]).set_index(["mode", "quantity"])
+
+
+def _as_vectors(u):
+    u = numpy.asarray(u)
+    return u[:, None] if u.ndim == 1 else u
+
+def _areas(nodes, tri):
+    p = nodes[tri]
+    return numpy.linalg.norm(numpy.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0]), axis=1) / 2
+
+def _masked_sum(values, mask):
+    return numpy.sum(values if mask is None else values[mask], axis=0)
@@ -0,0 +1,324 @@
+"""
+Bulk export of eigenmode fields to memory-mapped .npy files, and lazy
+Python-side integrals over them.
+
+FieldExporter dumps, for each variation and mode, the complex E and H (or any
+calculator expression) on a regular grid (ExportOnGrid) or on the mesh nodes
+of a volume, and e.g. Jsurf on the mesh nodes of chosen faces (ExportToFile).
+One calculator export per quantity, phase, mode and variation replaces the
+COM round trip per integral. The calculator exports real fields at a phase,
+so complex fields are built from phases 0 and 90 deg: F = F(0) - j F(90).
+These exports cannot be batched further: ExportOnGrid and ExportToFile write
+the one real quantity on top of the stack, at the one phase of their
+intrinsics, so E and H at two phases take 4 exports per mode.
+
+Everything goes into one directory: a manifest.json and one .npy per array.
+With mesh=True the tetrahedral mesh of each variation is saved too (an
+epr_mesh.TetMesh, from a mesh plot exported as an EnSight case), so mesh-node
+exports can be integrated exactly with epr_mesh.
+FieldArchive reads it back lazily (memory-mapped) and needs neither HFSS nor
+the design, so integrals, participations and plots can be redone offline:
+    FieldExporter(setup, "fields").export({"0": bbq.get_lv("0")}, modes=[0, 1],
+                                           grid=(["-2mm"]*3, ["2mm"]*3, ["0.05mm"]*3))
+    archive = FieldArchive("fields")
+    U_E = archive.energy("0", 0, "E")
+"""
+from __future__ import division
+import os, json
+import numpy
+from numpy.lib.format import open_memmap
+from scipy.constants import epsilon_0, mu_0
+
+MANIFEST = "manifest.json"
+CHUNK_SIZE = 1000000 # points per block in the archive integrals
+
+
+def read_fld(fn):
+    """
+    Reads a calculator export (.fld from ExportOnGrid / ExportToFile): header
+    lines are skipped, then one row per point, x y z [m] and the field values.
+    returns points [N x 3], values [N x n_components]
+    """
+    with open(fn) as f:
+        lines = f.read().splitlines()
+    for start, line in enumerate(lines):
+        tokens = line.split()
+        try:
+            if tokens:
+                [float(t) for t in tokens]
+                break
+        except ValueError:
+            continue
+    else:
+        return numpy.zeros((0, 3)), numpy.zeros((0, 0))
+    n_cols = len(lines[start].split())
+    data = numpy.fromstring(" ".join(lines[start:]), sep=" ").reshape(-1, n_cols)
+    return data[:, :3], data[:, 3:]
+
+
+class FieldExporter(object):
+    def __init__(self, setup, path, dtype=complex):
+        """
+        :type setup: hfss.HfssEMSetup
+        :param path: output directory, created if needed; an existing manifest is extended
+        """
+        self.setup = setup
+        self.solutions = setup.get_solutions()
+        self.calc_module = setup.parent._fields_calc
+        self.path = os.path.abspath(path)
+        self.dtype = dtype
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        manifest = os.path.join(self.path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"setup": setup.solution_name, "grid": None, "variations": {}, "fields": {}}
+
+    def export(self, variations, modes, quantities=("E", "H"), grid=None, volume="AllObjects",
+               surfaces=None, surface_quantities=("Jsurf",), phases=(0, 90), mesh=False):
+        """
+        :param variations: {variation: lv}, e.g. {v: bbq.get_lv(v) for v in bbq.variations}
+        :param modes: 0-based mode numbers
+        :param quantities: calculator quantity names ("E", "H", ...) or {name: CalcObject}
+        :param grid: (min, max, spacing), each 3 value strings with units, e.g. ["0.1mm"]*3.
+        If None, the fields are exported on the mesh nodes of volume.
+        :param surfaces: faces / sheets to export surface_quantities on (mesh nodes)
+        :param phases: (0, 90) for complex fields, (0,) for the real field at phase 0
+        :param mesh: also export the mesh of each variation (export_mesh), for epr_mesh
+        """
+        from hfss import CalcObject, to_base_units
+        if isinstance(quantities, (list, tuple)):
+            quantities = dict((q, CalcObject([], self.setup).getQty(q)) for q in quantities)
+        surface_quantities = dict((q, CalcObject([], self.setup).getQty(q)) for q in surface_quantities)
+        if grid is not None:
+            self.manifest["grid"] = {"min": list(grid[0]), "max": list(grid[1]), "spacing": list(grid[2]),
+                                     "dV": float(numpy.prod([to_base_units(s) for s in grid[2]]))}
+        for variation, lv in variations.items():
+            variation = str(variation)
+            info = self.manifest["variations"].setdefault(variation, {"surfaces": {}})
+            info["lv"] = list(lv)
+            for mode in modes:
+                self.solutions.set_mode(mode+1, 0)
+                for name, expr in quantities.items():
+                    points, values = self._export(expr, lv, phases, grid=grid, volume=volume)
+                    info["points"] = self._save_points(points, "v%s_points" % variation, info.get("points"))
+                    self._save_field(values, variation, mode, name)
+                for surface in surfaces or []:
+                    for name, expr in surface_quantities.items():
+                        points, values = self._export(expr, lv, phases, surface=surface)
+                        info["surfaces"][surface] = self._save_points(
+                            points, "v%s_%s_points" % (variation, surface), info["surfaces"].get(surface))
+                        self._save_field(values, variation, mode, name, surface)
+                self.write_manifest() # after each mode, so an interrupted export stays readable
+            if mesh:
+                self.export_mesh(variation, lv)
+        return FieldArchive(self.path)
+
+    def export_mesh(self, variation, lv, objects=None, length_scale=None, plot_name="pyhfss_mesh"):
+        """
+        Saves the tetrahedral mesh of a variation, with the material of each object, as
+        an epr_mesh.TetMesh (FieldArchive.mesh). HFSS plots the mesh of the objects
+        (default all solids) of the design's current variable values, so these are set
+        to lv for the export and restored after; the plot is exported as an EnSight case
+        (ExportFieldPlot, ASCII) and deleted.
+        :param length_scale: m per coordinate unit of the export; by default matched to the
+        node points of the field export of the variation
+        """
+        from epr_mesh import TetMesh
+        variation = str(variation)
+        design = self.setup.parent
+        objects = design.modeler.get_objects_in_group("Solids") if objects is None else list(objects)
+        fn = os.path.join(self.path, "mesh.case")
+        variables = dict((name[:-2], value) for name, value in zip(lv[::2], lv[1::2]))  # "LJ:=", "8nH"
+        owner = lambda name: design.parent if name.startswith("$") else design         # project variables
+        saved = dict((name, owner(name).get_variable_value(name)) for name in variables)
+        try:
+            for name, value in variables.items():
+                owner(name).set_variable(name, value)
+            self.calc_module.CreateFieldPlot(["NAME:" + plot_name, "SolutionName:=", self.setup.solution_name,
+                                              "QuantityName:=", "Mesh", "PlotFolder:=", "MeshPlots",
+                                              "FieldType:=", "Fields", "IntrinsicVar:=", "",
+                                              "PlotGeomInfo:=", [1, "Volume", "ObjList", len(objects)] + objects],
+                                             "Mesh")
+            try:
+                self.calc_module.ExportFieldPlot(plot_name, False, fn)
+            finally:
+                self.calc_module.DeleteFieldPlot([plot_name])
+        finally:
+            for name, value in saved.items():
+                owner(name).set_variable(name, value)
+        mesh = TetMesh.from_ensight(fn, dict((o, design.modeler.get_material(o)) for o in objects))
+        info = self.manifest["variations"].setdefault(variation, {"surfaces": {}})
+        if length_scale is None:
+            if "points" not in info:
+                raise ValueError("No field export of variation %s to match the mesh units to; give length_scale" % variation)
+            length_scale = match_length_scale(mesh.nodes, numpy.load(os.path.join(self.path, info["points"]), mmap_mode="r"))
+        mesh.nodes *= length_scale
+        info["mesh"] = "v%s_mesh.npz" % variation
+        mesh.save(os.path.join(self.path, info["mesh"]))
+        self.write_manifest()
+        return mesh
+
+    def write_manifest(self):
+        with open(os.path.join(self.path, MANIFEST), "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+
+    def _export(self, expr, lv, phases, grid=None, volume="AllObjects", surface=None):
+        """ one calculator export per phase; returns points, complex values """
+        fn = os.path.join(self.path, "export.fld")
+        setup_name = self.setup.solution_name
+        values = 0
+        for phase in phases:
+            args = expr._eval_args(phase, lv)
+            expr.write_stack()
+            if grid is not None and surface is None:
+                self.calc_module.ExportOnGrid(fn, list(grid[0]), list(grid[1]), list(grid[2]), setup_name, args)
+            else:
+                if surface is not None:
+                    self.calc_module.EnterSurf(surface)
+                else:
+                    self.calc_module.EnterVol(volume)
+                self.calc_module.CalcOp("Value")
+                self.calc_module.ExportToFile(fn, setup_name, args)
+            self.calc_module.CalcStack("clear")
+            points, real = read_fld(fn)
+            os.remove(fn)
+            values = values + real*numpy.exp(-1j*numpy.deg2rad(phase)) if len(phases) > 1 else real
+        return points, values
+
+    def _save_points(self, points, name, existing):
+        """ the points of a variation are saved once (they don't change between modes) """
+        if existing is None:
+            numpy.save(os.path.join(self.path, name + ".npy"), points)
+        return name + ".npy"
+
+    def _save_field(self, values, variation, mode, quantity, surface=None):
+        fn = "v%s_m%d_%s%s.npy" % (variation, mode, quantity, "" if surface is None else "_" + surface)
+        dtype = self.dtype if numpy.iscomplexobj(values) else float
+        array = open_memmap(os.path.join(self.path, fn), mode="w+", dtype=dtype, shape=values.shape)
+        array[:] = values
+        array.flush()
+        del array
+        self.manifest["fields"][field_key(variation, mode, quantity, surface)] = {"file": fn, "shape": list(values.shape)}
+
+def match_length_scale(coordinates, points, scales=(1., 1e-2, 1e-3, 1e-6, 1e-9, 2.54e-2, 2.54e-5)):
+    """ the unit scale [m] (of m, cm, mm, um, nm, in, mil) that best maps the extent of coordinates to that of points [m] """
+    extent = lambda x: numpy.ptp(numpy.asarray(x), axis=0).max()
+    ratio = extent(points) / extent(coordinates)
+    return min(scales, key=lambda scale: abs(numpy.log(ratio / scale)))
+
+def field_key(variation, mode, quantity, surface=None):
+    return "%s/%d/%s%s" % (variation, mode, quantity, "" if surface is None else "@" + surface)
+
+def export_bbq_fields(bbq, path, variations=None, modes=None, **kwargs):
+    """ FieldExporter.export for the variations (default all) and modes (default all) of a bbq.Bbq """
+    variations = bbq.variations if variations is None else variations
+    modes = range(bbq.nmodes) if modes is None else modes
+    return FieldExporter(bbq.setup, path).export(dict((v, bbq.get_lv(v)) for v in variations), modes, **kwargs)
+
+
+class FieldArchive(object):
+    """ read side of FieldExporter: arrays are memory-mapped and only loaded when used """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.grid = self.manifest["grid"]
+
+    @property
+    def variations(self):
+        return sorted(self.manifest["variations"])
+
+    def modes(self, variation):
+        return sorted(set(int(k.split("/")[1]) for k in self.manifest["fields"] if k.split("/")[0] == str(variation)))
+
+    def quantities(self, variation, mode):
+        prefix = "%s/%d/" % (variation, mode)
+        return sorted(k[len(prefix):] for k in self.manifest["fields"] if k.startswith(prefix))
+
+    def points(self, variation, surface=None):
+        info = self.manifest["variations"][str(variation)]
+        fn = info["points"] if surface is None else info["surfaces"][surface]
+        return numpy.load(os.path.join(self.path, fn), mmap_mode="r")
+
+    def mesh(self, variation):
+        """ the epr_mesh.TetMesh saved with the fields (export(mesh=True)), with the exported surfaces named """
+        from epr_mesh import TetMesh
+        info = self.manifest["variations"][str(variation)]
+        if "mesh" not in info:
+            raise ValueError("No mesh exported for variation %s" % variation)
+        mesh = TetMesh.load(os.path.join(self.path, info["mesh"]))
+        for surface in info["surfaces"]:
+            if surface not in mesh.surfaces:
+                mesh.add_surface(surface, self.points(variation, surface))
+        return mesh
+
+    def field(self, variation, mode, quantity, surface=None):
+        """ memory-mapped [N points x components] """
+        fn = self.manifest["fields"][field_key(variation, mode, quantity, surface)]["file"]
+        return numpy.load(os.path.join(self.path, fn), mmap_mode="r")
+
+    def integrate(self, variation, mode, integrand, quantity="E", mask=None):
+        """
+        Volume integral over the grid of integrand(points, values) -> [N],
+        evaluated block by block. mask: boolean [N] or function of the points.
+        """
+        if self.grid is None:
+            raise ValueError("Fields were exported on mesh nodes; integrate them with epr_mesh")
+        points, values = self.points(variation), self.field(variation, mode, quantity)
+        total = 0.
+        for start in range(0, len(points), CHUNK_SIZE):
+            block = slice(start, start + CHUNK_SIZE)
+            f = integrand(points[block], values[block])
+            if mask is not None:
+                f = f * (mask(points[block]) if callable(mask) else mask[block])
+            total += numpy.sum(f)
+        return total * self.grid["dV"]
+
+    def energy(self, variation, mode, quantity="E", eps=None, mask=None):
+        """
+        0.5 Re int eps |F|^2 dV, as Bbq.calc_U_E / calc_U_H (2 x the peak energy).
+        eps: scalar or function of the points, default epsilon_0 for E, mu_0 for H.
+        """
+        if eps is None:
+            eps = mu_0 if quantity == "H" else epsilon_0
+        def integrand(points, values):
+            weight = eps(points) if callable(eps) else eps
+            return 0.5 * numpy.real(weight * numpy.sum(numpy.abs(values)**2, axis=1))
+        return self.integrate(variation, mode, integrand, quantity, mask)
+
+    def participation(self, variation, mode, mask, quantity="E", eps=None):
+        """ fraction of the energy in mask """
+        return self.energy(variation, mode, quantity, eps, mask) / self.energy(variation, mode, quantity, eps)
+
+    def surface_mean(self, variation, mode, surface, quantity="Jsurf"):
+        """ mean |F| over the exported nodes of surface """
+        return numpy.mean(numpy.sqrt(numpy.sum(numpy.abs(self.field(variation, mode, quantity, surface))**2, axis=1)))
+
+    def slice(self, variation, mode, quantity="E", axis=2, value=0.):
+        """
+        |F| on the grid plane nearest to value [m] along axis.
+        returns the two in-plane coordinate axes and the [n1 x n2] magnitudes
+        """
+        points = numpy.asarray(self.points(variation))
+        coords = numpy.unique(points[:, axis])
+        on_plane = points[:, axis] == coords[numpy.argmin(numpy.abs(coords - value))]
+        plane = points[on_plane][:, [i for i in range(3) if i != axis]]
+        mag = numpy.sqrt(numpy.sum(numpy.abs(self.field(variation, mode, quantity)[on_plane])**2, axis=1))
+        u, iu = numpy.unique(plane[:, 0], return_inverse=True)
+        v, iv = numpy.unique(plane[:, 1], return_inverse=True)
+        image = numpy.full((len(u), len(v)), numpy.nan)
+        image[iu, iv] = mag
+        return u, v, image
+
+    def plot_slice(self, variation, mode, quantity="E", axis=2, value=0., ax=None):
+        import matplotlib.pyplot as plt
+        u, v, image = self.slice(variation, mode, quantity, axis, value)
+        ax = plt.gca() if ax is None else ax
+        mesh = ax.pcolormesh(u*1e3, v*1e3, image.T)
+        ax.set_aspect("equal")
+        ax.set_title("|%s|, variation %s, mode %d" % (quantity, variation, mode))
+        plt.colorbar(mesh, ax=ax)
+        return ax
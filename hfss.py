@@ -2,19 +2,227 @@ from __future__ import division
 import atexit
 from copy import copy
 import os
-
+import re
 import tempfile
 import types
 import numpy
 import signal
 import pythoncom
+import threading
 import time
-from sympy.parsing import sympy_parser
-from pint import UnitRegistry # units 
+from importlib import import_module
 from win32com.client import Dispatch, CDispatch
+from sweep_plan import plan_sweep_segments, sweep_segment_points
+
+class LazyModule(object):
+    """Stands in for a module that is only imported on first attribute access.
+    on_import(module) is called once, right after the import."""
+    def __init__(self, name, on_import=None):
+        self._name = name
+        self._on_import = on_import
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = import_module(self._name)
+            if self._on_import is not None:
+                self._on_import(self._module)
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+_ureg = None
+def get_unit_registry():
+    """The pint UnitRegistry shared by all modules, created on first use
+    (parsing its definitions takes a good part of a second)."""
+    global _ureg
+    if _ureg is None:
+        from pint import UnitRegistry # units 
+        _ureg = UnitRegistry(system='mks')
+    return _ureg
+
+class _LazyUnitRegistry(object):
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(get_unit_registry(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return get_unit_registry()(*args, **kwargs)
+
+ureg = _LazyUnitRegistry()
+pd = LazyModule('pandas')
+
+class ExportChannel(object):
+    """
+    Scratch files for HFSS text exports. Each channel reuses one uniquely named
+    file (mkstemp) per suffix in its scratch directory: scratch_dir, else the
+    PYHFSS_SCRATCH environment variable (e.g. a RAM disk), else the system temp
+    directory. The file is deleted before every export, and an export that
+    leaves it missing or empty raises IOError; close() (also at exit) removes it.
+    """
+    def __init__(self, scratch_dir=None):
+        self.scratch_dir = scratch_dir
+        self.files = {}
+        atexit.register(self.close)
+
+    def path(self, suffix=""):
+        fn = self.files.get(suffix)
+        if fn is None:
+            scratch_dir = self.scratch_dir or os.environ.get("PYHFSS_SCRATCH") or None
+            fd, fn = tempfile.mkstemp(suffix=suffix, prefix="pyhfss_", dir=scratch_dir)
+            os.close(fd)
+            self.files[suffix] = fn
+        return fn
+
+    def export(self, export_fn, parser, suffix=""):
+        """ export_fn(path) has HFSS write the file, parser(path) reads it; returns the parsed data """
+        fn = self.path(suffix)
+        if os.path.exists(fn):
+            os.remove(fn)
+        try:
+            export_fn(fn)
+            if not os.path.exists(fn) or os.path.getsize(fn) == 0:
+                raise IOError("HFSS export wrote no data to %s" % fn)
+            return parser(fn)
+        finally:
+            open(fn, "w").close() # keeps the name reserved
+
+    def close(self):
+        for fn in self.files.values():
+            if os.path.exists(fn):
+                os.remove(fn)
+        self.files = {}
 
-ureg = UnitRegistry()
-Q    = ureg.Quantity
+exports = ExportChannel()
+
+def set_scratch_dir(path):
+    """ directory for the scratch files of HFSS exports, e.g. on a RAM disk """
+    exports.close()
+    exports.scratch_dir = path
+
+def read_numeric_table(fn, delimiter=None):
+    """
+    Fast reader for the numeric text exports: skips header and comment lines up
+    to the first all-numeric row. returns float array [rows x columns]
+    """
+    with open(fn) as f:
+        text = f.read()
+    lines = text.splitlines()
+    for start, line in enumerate(lines):
+        tokens = line.split(delimiter)
+        if not tokens or not line.strip():
+            continue
+        try:
+            [float(t) for t in tokens]
+        except ValueError:
+            continue
+        body = "\n".join(lines[start:])
+        if delimiter is not None:
+            body = body.replace(delimiter, " ")
+        return numpy.fromstring(body, sep=" ").reshape(-1, len(tokens))
+    return numpy.zeros((0, 0))
+
+def read_eigenmodes(fn):
+    """
+    Reads an ExportEigenmodes file. returns freqs [GHz], kappa_over_2pis [GHz]
+    (None if the Qs were not saved)
+    """
+    with open(fn) as f:
+        rows = [line.split() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    freqs = [float(row[1]) for row in rows]
+    if rows and len(rows[0]) == 6: # checking if values for Q were saved
+        kappa_over_2pis = [2*float(row[3]) for row in rows] # eigvalue=(omega-i*kappa/2)/2pi
+                                                            # so kappa/2pi = 2*Im(eigvalue)
+    else:
+        kappa_over_2pis = None
+    return freqs, kappa_over_2pis
+
+_TIME_RE = re.compile(r"^(\d+):(\d\d):(\d\d)$")
+_MEMORY_RE = re.compile(r"^([\d.]+)\s*([KMG])B?$", re.I)
+_MEMORY_SCALE = {"K": 1./1024, "M": 1., "G": 1024.}
+_PASS_RE = re.compile(r"Adaptive Pass (\d+)", re.I)
+_TETS_RE = re.compile(r"(\d+) tetrahedra", re.I)
+
+def _profile_fields(line):
+    return [f.strip() for f in (line.split("\t") if "\t" in line else re.split(r"\s{2,}", line))]
+
+def _seconds(text):
+    match = _TIME_RE.match(text)
+    return numpy.nan if match is None else 3600*int(match.group(1)) + 60*int(match.group(2)) + int(match.group(3))
+
+def _megabytes(text):
+    match = _MEMORY_RE.match(text)
+    return numpy.nan if match is None else float(match.group(1))*_MEMORY_SCALE[match.group(2).upper()]
+
+def read_profile(fn):
+    """
+    Reads an ExportProfile file. returns a DataFrame, one row per timed task:
+    pass (0 before the adaptive passes), group, task, real_time, cpu_time [s],
+    memory [MB], tets (where the task reports them) and info
+    """
+    rows, group, n_pass = [], "", 0
+    with open(fn) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            fields = _profile_fields(line)
+            times = [i for i, field in enumerate(fields) if _TIME_RE.match(field)]
+            if not times:
+                match = _PASS_RE.search(line)
+                if match is not None:
+                    n_pass = int(match.group(1))
+                group = line.strip()
+                continue
+            first = times[0]
+            rest = fields[first:] + [""]*3
+            info = " ".join(rest[3:]).strip()
+            tets = _TETS_RE.search(info)
+            rows.append((n_pass, group, " ".join(fields[:first]), _seconds(rest[0]), _seconds(rest[1]),
+                         _megabytes(rest[2]), numpy.nan if tets is None else int(tets.group(1)), info))
+    return pd.DataFrame(rows, columns=["pass", "group", "task", "real_time", "cpu_time", "memory", "tets", "info"])
+
+def profile_summary(profile):
+    """ passes, total real/cpu time [s], time per pass, peak memory [MB] and final tets of a read_profile table """
+    profile = profile[~profile["task"].str.lower().str.startswith("total")]
+    passes = profile["pass"].max()
+    return pd.Series({"passes": passes,
+                      "real_time": profile["real_time"].sum(),
+                      "cpu_time": profile["cpu_time"].sum(),
+                      "time_per_pass": profile.loc[profile["pass"] > 0, "real_time"].sum()/max(passes, 1),
+                      "peak_memory": profile["memory"].max(),
+                      "tets": profile["tets"].dropna().iloc[-1] if profile["tets"].notnull().any() else numpy.nan})
+
+def read_mesh_stats(fn):
+    """
+    Reads an ExportMeshStats file. returns a DataFrame indexed by object, with
+    the numeric columns of the table (num_tets, min_edge_length, ...)
+    """
+    with open(fn) as f:
+        lines = [line.rstrip("\r\n") for line in f]
+    for start, line in enumerate(lines):
+        if line.strip().startswith("Name"):
+            break
+    else:
+        raise ValueError("No mesh statistics table in %s" % fn)
+    columns = [re.sub(r"[^\w]+", "_", c.strip().lower()).strip("_") for c in _profile_fields(line.strip())]
+    rows = []
+    for line in lines[start+1:]:
+        fields = _profile_fields(line.strip())
+        if len(fields) < 2:
+            continue
+        try:
+            values = [float(v) for v in fields[1:len(columns)]]
+        except ValueError:
+            continue
+        rows.append([fields[0]] + values + [numpy.nan]*(len(columns) - len(fields))) # ragged rows: padded
+    return pd.DataFrame(rows, columns=columns).set_index(columns[0])
+
+def Q(*args, **kwargs):
+    return get_unit_registry().Quantity(*args, **kwargs)
 
 BASIS_ORDER = {"Zero Order": 0,
                "First Order": 1,
@@ -22,6 +230,7 @@ BASIS_ORDER = {"Zero Order": 0,
                "Mixed Order": -1}
 
 def simplify_arith_expr(expr):
+    from sympy.parsing import sympy_parser
     try:
         out = repr(sympy_parser.parse_expr(str(expr)))
         return out
@@ -38,14 +247,78 @@ def increment_name(base, existing):
         n += 1
     return make_name()
     
+# Fast path for the value/unit strings of design variables, e.g. '8.5nH' or '0.1mm':
+# a precompiled table of unit scale factors (to SI) and dimensions, and a memo cache.
+# Anything else falls back to pint.
+_UNIT_PREFIXES = {'f': 1e-15, 'p': 1e-12, 'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'c': 1e-2,
+                  'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}
+_UNIT_BASES = {'m': 'length', 'meter': 'length', 'H': 'inductance', 'F': 'capacitance',
+               'Hz': 'frequency', 's': 'time', 'ohm': 'resistance', 'Ohm': 'resistance',
+               'S': 'conductance', 'A': 'current', 'V': 'voltage', 'W': 'power', 'K': 'temperature'}
+_UNIT_TABLE = {'': (1., ''), 'mil': (25.4e-6, 'length'), 'in': (25.4e-3, 'length'),
+               'rad': (1., 'angle'), 'deg': (numpy.pi/180, 'angle')}
+for _base, _dim in _UNIT_BASES.items():
+    _UNIT_TABLE[_base] = (1., _dim)
+    if _base != 'meter':
+        for _prefix, _scale in _UNIT_PREFIXES.items():
+            _UNIT_TABLE.setdefault(_prefix + _base, (_scale, _dim))
+_VALUE_UNIT_RE = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*([A-Za-z]*)\s*$')
+_value_unit_cache = {}
+
+def parse_value_unit(expr):
+    """
+    '8.5nH' -> (8.5, 'nH'). Only simple number+unit strings with a unit in
+    the table are accepted; returns None for anything else.
+    """
+    try:
+        return _value_unit_cache[expr]
+    except KeyError:
+        pass
+    match = _VALUE_UNIT_RE.match(str(expr))
+    parsed = None
+    if match is not None and match.group(2) in _UNIT_TABLE:
+        parsed = (float(match.group(1)), match.group(2))
+    _value_unit_cache[expr] = parsed
+    return parsed
+
+def to_base_units(expr):
+    """
+    :type expr: str
+    :return: float, the value of expr in SI base units; e.g. '8.5nH' -> 8.5e-9
+    """
+    parsed = parse_value_unit(expr)
+    if parsed is None:
+        return Q(expr).to_base_units().magnitude
+    value, unit = parsed
+    return value*_UNIT_TABLE[unit][0]
+
 def extract_value_unit(expr, units):
     """
     :type expr: str
     :type units: str
     :return: float
     """
+    parsed = parse_value_unit(expr)
+    if parsed is not None and units in _UNIT_TABLE:
+        value, unit = parsed
+        (scale, dim), (to_scale, to_dim) = _UNIT_TABLE[unit], _UNIT_TABLE[units]
+        if dim == to_dim:
+            return value*scale/to_scale
     return Q(expr).to(units).magnitude
 
+def convert_column(exprs, units=None):
+    """
+    Vectorized conversion of a column of value/unit strings (list, array or Series)
+    to a float array in units, or in SI base units if units is None.
+    Each distinct string is only parsed once.
+    """
+    uniques, inverse = numpy.unique(numpy.asarray(exprs, dtype=str), return_inverse=True)
+    if units is None:
+        values = numpy.array([to_base_units(expr) for expr in uniques])
+    else:
+        values = numpy.array([extract_value_unit(expr, units) for expr in uniques])
+    return values[inverse]
+
 class VariableString(str):
     def __add__(self, other):
         return var("(%s) + (%s)" % (self, other))
@@ -222,6 +495,67 @@ class HfssDesktop(COMWrapper):
     def temp_directory(self, path):
         self._desktop.SetTempDirectory(path)
 
+    def get_registry(self, key):
+        """ value of a desktop registry key, int if it is one """
+        try:
+            return self._desktop.GetRegistryInt(key)
+        except Exception:
+            return self._desktop.GetRegistryString(key)
+
+    def set_registry(self, key, value):
+        if isinstance(value, (bool, int, long)):
+            self._desktop.SetRegistryInt(key, int(value))
+        else:
+            self._desktop.SetRegistryString(key, str(value))
+
+    def get_analysis_config(self, settings=None):
+        """ {setting: value} of the analysis settings (default all of ANALYSIS_REGISTRY_KEYS) that can be read """
+        config = {}
+        for setting in ANALYSIS_REGISTRY_KEYS if settings is None else settings:
+            try:
+                config[setting] = self.get_registry(ANALYSIS_REGISTRY_KEYS.get(setting, setting))
+            except Exception:
+                pass # not in this version
+        return config
+
+    def set_analysis_config(self, **settings):
+        """
+        Sets analysis settings, e.g. set_analysis_config(cores=8, tasks=2, memory_limit_mb=64000);
+        names are those of ANALYSIS_REGISTRY_KEYS, or registry keys themselves.
+        returns the previous values, to restore them with set_analysis_config(**previous)
+        (settings that were not in the registry before stay set)
+        """
+        previous = self.get_analysis_config(settings.keys())
+        for setting, value in settings.items():
+            if value is not None:
+                self.set_registry(ANALYSIS_REGISTRY_KEYS.get(setting, setting), value)
+        return previous
+
+
+# Analysis settings by name -> desktop registry key (HFSS 2015/2016 preferences; other versions may
+# name them differently, set_analysis_config also takes registry keys directly)
+ANALYSIS_REGISTRY_KEYS = {
+    "cores": "HFSS/Preferences/NumberOfProcessors",
+    "distributed_cores": "HFSS/Preferences/NumberOfProcessorsDistributed",
+    "tasks": "HFSS/Preferences/NumberOfDistributedTasks",
+    "use_hpc": "HFSS/Preferences/UseHPCForMP",
+    "hpc_license": "HFSS/Preferences/HPCLicenseType",
+    "memory_limit_mb": "HFSS/Preferences/MemLimitHard",
+    "memory_soft_limit_mb": "HFSS/Preferences/MemLimitSoft",
+    "dso_config": "Desktop/ActiveDSOConfigurations/HFSS",
+}
+
+analysis_log = [] # one dict per HfssSetup.analyze: setup, design, start, wall_time and config
+
+def get_analysis_log():
+    """ analysis_log as a DataFrame, with the config settings as columns """
+    rows = []
+    for entry in analysis_log:
+        row = dict((k, v) for k, v in entry.items() if k != "config")
+        row.update(entry["config"])
+        rows.append(row)
+    return pd.DataFrame(rows)
+
 
 class HfssProject(COMWrapper):
     def __init__(self, desktop, project):
@@ -337,6 +671,8 @@ class HfssDesign(COMWrapper):
         self._modeler = design.SetActiveEditor("3D Modeler")
         self._optimetrics = design.GetModule("Optimetrics")
         self.modeler = HfssModeler(self, self._modeler, self._boundaries)
+        self.named_expressions = set() # known to exist in the fields calculator, see CalcLibrary
+        self.reports = HfssReportManager(self)
 
     def rename_design(self, name):
         old_name = self._design.GetName()
@@ -421,6 +757,50 @@ class HfssDesign(COMWrapper):
     def get_nominal_variation(self):
         return self._design.GetNominalVariation()
 
+    def get_parametric_setup_names(self):
+        try:
+            return list(self._optimetrics.GetSetupNamesByType("OptiParametric"))
+        except Exception:
+            return list(self._optimetrics.GetSetupNames()) # older versions: all Optimetrics setups
+
+    def create_parametric_setup(self, sweeps, setup=None, name="ParametricSetup", synchronize=False,
+                                save_fields=True, copy_mesh=False):
+        """
+        Optimetrics parametric sweep, so that HFSS schedules (and can distribute) the solves.
+        :param sweeps: [(variable, values)], design or $project variables; values is a list of value
+        strings, e.g. ["8nH", "9nH"], or ("LIN", start, stop, step) or ("LINC", start, stop, count)
+        :param setup: name of the analysis setup to solve, default the first
+        :param synchronize: False for the Cartesian product of the sweeps, True to step them together
+        (all the same length), e.g. for an explicit table of settings
+        :rtype: HfssParametricSetup
+        """
+        setup = self.get_setup_names()[0] if setup is None else setup
+        name = increment_name(name, self.get_parametric_setup_names())
+        definitions = ["NAME:Sweeps"]
+        for variable, values in sweeps:
+            definitions.append(["NAME:SweepDefinition", "Variable:=", variable, "Data:=", _sweep_data(values),
+                                "OffsetF1:=", False, "Synchronize:=", 1 if synchronize else 0])
+        self._optimetrics.InsertSetup("OptiParametric", [
+            "NAME:"+name,
+            "IsEnabled:=", True,
+            ["NAME:ProdOptiSetupDataV2",
+             "SaveFields:=", save_fields,
+             "CopyMesh:=", copy_mesh,
+             "SolveWithCopiedMeshOnly:=", True],
+            ["NAME:StartingPoint"],
+            "Sim. Setups:=", [setup],
+            definitions,
+            ["NAME:Sweep Operations"],
+            ["NAME:Goals"]
+        ])
+        return HfssParametricSetup(self, name, sweeps, setup, synchronize)
+
+    def create_parametric_table(self, rows, setup=None, name="ParametricSetup", **kwargs):
+        """ parametric setup of an explicit table of settings, rows: [{variable: value string}] """
+        variables = sorted(rows[0])
+        return self.create_parametric_setup([(v, [row[v] for row in rows]) for v in variables], setup, name,
+                                            synchronize=True, **kwargs)
+
     def create_variable(self, name, value, postprocessing=False):
         if postprocessing==True:
             variableprop = "PostProcessingVariableProp"
@@ -473,10 +853,11 @@ class HfssDesign(COMWrapper):
         :type units: str
         :return: float
         """
+        from sympy.parsing import sympy_parser
         try:
             sexp = sympy_parser.parse_expr(expr)
         except SyntaxError:
-            return Q(expr).to(units).magnitude
+            return extract_value_unit(expr, units)
 
         sub_exprs = {fs: self.get_variable_value(fs.name) for fs in sexp.free_symbols}
         return float(sexp.subs({fs: self._evaluate_variable_expression(e, units) for fs, e in sub_exprs.items()}))
@@ -509,10 +890,48 @@ class HfssSetup(HfssPropertyObject):
         self.prop_server = "AnalysisSetup:" + setup
         self.expression_cache_items = []
 
-    def analyze(self, name=None):
+    def analyze(self, name=None, config=None):
+        """
+        :param config: {setting: value} analysis settings for this analyze only, see
+        HfssDesktop.set_analysis_config. The wall time is logged in analysis_log.
+        """
         if name is None:
             name = self.name
-        self.parent._design.Analyze(name)
+        desktop = self.parent.parent.parent if config else None
+        previous = desktop.set_analysis_config(**config) if config else None
+        try:
+            start = time.time()
+            self.parent._design.Analyze(name)
+            wall_time = time.time() - start
+        finally:
+            if previous is not None:
+                desktop.set_analysis_config(**previous)
+        analysis_log.append({"setup": name, "start": start, "wall_time": wall_time,
+                             "config": dict(config or {}), "design": self.parent.name})
+        return wall_time
+
+    def benchmark(self, configs, clean=False, variation=""):
+        """
+        Scaling curve: the setup is analyzed once per config ({setting: value}, see
+        HfssDesktop.set_analysis_config). returns DataFrame, one row per config: the settings,
+        wall_time [s] and the profile_summary of the solve.
+        Without clean, configs after the first may reuse the existing solution; benchmark
+        on a copy of the design for timings from scratch.
+        WARNING: clean=True deletes the solutions of EVERY setup and variation in the
+        design (DeleteFullVariation("All")) before each config, not just this setup's.
+        """
+        rows = []
+        for config in configs:
+            if clean:
+                self.parent._design.DeleteFullVariation("All", False)
+            row = dict(config)
+            row["wall_time"] = self.analyze(config=config)
+            try:
+                row.update(profile_summary(self.get_profile(variation)))
+            except Exception:
+                pass # no profile
+            rows.append(row)
+        return pd.DataFrame(rows)
         
     def insert_sweep(self, start_ghz, stop_ghz, count=None, step_ghz=None,
                      name="Sweep", type="Fast", save_fields=False):
@@ -522,8 +941,8 @@ class HfssSetup(HfssPropertyObject):
         params = [
             "NAME:"+name,
             "IsEnabled:=", True,
-            "StartValue:=", "%fGHz" % start_ghz,
-            "StopValue:=", "%fGHz" % stop_ghz,
+            "StartValue:=", "%.9gGHz" % start_ghz,
+            "StopValue:=", "%.9gGHz" % stop_ghz,
             "Type:=", type,
             "SaveFields:=", save_fields,
             "ExtrapToDC:=", False,
@@ -531,7 +950,7 @@ class HfssSetup(HfssPropertyObject):
         if step_ghz is not None:
             params.extend([
                 "SetupType:=", "LinearSetup",
-                "StepSize:=", "%fGHz" % step_ghz,
+                "StepSize:=", "%.9gGHz" % step_ghz,
             ])
         else:
             params.extend([
@@ -541,6 +960,30 @@ class HfssSetup(HfssPropertyObject):
 
         self._setup_module.InsertFrequencySweep(self.name, params)
         return HfssFrequencySweep(self, name)
+
+    def insert_planned_sweep(self, segments, name="Sweep", type="Discrete",
+                             single_points=False, save_fields=False):
+        """
+        Inserts the segments of plan_sweep_segments, either as one LinearCount
+        sweep per segment or, with single_points, as a single sweep of the
+        merged point list. Merge the results with merged_network_matrices.
+        returns [HfssFrequencySweep]
+        """
+        if not single_points:
+            return [self.insert_sweep(start, stop, count=count, name=name, type=type,
+                                      save_fields=save_fields)
+                    for start, stop, count in segments]
+        name = increment_name(name, self.get_sweep_names())
+        self._setup_module.InsertFrequencySweep(self.name, [
+            "NAME:"+name,
+            "IsEnabled:=", True,
+            "SetupType:=", "SinglePoints",
+            "ValueList:=", ["%.9fGHz" % f for f in sweep_segment_points(segments)],
+            "Type:=", type,
+            "SaveFields:=", save_fields,
+            "ExtrapToDC:=", False,
+        ])
+        return [HfssFrequencySweep(self, name)]
     
     def delete_sweep(self, name):
         self._setup_module.DeleteSweep(self.name, name)
@@ -605,20 +1048,18 @@ class HfssSetup(HfssPropertyObject):
         self._setup_module.EditSetup(self.name, args)
 		
     def get_convergence(self, variation=""):
-        fn = tempfile.mktemp()
-        self.parent._design.ExportConvergence(self.name, variation, fn, False)
-        return numpy.loadtxt(fn)
+        return exports.export(lambda fn: self.parent._design.ExportConvergence(self.name, variation, fn, False),
+                              read_numeric_table)
 
     def get_mesh_stats(self, variation=""):
-        #TODO: seems to be borken in 2016. todo fix
-        fn = tempfile.mktemp()
-        self.parent._design.ExportMeshStats(self.name, variation, fn, False)
-        return numpy.loadtxt(fn)
+        """ DataFrame of the mesh statistics per object, see read_mesh_stats """
+        return exports.export(lambda fn: self.parent._design.ExportMeshStats(self.name, variation, fn, False),
+                              read_mesh_stats)
 
     def get_profile(self, variation=""):
-        fn = tempfile.mktemp()
-        self.parent._design.ExportProfile(self.name, variation, fn, False)
-        return numpy.loadtxt(fn)
+        """ DataFrame of the solver profile per task, see read_profile and profile_summary """
+        return exports.export(lambda fn: self.parent._design.ExportProfile(self.name, variation, fn, False),
+                              read_profile)
 
     def get_fields(self):
         return HfssFieldsCalc(self)
@@ -680,21 +1121,9 @@ class HfssDesignSolutions(COMWrapper):
 
 class HfssEMDesignSolutions(HfssDesignSolutions):
     def eigenmodes(self, lv=""):
-        fn = tempfile.mktemp()
-        self._solutions.ExportEigenmodes(self.parent.solution_name, lv, fn)
-        data = numpy.loadtxt(fn, dtype='str')
-        if numpy.size(numpy.shape(data)) == 1: # getting around the very annoying fact that 
-            data = numpy.array([data])         # in Python a 1D array does not have shape (N,1)
-        else:                                  # but rather (N,) ....
-            pass
-        if numpy.size(data[0,:])==6: # checking if values for Q were saved
-            kappa_over_2pis = [2*float(ii) for ii in data[:,3]] # eigvalue=(omega-i*kappa/2)/2pi
-                                                    # so kappa/2pi = 2*Im(eigvalue)
-        else:
-            kappa_over_2pis = None
-            
-        freqs = [float(ii) for ii in data[:,1]]
-        return freqs, kappa_over_2pis
+        """ returns freqs [GHz], kappa_over_2pis (None if no Qs), see read_eigenmodes """
+        return exports.export(lambda fn: self._solutions.ExportEigenmodes(self.parent.solution_name, lv, fn),
+                              read_eigenmodes)
 
     def set_mode(self, n, phase):
         n_modes = int(self.parent.n_modes)
@@ -710,6 +1139,46 @@ class HfssEMDesignSolutions(HfssDesignSolutions):
 class HfssDMDesignSolutions(HfssDesignSolutions):
     pass
 
+def merged_network_matrices(sweeps, data_types="SYZ", z0=None):
+    """
+    get_network_matrices of several sweeps (e.g. from insert_planned_sweep),
+    merged into one array sorted by frequency, shared segment edges only once.
+    returns freq, {data_type: complex array [freq x port x port]}
+    """
+    results = [sweep.get_network_matrices(data_types, z0=z0) for sweep in sweeps]
+    freq = numpy.concatenate([freq for freq, matrices in results])
+    freq, index = numpy.unique(freq, return_index=True)
+    return freq, dict((t, numpy.concatenate([matrices[t] for f, matrices in results])[index])
+                      for t in data_types)
+
+def read_network_data(fn, data_type="S"):
+    """
+    Reads a tab-delimited ExportNetworkData file.
+    returns freq, complex array [freq x port x port]
+    """
+    with open(fn) as f:
+        f.readline()
+        colnames = f.readline().split()
+        array = numpy.fromstring(f.read(), sep=" ")
+    array = array.reshape(-1, len(colnames))
+    n_ports = int(round(numpy.sqrt((len(colnames) - 1)/2)))
+    ports = range(1, n_ports + 1)
+    real_idx = [[colnames.index("%s[%d,%d]_Real" % (data_type, i, j)) for j in ports] for i in ports]
+    imag_idx = [[colnames.index("%s[%d,%d]_Imag" % (data_type, i, j)) for j in ports] for i in ports]
+    return array[:, 0], array[:, real_idx] + 1j*array[:, imag_idx]
+
+_NETWORK_FORMAT = r"[SYZsyz](?:\[\d+,\d+\]|\d\d)"
+
+def s_to_yz(S, z0=50):
+    """
+    Y and Z matrices [freq x port x port] from S matrices referenced to the real impedance z0
+        Y = (I+S)^-1 (I-S) / z0,    Z = z0 (I-S)^-1 (I+S)
+    """
+    eye = numpy.eye(S.shape[-1])
+    Y = numpy.linalg.solve(eye + S, eye - S) / z0
+    Z = numpy.linalg.solve(eye - S, eye + S) * z0
+    return Y, Z
+
 class HfssFrequencySweep(COMWrapper):
     prop_tab = "HfssTab"
     start_freq = make_float_prop("Start")
@@ -733,41 +1202,73 @@ class HfssFrequencySweep(COMWrapper):
     def analyze_sweep(self):
         self.parent.analyze(self.solution_name)
         
-    def get_network_data(self, formats):
-        if isinstance(formats, str):
-            formats = formats.split(",")
+    def get_network_data(self, formats, z0=None):
+        """
+        formats: e.g. "S12,Y11" or ["S[10,11]", "Z11"]; raises ValueError on anything else
+        returns freq, [complex array for each format]
+        see get_network_matrices
+        """
+        if isinstance(formats, basestring):
+            unknown = re.sub(r"[,\s]", "", re.sub(_NETWORK_FORMAT, "", formats))
+            if unknown:
+                raise ValueError("Unknown network data format(s) in %r: %r" % (formats, unknown))
+            formats = re.findall(_NETWORK_FORMAT, formats)
         formats = [f.upper() for f in formats]
-
-        fmts_lists = {'S': [], 'Y': [], 'Z': []}
-
         for f in formats:
-            fmts_lists[f[0]].append((int(f[1]), int(f[2])))
-
-        ret = [None] * len(formats)
-        freq = None
-
-        for data_type, list in fmts_lists.items():
-            if list:
-                fn = tempfile.mktemp()
-                self.parent._solutions.ExportNetworkData(
-                    [],  self.parent.name + " : " + self.name,
-                      2, fn, ["all"], False, 0,
-                      data_type, -1, 1, 15
-                )
-                with open(fn) as f:
-                    f.readline()
-                    colnames = f.readline().split()
-                array = numpy.loadtxt(fn, skiprows=2)
-                if freq is None:
-                    freq = array[:, 0]
-                for i, j in list:
-                    real_idx = colnames.index("%s[%d,%d]_Real" % (data_type, i, j))
-                    imag_idx = colnames.index("%s[%d,%d]_Imag" % (data_type, i, j))
-                    c_arr = array[:, real_idx] + 1j*array[:, imag_idx]
-                    ret[formats.index("%s%d%d" % (data_type, i, j))] = c_arr
-
+            if not re.match(_NETWORK_FORMAT + "$", f):
+                raise ValueError("Unknown network data format %r" % f)
+        freq, matrices = self.get_network_matrices("".join(set(f[0] for f in formats)), z0=z0)
+        ret = []
+        for f in formats:
+            i, j = [int(n) for n in re.findall(r"\d+", f)] if "[" in f else (int(f[1]), int(f[2]))
+            ret.append(matrices[f[0]][:, i-1, j-1])
         return freq, ret
 
+    def get_network_matrices(self, data_types="SYZ", z0=None):
+        """
+        Y and Z are computed locally, with batched matrix inversions over frequency,
+        from one export of S renormalized to a real impedance (they don't depend on it).
+        S is as HFSS defines it for the ports (e.g. referenced to the wave-port
+        impedances), exported without renormalization; with z0 (ohm), S is renormalized
+        to z0 instead, and comes from the same export as Y and Z.
+        Without z0, asking for S together with Y or Z takes two exports: the
+        unrenormalized S is referenced to the port impedances, which are complex,
+        frequency dependent and not part of the exported matrix, so Y and Z cannot
+        be computed from it. Pass z0 if S renormalized to it will do.
+        returns freq, {data_type: complex array [freq x port x port]}
+        """
+        matrices = {}
+        if z0 is not None or "Y" in data_types or "Z" in data_types:
+            ref = 50. if z0 is None else z0
+            freq, S = self._export_S(ref)
+            matrices.update(zip("YZ", s_to_yz(S, ref)))
+            if z0 is not None:
+                matrices["S"] = S
+        if "S" in data_types and "S" not in matrices:
+            freq, matrices["S"] = self._export_S(None)
+        return freq, dict((t, matrices[t]) for t in data_types)
+
+    def _export_S(self, z0):
+        """ freq, S [freq x port x port], renormalized to z0 unless None """
+        return exports.export(lambda fn: self.parent._solutions.ExportNetworkData(
+            [],  self.parent.name + " : " + self.name,
+              2, fn, ["all"], z0 is not None, z0 or 0,
+              "S", -1, 1, 15
+        ), lambda fn: read_network_data(fn, "S"), ".tab")
+
+    def export_touchstone(self, filename, z0=50):
+        """
+        Exports the S parameters of the sweep to a Touchstone file (renormalized to
+        z0 ohm). See the touchstone module to stream it back in, e.g. into .npy files.
+        """
+        filepath = os.path.abspath(filename)
+        self.parent._solutions.ExportNetworkData(
+            [],  self.parent.name + " : " + self.name,
+              3, filepath, ["all"], True, z0,
+              "S", -1, 0, 15
+        )
+        return filepath
+
     def create_report(self, name, expr):
         existing = self.parent._reporter.GetAllReportNames()
         name = increment_name(name, existing)
@@ -780,8 +1281,13 @@ class HfssFrequencySweep(COMWrapper):
         return HfssReport(self.parent.parent, name)
 
     def get_report_arrays(self, expr):
-        r = self.create_report("Temp", expr)
-        return r.get_arrays()
+        """ returns [freq, values] of expr at the nominal variation, through the pooled report """
+        data = self.get_report_data([expr])
+        return numpy.vstack([data.index.values, data.values.T])
+
+    def get_report_data(self, exprs, variations=None):
+        """ DataFrame of exprs over the sweep, see HfssReportManager.get_report_data """
+        return self.parent.parent.reports.get_report_data(self.solution_name, exprs, variations)
 
 
 class HfssReport(COMWrapper):
@@ -799,9 +1305,307 @@ class HfssReport(COMWrapper):
         self.parent_design._reporter.ExportToFile(self.name, filepath)
 
     def get_arrays(self):
-        fn = tempfile.mktemp(suffix=".csv")
-        self.export_to_file(fn)
-        return numpy.loadtxt(fn, skiprows=1, delimiter=',').transpose()
+        return exports.export(self.export_to_file, lambda fn: read_numeric_table(fn, ","), ".csv").transpose()
+
+
+class HfssReportManager(COMWrapper):
+    """
+    Reports created on behalf of scripts are pooled: one report per solution,
+    report type and domain, reused for each request, so the report list of the
+    design stays short. A repeated request only updates the report; new
+    variations or expressions replace its traces (UpdateTraces, or DeleteTraces
+    and AddTraces). Any number of Y expressions and variations are fetched with
+    one report and one ExportToFile. The pooled reports are deleted on release
+    (and at exit).
+    """
+    def __init__(self, design, prefix="pyHFSS_"):
+        """
+        :type design: HfssDesign
+        """
+        super(HfssReportManager, self).__init__()
+        self.parent = design
+        self._reporter = design._reporter
+        self.prefix = prefix
+        self.pool = {}
+        self.traces = {} # report name -> (families, x, exprs) of its traces
+
+    def get_report_data(self, solution_name, exprs, variations=None, report_type="Modal Solution Data",
+                        domain="Sweep", x="Freq", x_values=("All",), with_units=False):
+        """
+        :param exprs: Y expressions, e.g. ["dB(S(1,1))", "im(Z(1,1))"]
+        :param variations: {variable: [values]} or {variable: "All"}; variables not
+        given are taken at their nominal value
+        :param domain: None for reports without a domain, e.g. "Eigenmode Parameters"
+        :param x: X component, "Freq" or e.g. a design variable
+        :return: DataFrame indexed by x, with columns (expression, variation)
+        (and {column: unit}, see read_report_csv)
+        """
+        variations = variations or {}
+        families = ["%s:=" % x, list(x_values)]
+        for name in self.parent.get_variable_names():
+            if name == x:
+                continue
+            values = variations.get(name, ["Nominal"])
+            families += ["%s:=" % name, ["All"] if values == "All" else list(values)]
+        exprs = list(exprs)
+        context = [] if domain is None else ["Domain:=", domain]
+        data = ["X Component:=", x, "Y Component:=", exprs]
+        name, exists = self.pooled_report(solution_name, report_type, domain)
+        traces = self.traces.get(name)
+        if not exists:
+            self._reporter.CreateReport(name, report_type, "Rectangular Plot", solution_name, context, families, data, [])
+        elif traces == (families, x, exprs):
+            self._reporter.UpdateReports([name]) # e.g. new solutions of the same variations
+        elif traces is not None and traces[2] == exprs:
+            self._reporter.UpdateTraces(name, exprs, solution_name, context, families, data)
+        else:
+            old = list(self._reporter.GetReportTraceNames(name))
+            if old:
+                self._reporter.DeleteTraces([name + ":=", old])
+            self._reporter.AddTraces(name, solution_name, context, families, data)
+        self.traces[name] = (families, x, exprs)
+        return exports.export(lambda fn: self._reporter.ExportToFile(name, fn),
+                              lambda fn: read_report_csv(fn, with_units), ".csv")
+
+    def pooled_report(self, solution_name, report_type, domain):
+        """ the name of the pooled report for this solution, report type and domain, and whether it exists """
+        key = (solution_name, report_type, domain)
+        name = self.pool.get(key)
+        if name is not None and name in self._reporter.GetAllReportNames():
+            return name, True
+        if name is None:
+            name = increment_name(self.prefix + report_type.replace(" ", ""), self._reporter.GetAllReportNames())
+            self.pool[key] = name
+        self.traces.pop(name, None)
+        return name, False
+
+    def clear(self):
+        existing = self._reporter.GetAllReportNames()
+        names = [name for name in self.pool.values() if name in existing]
+        if names:
+            self._reporter.DeleteReports(names)
+        self.pool = {}
+        self.traces = {}
+
+    def release(self):
+        if self.pool and self._reporter is not None:
+            try:
+                self.clear()
+            except Exception:
+                pass # HFSS may already be gone
+        super(HfssReportManager, self).release()
+
+_REPORT_COLUMN_RE = re.compile(r"^(.*?)(?: \[([^\]]*)\])?(?: - (.*))?$")
+
+def parse_report_column(column):
+    """ 'mag(S(1,1)) [] - LJ=\'8nH\' w=\'1mm\'' -> ('mag(S(1,1))', '', "LJ='8nH' w='1mm'") """
+    expr, unit, variation = _REPORT_COLUMN_RE.match(column.strip()).groups()
+    return expr, unit or "", variation or ""
+
+def read_report_csv(fn, with_units=False):
+    """
+    Reads a report exported to .csv. returns a DataFrame indexed by the X
+    component, with columns (expression, variation) (and {column: unit})
+    """
+    data = pd.read_csv(fn, engine="c")
+    parsed = [parse_report_column(c) for c in data.columns]
+    data.index = pd.Index(data.iloc[:, 0].values, name=parsed[0][0])
+    data = data.iloc[:, 1:]
+    data.columns = pd.MultiIndex.from_tuples([(e, v) for e, u, v in parsed[1:]], names=["expression", "variation"])
+    if with_units:
+        return data, dict(((e, v), u) for e, u, v in parsed)
+    return data
+
+
+def parse_variation(lv):
+    """ "LJ='8nH' w='1mm'" -> {"LJ": "8nH", "w": "1mm"} """
+    return dict(re.findall(r"(\$?\w+)='([^']*)'", str(lv)))
+
+def _same_value(a, b):
+    try:
+        return numpy.isclose(to_base_units(str(a)), to_base_units(str(b)), rtol=1e-9, atol=0)
+    except Exception:
+        return str(a) == str(b)
+
+def match_variations(rows, listvariations):
+    """ index into listvariations (ListVariations) of a solved variation with the values of each
+    row ({variable: value string}; other variables may be anything), None where there is none """
+    solved = [parse_variation(lv) for lv in listvariations]
+    matches = []
+    for row in rows:
+        found = [i for i, values in enumerate(solved)
+                 if all(name in values and _same_value(values[name], value) for name, value in row.items())]
+        matches.append(found[0] if found else None)
+    return matches
+
+def _sweep_data(values):
+    if isinstance(values, tuple) and values and values[0] in ("LIN", "LINC"):
+        return " ".join(str(v) for v in values)
+    return ", ".join(str(v) for v in values)
+
+def _sweep_values(values):
+    """ the value strings of a sweep definition, see HfssDesign.create_parametric_setup """
+    if not (isinstance(values, tuple) and values and values[0] in ("LIN", "LINC")):
+        return [str(v) for v in values]
+    kind, start, stop, step = values
+    parsed = parse_value_unit(str(start))
+    unit = parsed[1] if parsed is not None else ""
+    scale = to_base_units("1" + unit) if unit else 1.
+    start, stop = to_base_units(str(start)), to_base_units(str(stop))
+    if kind == "LINC":
+        points = numpy.linspace(start, stop, int(step))
+    else:
+        step = to_base_units(str(step))
+        points = numpy.arange(int(numpy.floor((stop - start)/step*(1 + 1e-9))) + 1)*step + start
+    return ["%.9g%s" % (p/scale, unit) for p in points]
+
+def _call_in_thread(com_object, method, *args):
+    """ starts com_object.method(*args) in a thread of its own (the COM object is marshalled to it),
+    so the caller can keep polling HFSS; returns the thread and a dict that gets "error" on failure """
+    stream = pythoncom.CoMarshalInterThreadInterfaceInStream(pythoncom.IID_IDispatch, com_object)
+    outcome = {}
+    def run():
+        pythoncom.CoInitialize()
+        try:
+            obj = Dispatch(pythoncom.CoGetInterfaceAndReleaseStream(stream, pythoncom.IID_IDispatch))
+            getattr(obj, method)(*args)
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            pythoncom.CoUninitialize()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread, outcome
+
+
+class HfssParametricSetup(COMWrapper):
+    def __init__(self, design, name, sweeps=None, setup=None, synchronize=False):
+        """
+        An Optimetrics parametric setup, see HfssDesign.create_parametric_setup
+        :type design: HfssDesign
+        """
+        super(HfssParametricSetup, self).__init__()
+        self.parent = design
+        self._optimetrics = design._optimetrics
+        self.name = name
+        self.sweeps = sweeps
+        self.setup = setup
+        self.synchronize = synchronize
+
+    @property
+    def rows(self):
+        """ the variations of the sweep, [{variable: value string}] """
+        names = [variable for variable, values in self.sweeps]
+        values = [_sweep_values(v) for variable, v in self.sweeps]
+        if self.synchronize:
+            return [dict(zip(names, row)) for row in zip(*values)]
+        rows = [{}]
+        for name, vals in zip(names, values):
+            rows = [dict(row, **{name: v}) for row in rows for v in vals]
+        return rows
+
+    def solved(self):
+        """ index into the setup's ListVariations of each row, None where not yet solved """
+        listvariations = self.parent._solutions.ListVariations(str(self.setup + " : LastAdaptive"))
+        return match_variations(self.rows, listvariations)
+
+    def progress(self):
+        """ (solved, total) variations """
+        solved = self.solved()
+        return sum(s is not None for s in solved), len(solved)
+
+    def solve(self, distributed=False, watch=False, poll_interval=30., config=None):
+        """
+        Solves all variations; with distributed, through AnalyzeDistributed, so HFSS spreads the
+        variations over the distributed-analysis machines / tasks set up in HFSS.
+        With watch, the solve runs in a thread (see start) and the progress (ListVariations) is
+        printed every poll_interval s. This polls HFSS from a second COM client while it is inside
+        Analyze*; HFSS does not promise to answer such calls during a solve, and may hold them until
+        the solve ends, so the prints can come late or not at all. If a poll fails, that is printed
+        and polling stops for the rest of the solve.
+        :param config: analysis settings for this solve only, see HfssDesktop.set_analysis_config
+        """
+        if watch:
+            running = self.start(distributed, config)
+            while not running.finish(poll_interval):
+                try:
+                    print "%s: %d / %d variations solved after %.0f s" % ((self.name,) + self.progress() + (time.time() - running.start_time,))
+                except pythoncom.com_error as e:
+                    print "%s: HFSS does not answer progress polls during the solve (%s); waiting for it to finish" % (self.name, e)
+                    running.finish()
+                    break
+            return
+        target, method = self._solve_method(distributed)
+        desktop = self.parent.parent.parent if config else None
+        previous = desktop.set_analysis_config(**config) if config else None
+        start = time.time()
+        try:
+            getattr(target, method)(self.name)
+        finally:
+            if previous is not None:
+                desktop.set_analysis_config(**previous)
+        analysis_log.append({"setup": self.name, "start": start, "wall_time": time.time() - start,
+                             "config": dict(config or {}, distributed=distributed), "design": self.parent.name})
+
+    def start(self, distributed=False, config=None):
+        """
+        Starts solve(distributed, config=config) in a thread of its own and returns at once.
+        returns a ParametricSolve: done() tells whether it has ended, finish() waits for it
+        """
+        return ParametricSolve(self, distributed, config)
+
+    def _solve_method(self, distributed):
+        if distributed:
+            return self.parent._design, "AnalyzeDistributed"
+        return self._optimetrics, "SolveSetup"
+
+    def delete(self):
+        self._optimetrics.DeleteSetups([self.name])
+
+
+class ParametricSolve(object):
+    """ a solve of an HfssParametricSetup running in a thread, see HfssParametricSetup.start """
+    def __init__(self, parametric, distributed=False, config=None):
+        self.parametric = parametric
+        self.distributed = distributed
+        self.config = config
+        self.desktop = parametric.parent.parent.parent if config else None
+        self.previous = self.desktop.set_analysis_config(**config) if config else None
+        self.start_time = time.time()
+        self.finished = False
+        target, method = parametric._solve_method(distributed)
+        try:
+            self.thread, self.outcome = _call_in_thread(target, method, parametric.name)
+        except:
+            self._restore()
+            raise
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def finish(self, timeout=None):
+        """
+        Waits for the solve, at most timeout s. Once it has ended, the analysis config is
+        restored and the solve is logged in analysis_log, or its error is raised.
+        returns False if the solve is still running, else True
+        """
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            return False
+        if not self.finished:
+            self.finished = True
+            self._restore()
+            if "error" in self.outcome:
+                raise self.outcome["error"]
+            analysis_log.append({"setup": self.parametric.name, "start": self.start_time,
+                                 "wall_time": time.time() - self.start_time, "design": self.parametric.parent.name,
+                                 "config": dict(self.config or {}, distributed=self.distributed)})
+        return True
+
+    def _restore(self):
+        if self.previous is not None:
+            self.desktop.set_analysis_config(**self.previous)
 
 
 class HfssModeler(COMWrapper):
@@ -952,6 +1756,13 @@ class HfssModeler(COMWrapper):
     def get_face_ids(self, obj):
         return self. _modeler.GetFaceIDs(obj)
 
+    def get_objects_in_group(self, group="Solids"):
+        """group is e.g. "Solids", "Sheets" or "Lines" """
+        return list(self._modeler.GetObjectsInGroup(group))
+
+    def get_material(self, obj):
+        return self._modeler.GetPropertyValue("Geometry3DAttributeTab", obj, "Material").strip('"')
+
     def eval_expr(self, expr, units="mm"):
         if not isinstance(expr, str):
             return expr
@@ -1052,6 +1863,17 @@ class HfssFieldsCalc(COMWrapper):
 
     def clear_named_expressions(self):
         self.parent.parent._fields_calc.ClearAllNamedExpr()
+        getattr(self.parent.parent, "named_expressions", set()).clear()
+
+    def load_library(self, path=None):
+        """ :rtype: CalcLibrary with the named expressions of the .clc file at path
+        (default participation_ratio.clc) """
+        return CalcLibrary(self.parent).load(DEFAULT_CLC if path is None else path)
+
+    def register_library(self, path=None, names=None):
+        """ adds the expressions of a .clc file (or only names, with their dependencies)
+        to the calculator, skipping those already present; returns the names added """
+        return self.load_library(path).register(names)
 
 class CalcObject(COMWrapper):
     def __init__(self, stack, setup):
@@ -1189,17 +2011,9 @@ class CalcObject(COMWrapper):
         self.calc_module.AddNamedExpr(name)
         return NamedCalcObject(name, self.setup)
 
-    def evaluate(self, phase=0, lv=None, print_debug = False):#, n_mode=1):
-        self.write_stack()
-        if print_debug:
-            print '---------------------'
-            print 'writing to stack: OK'
-            print '-----------------'
-        #self.calc_module.set_mode(n_mode, 0)
-        setup_name = self.setup.solution_name
-        
+    def _eval_args(self, phase=0, lv=None):
         if lv is not None:
-           args = lv
+           args = list(lv) # copy, so that the same lv can be reused across evaluations
         else:
            args = []
            
@@ -1208,10 +2022,38 @@ class CalcObject(COMWrapper):
         
         if isinstance(self.setup, HfssDMSetup):
             args.extend(["Freq:=", self.setup.solution_freq])
+        return args
 
+    def evaluate(self, phase=0, lv=None, print_debug = False):#, n_mode=1):
+        self.write_stack()
+        if print_debug:
+            print '---------------------'
+            print 'writing to stack: OK'
+            print '-----------------'
+        #self.calc_module.set_mode(n_mode, 0)
+        setup_name = self.setup.solution_name
+        args = self._eval_args(phase, lv)
         self.calc_module.ClcEval(setup_name, args)
         return float(self.calc_module.GetTopEntryValue(setup_name, args)[0])
 
+    def evaluate_integrals(self, names, kind="EnterSurf", phase=0, lv=None):
+        """Integrate this expression over each geometry in names, in one calculator
+        session: the integrand is written to the stack once and duplicated for each geometry.
+        kind is "EnterSurf", "EnterVol" or "EnterLine". Returns a numpy array."""
+        self.write_stack()
+        setup_name = self.setup.solution_name
+        args = self._eval_args(phase, lv)
+        values = numpy.zeros(len(names))
+        for i, name in enumerate(names):
+            self.calc_module.CalcStack("push")
+            getattr(self.calc_module, kind)(name)
+            self.calc_module.CalcOp("Integrate")
+            self.calc_module.ClcEval(setup_name, args)
+            values[i] = float(self.calc_module.GetTopEntryValue(setup_name, args)[0])
+            self.calc_module.CalcStack("pop")
+        self.calc_module.CalcStack("pop")
+        return values
+
 class NamedCalcObject(CalcObject):
     def __init__(self, name, setup):
         self.name = name
@@ -1223,6 +2065,128 @@ class ConstantCalcObject(CalcObject):
         stack = [("EnterScalar", num)]
         super(ConstantCalcObject, self).__init__(stack, setup)
 
+# .clc calculator libraries: commands that enter a new stack entry, and the
+# calculator operations by number of operands (the rest are unary)
+DEFAULT_CLC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "participation_ratio.clc")
+_CLC_ENTER = {"Fundamental_Quantity": "EnterQty", "NameOfExpression": "CopyNamedExprToStack",
+              "Scalar_Constant": "EnterScalar", "Scalar_Function": "EnterScalarFunc",
+              "EnterVolume": "EnterVol", "EnterSurface": "EnterSurf", "EnterLine": "EnterLine",
+              "EnterPoint": "EnterPoint"}
+_CLC_BINARY_OPS = set(["+", "-", "*", "/", "Dot", "Cross", "Pow", "Integrate", "Max", "Min", "Atan2"])
+_CLC_SKIP_OPS = set(["VolumeValue", "SurfaceValue", "LineValue", "PointValue"])
+_CLC_LINE_RE = re.compile(r"^\s*(\w+)\((.*)\)\s*$")
+_CLC_ARG_RE = re.compile(r"(?:\w+=)?('[^']*'|[^,]+)")
+
+def parse_clc(path):
+    """
+    Parses the $begin 'Named_Expression' blocks of a calculator library (.clc).
+    returns [(name, expression text, [(command, args)])] in file order
+    """
+    entries, current = [], None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("$begin 'Named_Expression'"):
+                current = {"name": None, "expression": None, "commands": []}
+            elif line.startswith("$end 'Named_Expression'"):
+                entries.append((current["name"], current["expression"], current["commands"]))
+                current = None
+            elif current is not None:
+                match = _CLC_LINE_RE.match(line)
+                if match is None:
+                    continue
+                command, args = match.group(1), match.group(2)
+                if command in ("Name", "Expression"):
+                    current[command.lower()] = args.strip()[1:-1]
+                else:
+                    args = [a.strip() for a in _CLC_ARG_RE.findall(args)]
+                    current["commands"].append((command, [a[1:-1] if a.startswith("'") else float(a) for a in args]))
+    return entries
+
+class CalcLibrary(object):
+    """
+    Named calculator expressions, from .clc files or Python, kept as CalcObjects
+    (each one a DAG of its operands, flattened to a stack only when written), and
+    registered with the fields calculator in dependency order, once per design.
+    """
+    def __init__(self, setup):
+        """
+        :type setup: HfssSetup
+        """
+        self.setup = setup
+        self.calc_module = setup.parent._fields_calc
+        self.exprs = {}
+        self.order = []
+        self.deps = {}
+
+    def load(self, path):
+        for name, text, commands in parse_clc(path):
+            self.add(name, *self.build(commands))
+        return self
+
+    def build(self, commands):
+        """ replays the .clc commands on a stack of CalcObjects; returns the CalcObject
+        and the named expressions it uses """
+        stack, deps = [], []
+        for command, args in commands:
+            if command == "Operation":
+                op = args[0]
+                if op in _CLC_SKIP_OPS:
+                    continue
+                if op in _CLC_BINARY_OPS:
+                    right, left = stack.pop(), stack.pop()
+                    stack.append(CalcObject(left.stack + right.stack + [("CalcOp", op)], self.setup))
+                else:
+                    stack.append(stack.pop()._unary_op(op))
+            elif command == "MaterialOp":
+                stack.append(CalcObject(stack.pop().stack + [("ClcMaterial", (args[0], "mult"))], self.setup))
+            elif command in _CLC_ENTER:
+                if command == "NameOfExpression":
+                    deps.append(args[0])
+                stack.append(CalcObject([(_CLC_ENTER[command], args[0])], self.setup))
+            else:
+                raise ValueError("Unsupported calculator command %s%s" % (command, tuple(args)))
+        if len(stack) != 1:
+            raise ValueError("Calculator expression leaves %d entries on the stack" % len(stack))
+        return stack[0], deps
+
+    def add(self, name, expr, deps=()):
+        """ adds (or replaces) a named expression; deps: names of library expressions it uses """
+        if name not in self.exprs:
+            self.order.append(name)
+        self.exprs[name] = expr
+        self.deps[name] = list(deps)
+        return NamedCalcObject(name, self.setup)
+
+    def __getitem__(self, name):
+        return NamedCalcObject(name, self.setup)
+
+    def __contains__(self, name):
+        return name in self.exprs
+
+    def exists(self, name):
+        known = getattr(self.setup.parent, "named_expressions", set())
+        if name not in known and self.calc_module.DoesNamedExpressionExists(name):
+            known.add(name)
+        return name in known
+
+    def register(self, names=None):
+        """ registers names (default all) and their dependencies, skipping expressions
+        that already exist; returns the names added """
+        added = []
+        def visit(name):
+            if name not in self.exprs or name in added or self.exists(name):
+                return
+            for dep in self.deps[name]:
+                visit(dep)
+            self.exprs[name].save_as(name)
+            self.calc_module.CalcStack("clear")
+            getattr(self.setup.parent, "named_expressions", set()).add(name)
+            added.append(name)
+        for name in (self.order if names is None else names):
+            visit(name)
+        return added
+
 def get_active_project():
     ''' If you see the error:
         "The requested operation requires elevation."
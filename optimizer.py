@@ -0,0 +1,352 @@
+"""
+Closed-loop design optimization: batches of design-variable settings are
+proposed from Gaussian-process surrogates (surrogate.py) of the results, solved
+by a backend, and the surrogates are refit as each result lands, until the
+Hamiltonian parameters meet the targets.
+
+    opt = BatchOptimizer({"pad_x": (0.2e-3, 0.6e-3), "LJ1": (8e-9, 12e-9)},
+                         targets={"f0_0": 5.5, "alpha_0": 200}, limits={"Q_0": (1e6, None)},
+                         backend=HfssBackend(project, design, units={"pad_x": "mm", "LJ1": "nH"},
+                                             junc_rect=["junc_rect"], junc_lines=["junc_line"],
+                                             junc_len=[0.0001], junc_LJ_var_name=["LJ1"]),
+                         checkpoint="opt.json")
+    opt.run(n_solves=30)
+    settings, results = opt.best()
+
+Outputs are named as in bbq.BbqAnalysis.get_results_table: f0_<m>, f1_<m> [GHz],
+alpha_<m>, chi_<m>_<n> [MHz], pJ_<m>_<junc>, Q_<m>. A backend has submit(settings)
+-> handle and poll() -> [(handle, {output: value} or None if the solve failed)];
+results may come back in any order. A function or solve signals a failed point by
+raising SolveError (or returning None); it is recorded as failed and the run goes
+on, while any other exception stops the run. The checkpoint (JSON) is rewritten
+after each result, and BatchOptimizer.load resumes from it, resubmitting the
+pending settings.
+"""
+from __future__ import division
+import os, json, time
+import numpy
+
+from surrogate import Surrogate
+
+
+class SolveError(Exception):
+    """ a point that could not be solved; recorded as failed rather than stopping the run """
+
+
+class BatchOptimizer(object):
+    def __init__(self, variables, targets=None, limits=None, weights=None, scales=None, backend=None,
+                 batch_size=4, n_initial=None, n_candidates=2000, n_samples=64, checkpoint=None, seed=None):
+        """
+        :param variables: {variable: (low, high)} in SI units
+        :param targets: {output: target value}
+        :param limits: {output: (low, high)}, None for an open side, e.g. {"Q_0": (1e6, None)}
+        :param weights: {output: weight} of the target terms, default 1
+        :param scales: {output: scale} of the misfit, default |target| (a relative misfit)
+        :param n_initial: space-filling settings before the surrogates are used, default 2 d + 1
+        :param n_samples: samples of the surrogate outputs per candidate for the expected improvement
+        """
+        self.variables = dict((k, tuple(float(x) for x in v)) for k, v in variables.items())
+        self.names = sorted(self.variables)
+        self.targets = targets or {}
+        self.limits = limits or {}
+        self.weights = weights or {}
+        self.scales = scales or {}
+        self.backend = backend
+        self.batch_size = batch_size
+        self.n_initial = 2*len(self.names) + 1 if n_initial is None else n_initial
+        self.n_candidates = n_candidates
+        self.n_samples = n_samples
+        self.checkpoint = checkpoint
+        self.rng = numpy.random.RandomState(seed)
+        self.history = []   # [{"settings": {...}, "results": {...} or None}]
+        self.pending = {}   # backend handle -> settings
+        self._initial = []  # space-filling settings not yet submitted
+
+    @property
+    def outputs(self):
+        return sorted(set(self.targets) | set(self.limits))
+
+    # --- objective
+    def objective(self, Y):
+        """ weighted squared relative misfit to the targets plus the squared violation of the limits;
+        Y: {output: array} or DataFrame, returns an array """
+        total = 0
+        for output, target in self.targets.items():
+            scale = self.scales.get(output, abs(target) or 1.)
+            total = total + self.weights.get(output, 1.)*((numpy.asarray(Y[output]) - target)/scale)**2
+        for output, (low, high) in self.limits.items():
+            y = numpy.asarray(Y[output])
+            if low is not None:
+                total = total + (numpy.clip(low - y, 0, None)/self.scales.get(output, abs(low) or 1.))**2
+            if high is not None:
+                total = total + (numpy.clip(y - high, 0, None)/self.scales.get(output, abs(high) or 1.))**2
+        return total
+
+    def _solved(self):
+        return [h for h in self.history if h["results"] is not None]
+
+    def best(self):
+        """ settings and results of the solved point with the lowest objective """
+        solved = self._solved()
+        if not solved:
+            return None, None
+        values = [float(self.objective(dict((o, h["results"][o]) for o in self.outputs))) for h in solved]
+        h = solved[int(numpy.argmin(values))]
+        return h["settings"], h["results"]
+
+    def table(self):
+        """ DataFrame of the history: settings, results and objective """
+        import pandas as pd
+        rows = []
+        for h in self.history:
+            row = dict(h["settings"])
+            row.update(h["results"] or {})
+            if h["results"] is not None:
+                row["objective"] = float(self.objective(dict((o, h["results"][o]) for o in self.outputs)))
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    # --- proposals
+    def _latin_hypercube(self, n):
+        u = (numpy.argsort(self.rng.rand(n, len(self.names)), axis=0) + self.rng.rand(n, len(self.names)))/n
+        low, high = numpy.array([self.variables[v] for v in self.names]).T
+        return [dict(zip(self.names, low + row*(high - low))) for row in u]
+
+    def propose(self, n):
+        """ n new settings: space-filling first, then by expected improvement of the surrogates,
+        with the pending settings counted as picked """
+        import pandas as pd
+        solved = self._solved()
+        n_seen = len(self.history) + len(self.pending)
+        if n_seen < self.n_initial or len(solved) < 2:
+            if not self._initial:
+                self._initial = self._latin_hypercube(max(self.n_initial - n_seen, n))
+            picks, self._initial = self._initial[:n], self._initial[n:]
+            return picks
+        X = pd.DataFrame([h["settings"] for h in solved], columns=self.names)
+        Y = pd.DataFrame([dict((o, h["results"][o]) for o in self.outputs) for h in solved], columns=self.outputs)
+        surrogate = Surrogate(X, Y, bounds=self.variables)
+        best = numpy.min(self.objective(Y))
+        samples = self.rng.normal(size=(self.n_samples, 1, len(self.outputs)))
+        def expected_improvement(mean, std):
+            draws = mean.values[None] + std.values[None]*samples          # [sample x candidate x output]
+            values = self.objective(dict((o, draws[..., i]) for i, o in enumerate(self.outputs)))
+            return numpy.mean(numpy.clip(best - values, 0, None), axis=0) + 1e-12*numpy.sum(std.values, axis=1)
+        pending = pd.DataFrame(list(self.pending.values()), columns=self.names)
+        suggestion = surrogate.suggest(n, surrogate.random_points(self.n_candidates, self.rng.randint(2**31 - 1)),
+                                       score=expected_improvement, pending=pending)
+        return [dict((v, float(row[v])) for v in self.names) for _, row in suggestion.iterrows()]
+
+    # --- loop
+    def submit(self, settings):
+        handle = self.backend.submit(settings)
+        self.pending[handle] = settings
+        return handle
+
+    def tell(self, settings, results):
+        """ records a result ({output: value}, or None for a failed solve) and saves the checkpoint """
+        if results is not None:
+            results = dict((k, float(v)) for k, v in results.items())
+        self.history.append({"settings": dict(settings), "results": results})
+        self.save()
+
+    def run(self, n_solves, poll_interval=1., verbose=True):
+        """ keeps up to batch_size settings in the backend until n_solves are done; proposals are
+        refreshed as each result lands, rather than after the whole batch """
+        while len(self.history) < n_solves:
+            n_free = min(self.batch_size - len(self.pending), n_solves - len(self.history) - len(self.pending))
+            if n_free > 0:
+                for settings in self.propose(n_free):
+                    self.submit(settings)
+                self.save()
+            done = self.backend.poll()
+            for handle, results in done:
+                settings = self.pending.pop(handle)
+                self.tell(settings, results)
+                if verbose:
+                    print '%d/%d  %s  ->  %s' % (len(self.history), n_solves, _format(settings),
+                                                 "failed" if results is None else _format(
+                                                     dict((o, results[o]) for o in self.outputs if o in results)))
+            if not done:
+                time.sleep(poll_interval)
+        return self.best()
+
+    # --- checkpoint
+    def save(self, fn=None):
+        fn = fn or self.checkpoint
+        if fn is None:
+            return
+        state = {"variables": self.variables, "targets": self.targets, "limits": self.limits,
+                 "weights": self.weights, "scales": self.scales, "batch_size": self.batch_size,
+                 "n_initial": self.n_initial, "history": self.history, "pending": list(self.pending.values())}
+        with open(fn + ".tmp", "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        if os.path.exists(fn):
+            os.remove(fn) # os.rename doesn't replace on Windows
+        os.rename(fn + ".tmp", fn)
+
+    @classmethod
+    def load(cls, fn, backend, **kwargs):
+        """ resumes from a checkpoint; the settings that were pending are submitted to backend again """
+        with open(fn) as f:
+            state = json.load(f)
+        opt = cls(state["variables"], state["targets"], state["limits"], state["weights"], state["scales"],
+                  backend, state["batch_size"], state["n_initial"], checkpoint=fn, **kwargs)
+        opt.history = state["history"]
+        for settings in state["pending"]:
+            opt.submit(settings)
+        return opt
+
+
+class FunctionBackend(object):
+    """ solves with a Python function settings -> {output: value}, e.g. a surrogate or a circuit model;
+    in a multiprocessing pool if processes is given """
+    def __init__(self, function, processes=None):
+        self.function = function
+        self.pool = None
+        if processes:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(processes)
+        self.jobs = {}
+        self.count = 0
+
+    def submit(self, settings):
+        self.count += 1
+        if self.pool is not None:
+            self.jobs[self.count] = self.pool.apply_async(self.function, (settings,))
+        else:
+            self.jobs[self.count] = settings
+        return self.count
+
+    def poll(self):
+        done = []
+        for handle, job in list(self.jobs.items()):
+            if self.pool is None:
+                done.append((handle, _call(self.function, job)))
+            elif job.ready():
+                done.append((handle, _result(job)))
+            else:
+                continue
+            del self.jobs[handle]
+        return done
+
+
+class HfssBackend(object):
+    """
+    Solves settings in HFSS: everything submitted while no solve is running goes into one Optimetrics
+    parametric setup (HfssDesign.create_parametric_table), so HFSS schedules and, with distributed,
+    spreads the solves; do_eBBQ then runs on the new variations, and the results of each are its
+    row of BbqAnalysis.get_results_table.
+    The solve runs in a background thread (HfssParametricSetup.start): poll starts it and returns
+    nothing until it has finished; the poll that finds it finished runs do_eBBQ and returns the batch.
+    """
+    def __init__(self, project, design, units=None, setup_name=None, distributed=False, keep_setups=False,
+                 config=None, **ebbq_kwargs):
+        """
+        :param units: {variable: unit} to set the SI settings in, e.g. {"pad_x": "mm", "LJ1": "nH"}
+        :param distributed: solve with AnalyzeDistributed, see HfssParametricSetup.solve
+        :param keep_setups: keep the parametric setups in the design afterwards
+        :param config: analysis settings for the solves, see hfss.HfssDesktop.set_analysis_config
+        :param ebbq_kwargs: passed to Bbq.do_eBBQ, e.g. junc_rect, junc_lines, junc_len, junc_LJ_var_name
+        """
+        self.project = project
+        self.design = design
+        self.units = units or {}
+        self.setup_name = setup_name
+        self.distributed = distributed
+        self.keep_setups = keep_setups
+        self.config = config
+        self.ebbq_kwargs = ebbq_kwargs
+        self.queue = []
+        self.count = 0
+        self.running = None # (batch, parametric setup, ParametricSolve) of the solve in the background
+
+    def submit(self, settings):
+        self.count += 1
+        self.queue.append((self.count, settings))
+        return self.count
+
+    def value_strings(self, settings):
+        from hfss import to_base_units
+        row = {}
+        for name, value in settings.items():
+            unit = self.units.get(name, "")
+            scale = to_base_units("1" + unit) if unit else 1.
+            row[name] = "%.9g%s" % (value/scale, unit)
+        return row
+
+    def solve(self, batch):
+        """ [settings] -> [results or None], waiting for the solve """
+        parametric, running = self.start(batch)
+        return self.collect(parametric, running)
+
+    def start(self, batch):
+        """ starts the solve of [settings] in the background; returns the parametric setup and its ParametricSolve """
+        parametric = self.design.create_parametric_table([self.value_strings(s) for s in batch], self._setup_name())
+        try:
+            return parametric, parametric.start(distributed=self.distributed, config=self.config)
+        except:
+            if not self.keep_setups:
+                parametric.delete()
+            raise
+
+    def collect(self, parametric, running):
+        """ waits for a solve from start, runs do_eBBQ on its variations; returns [results or None] """
+        from bbq import Bbq
+        try:
+            running.finish()
+            bbq = Bbq(self.project, self.design, verbose=False, setup_name=self._setup_name())
+            variations = bbq.get_parametric_variations(parametric)
+        finally:
+            if not self.keep_setups:
+                parametric.delete()
+        solved = [v for v in variations if v is not None]
+        results = {}
+        if solved:
+            bbq.do_eBBQ(variations=solved, **self.ebbq_kwargs)
+            results = bbq.bbq_analysis._results_tables(solved)[1].T.to_dict()
+        return [results.get(v) for v in variations]
+
+    def _setup_name(self):
+        return self.setup_name or self.design.get_setup_names()[0]
+
+    def poll(self):
+        import pythoncom
+        if self.running is None:
+            if self.queue:
+                batch, self.queue = self.queue, []
+                try:
+                    self.running = (batch,) + self.start([settings for handle, settings in batch])
+                except (SolveError, pythoncom.com_error) as e:
+                    print "Solve of the batch failed: %s" % e
+                    return [(handle, None) for handle, settings in batch]
+            return []
+        batch, parametric, running = self.running
+        if not running.done():
+            return []
+        self.running = None
+        try:
+            results = self.collect(parametric, running)
+        except (SolveError, pythoncom.com_error) as e:
+            print "Solve of the batch failed: %s" % e
+            results = [None]*len(batch)
+        return [(handle, r) for (handle, settings), r in zip(batch, results)]
+
+
+def _call(function, settings):
+    try:
+        return function(settings)
+    except SolveError as e:
+        print "Solve of %s failed: %s" % (_format(settings), e)
+        return None
+
+def _result(job):
+    """ the result of a pool job; SolveError in the worker -> None, anything else is raised again """
+    try:
+        return job.get()
+    except SolveError as e:
+        print "Solve failed: %s" % e
+        return None
+
+def _format(values):
+    return ", ".join("%s=%.4g" % (k, values[k]) for k in sorted(values))
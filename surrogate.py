@@ -0,0 +1,190 @@
+"""
+Gaussian-process surrogates of simulation results over the design variables,
+to predict eBBQ results (frequencies, Qs, participations, chis) between the
+solved variations, with an uncertainty, and to pick the next variations to
+solve where the surrogates are least certain.
+
+Each output is modelled independently, with an ARD Matern 5/2 (or squared
+exponential) kernel on the variables scaled to the unit box; the length scales
+and noise are set by maximizing the marginal likelihood.
+    surrogate = analysis.get_surrogate()             # bbq.BbqAnalysis
+    mean, std = surrogate.predict(pd.DataFrame({"pad_x": [0.4e-3], "LJ1": [9e-9]}))
+    next_points = surrogate.suggest(n=4)
+"""
+from __future__ import division
+import numpy
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+
+
+class GaussianProcess(object):
+    """
+    Gaussian-process regression of one output; X [n x d] in the unit box, y [n].
+    The signal variance is profiled out of the likelihood.
+    """
+    def __init__(self, kernel="matern52", length_scales=None, noise=None, n_restarts=3):
+        """
+        :param kernel: "matern52" or "se"
+        :param length_scales, noise: fixed hyperparameters (relative to the unit box and
+        the signal variance); fitted when None
+        """
+        self.kernel = kernel
+        self.length_scales = length_scales
+        self.noise = noise
+        self.n_restarts = n_restarts
+
+    def _k(self, A, B, length_scales):
+        r = numpy.sqrt(numpy.sum(((A[:, None, :] - B[None, :, :])/length_scales)**2, axis=-1))
+        if self.kernel == "se":
+            return numpy.exp(-r**2/2)
+        return (1 + numpy.sqrt(5)*r + 5/3*r**2)*numpy.exp(-numpy.sqrt(5)*r)
+
+    def _factor(self, X, y, length_scales, noise):
+        K = self._k(X, X, length_scales) + (noise + 1e-10)*numpy.eye(len(X))
+        L = cho_factor(K, lower=True)
+        alpha = cho_solve(L, y)
+        variance = max(y.dot(alpha)/len(y), 1e-300)
+        return L, alpha, variance
+
+    def _neg_log_likelihood(self, theta, X, y):
+        try:
+            L, alpha, variance = self._factor(X, y, numpy.exp(theta[:-1]), numpy.exp(theta[-1]))
+        except numpy.linalg.LinAlgError:
+            return 1e300
+        return len(y)/2*numpy.log(variance) + numpy.sum(numpy.log(numpy.diag(L[0])))
+
+    def fit(self, X, y):
+        self.X = numpy.atleast_2d(numpy.asarray(X, dtype=float))
+        y = numpy.asarray(y, dtype=float)
+        self.y_mean, self.y_scale = y.mean(), (y.std() if y.std() > 0 else 1.)
+        self.y = (y - self.y_mean)/self.y_scale
+        d = self.X.shape[1]
+        if self.length_scales is None or self.noise is None:
+            bounds = [(numpy.log(1e-2), numpy.log(1e2))]*d + [(numpy.log(1e-8), numpy.log(1e-1))]
+            starts = [numpy.log([l]*d + [1e-6]) for l in numpy.logspace(-1, 0.5, self.n_restarts)]
+            if self.length_scales is not None:
+                bounds[:d] = [(numpy.log(l),)*2 for l in numpy.broadcast_to(self.length_scales, (d,))]
+            if self.noise is not None:
+                bounds[-1] = (numpy.log(self.noise),)*2
+            best = min((minimize(self._neg_log_likelihood, numpy.clip(x0, *zip(*bounds)), (self.X, self.y),
+                                 method="L-BFGS-B", bounds=bounds) for x0 in starts), key=lambda r: r.fun)
+            self.fitted_length_scales, self.fitted_noise = numpy.exp(best.x[:-1]), numpy.exp(best.x[-1])
+        else:
+            self.fitted_length_scales = numpy.broadcast_to(self.length_scales, (d,)).astype(float)
+            self.fitted_noise = self.noise
+        self._L, self._alpha, self.variance = self._factor(self.X, self.y, self.fitted_length_scales, self.fitted_noise)
+        return self
+
+    def predict(self, X, return_std=True):
+        X = numpy.atleast_2d(numpy.asarray(X, dtype=float))
+        k = self._k(X, self.X, self.fitted_length_scales)
+        mean = self.y_mean + self.y_scale*k.dot(self._alpha)
+        if not return_std:
+            return mean
+        var = self.variance*(1 - numpy.sum(k*cho_solve(self._L, k.T).T, axis=1))
+        return mean, self.y_scale*numpy.sqrt(numpy.clip(var, 0, None))
+
+    def condition(self, X):
+        """ copy with the points X added at their predicted mean: same mean, reduced std (for batch selection) """
+        gp = GaussianProcess(self.kernel, self.fitted_length_scales, self.fitted_noise)
+        X = numpy.atleast_2d(numpy.asarray(X, dtype=float))
+        gp.X = numpy.vstack([self.X, X])
+        gp.y_mean, gp.y_scale = self.y_mean, self.y_scale
+        gp.y = numpy.concatenate([self.y, (self.predict(X, False) - self.y_mean)/self.y_scale])
+        gp.fitted_length_scales, gp.fitted_noise = self.fitted_length_scales, self.fitted_noise
+        gp._L, gp._alpha, _ = gp._factor(gp.X, gp.y, gp.fitted_length_scales, gp.fitted_noise)
+        gp.variance = self.variance
+        return gp
+
+
+class Surrogate(object):
+    """ one GaussianProcess per output column of a table of results over the variables """
+    def __init__(self, X, Y, bounds=None, **gp_kwargs):
+        """
+        :param X: DataFrame [variation x variable] of numeric variable values (SI)
+        :param Y: DataFrame [variation x output]; rows with a missing output are skipped for that output
+        :param bounds: {variable: (low, high)} of the design space, default the range of X
+        :param gp_kwargs: passed to GaussianProcess, e.g. kernel
+        """
+        import pandas as pd
+        self.variables, self.outputs = list(X.columns), list(Y.columns)
+        bounds = bounds or {}
+        self.bounds = numpy.array([bounds.get(v, (X[v].min(), X[v].max())) for v in self.variables], dtype=float)
+        self.X, self.Y = X, Y
+        self.models = {}
+        for output in self.outputs:
+            keep = Y[output].notnull().values
+            self.models[output] = GaussianProcess(**gp_kwargs).fit(self._scale(X.values[keep]), Y[output].values[keep])
+        self._pd = pd
+
+    def _scale(self, X):
+        span = self.bounds[:, 1] - self.bounds[:, 0]
+        return (numpy.asarray(X, dtype=float) - self.bounds[:, 0])/numpy.where(span > 0, span, 1)
+
+    def _frame(self, X):
+        if isinstance(X, dict):
+            X = self._pd.DataFrame(X)
+        return X[self.variables] if hasattr(X, "columns") else self._pd.DataFrame(numpy.atleast_2d(X), columns=self.variables)
+
+    def predict(self, X, outputs=None):
+        """ returns mean, std: DataFrames [point x output] """
+        X = self._frame(X)
+        outputs = self.outputs if outputs is None else outputs
+        predictions = dict((output, self.models[output].predict(self._scale(X.values))) for output in outputs)
+        mean = self._pd.DataFrame(dict((o, p[0]) for o, p in predictions.items()), index=X.index, columns=outputs)
+        std = self._pd.DataFrame(dict((o, p[1]) for o, p in predictions.items()), index=X.index, columns=outputs)
+        return mean, std
+
+    def random_points(self, n=2000, seed=None):
+        """ n uniform random points in the bounds, as a DataFrame """
+        u = numpy.random.RandomState(seed).rand(n, len(self.variables))
+        return self._pd.DataFrame(self.bounds[:, 0] + u*(self.bounds[:, 1] - self.bounds[:, 0]), columns=self.variables)
+
+    def suggest(self, n=1, candidates=None, outputs=None, score=None, pending=None, seed=None):
+        """
+        The n candidates to solve next, chosen greedily: each pick maximizes score(mean, std)
+        (DataFrames [candidate x output] -> [candidate]), then is added to the models at its
+        predicted mean, so the following picks look elsewhere.
+        :param candidates: DataFrame of variable settings, default random points in the bounds
+        :param score: default the summed std of the outputs relative to their spread over the
+        solved points, i.e. where the surrogates are least certain
+        :param pending: variable settings already being solved, taken as picked
+        returns the chosen rows of candidates, with the score at the time of the pick
+        """
+        candidates = self.random_points(seed=seed) if candidates is None else self._frame(candidates)
+        outputs = self.outputs if outputs is None else outputs
+        if score is None:
+            scale = self.Y[outputs].std().replace(0, 1).fillna(1)
+            score = lambda mean, std: ((std/scale)**2).sum(axis=1).values
+        models = dict((o, self.models[o]) for o in outputs)
+        if pending is not None and len(pending):
+            models = dict((o, gp.condition(self._scale(self._frame(pending).values))) for o, gp in models.items())
+        x = self._scale(candidates.values)
+        picks, scores = [], []
+        for i in range(min(n, len(candidates))):
+            predictions = dict((o, models[o].predict(x)) for o in outputs)
+            mean = self._pd.DataFrame(dict((o, p[0]) for o, p in predictions.items()), columns=outputs)
+            std = self._pd.DataFrame(dict((o, p[1]) for o, p in predictions.items()), columns=outputs)
+            s = numpy.asarray(score(mean, std), dtype=float)
+            s[picks] = -numpy.inf
+            best = int(numpy.argmax(s))
+            picks.append(best)
+            scores.append(s[best])
+            models = dict((o, gp.condition(x[best])) for o, gp in models.items())
+        suggestion = candidates.iloc[picks].copy()
+        suggestion["score"] = scores
+        return suggestion
+
+    def cross_validate(self, outputs=None):
+        """ leave-one-out errors (prediction - solved) at the solved points, with the fitted hyperparameters """
+        outputs = self.outputs if outputs is None else outputs
+        errors = self._pd.DataFrame(numpy.nan, index=self.X.index, columns=outputs)
+        for output in outputs:
+            gp = self.models[output]
+            keep = numpy.nonzero(self.Y[output].notnull().values)[0]
+            for j, row in enumerate(keep):
+                others = numpy.arange(len(keep)) != j
+                loo = GaussianProcess(gp.kernel, gp.fitted_length_scales, gp.fitted_noise)
+                loo.fit(gp.X[others], self.Y[output].values[keep][others])
+                errors.iloc[row, errors.columns.get_loc(output)] = loo.predict(gp.X[j:j+1], False)[0] - self.Y[output].values[row]
+        return errors
@@ -0,0 +1,48 @@
+"""
+Non-uniform frequency sweep plans: dense windows around the expected
+resonances and a coarse background grid in between, as (start_ghz, stop_ghz,
+count) segments for HfssSetup.insert_planned_sweep.
+
+Does not need HFSS; hfss re-exports both functions.
+"""
+from __future__ import division
+import numpy
+
+
+def plan_sweep_segments(start_ghz, stop_ghz, freqs_ghz, Qs, span=10, points_per_linewidth=4,
+                        background_step_ghz=None, background_count=51):
+    """
+    Non-uniform sweep plan: dense windows of +-span linewidths (f/Q) around each
+    resonance, with points_per_linewidth points per linewidth, and a coarse
+    background grid (background_step_ghz, or background_count points over the
+    whole range) in between. Each window keeps its own step; where windows
+    overlap, only the overlap gets the finer of the steps.
+    Seed it with HfssEMDesignSolutions.eigenmodes (Q = f/kappa_over_2pi) or the
+    resonances of a coarse sweep (vectfit.fit_sweep).
+    returns sorted, non-overlapping [(start_ghz, stop_ghz, count)]
+    """
+    if background_step_ghz is None:
+        background_step_ghz = float(stop_ghz - start_ghz) / (background_count - 1)
+    windows = []
+    for f, Q in zip(freqs_ghz, Qs):
+        width = float(f) / Q
+        lo, hi = max(f - span*width, start_ghz), min(f + span*width, stop_ghz)
+        if lo < hi:
+            windows.append((lo, hi, width / points_per_linewidth))
+    windows.sort()
+
+    # the finest step covering each interval between window edges; runs of equal step are joined
+    edges = sorted(set([start_ghz, stop_ghz] + [x for lo, hi, step in windows for x in (lo, hi)]))
+    pieces = []
+    for a, b in zip(edges[:-1], edges[1:]):
+        step = min([s for lo, hi, s in windows if lo <= a and b <= hi] or [background_step_ghz])
+        if pieces and pieces[-1][2] == step:
+            pieces[-1] = (pieces[-1][0], b, step)
+        else:
+            pieces.append((a, b, step))
+    return [(lo, hi, int(numpy.ceil((hi - lo) / step - 1e-9)) + 1) for lo, hi, step in pieces]
+
+def sweep_segment_points(segments):
+    """ the sorted, unique frequencies (GHz) of a list of (start_ghz, stop_ghz, count) """
+    points = numpy.concatenate([numpy.linspace(start, stop, count) for start, stop, count in segments])
+    return numpy.unique(numpy.round(points, 9))
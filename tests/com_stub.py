@@ -0,0 +1,27 @@
+"""
+Stand-ins for the win32 COM modules (pywin32), so that hfss and bbq import on
+machines without HFSS; only installed when the real modules are missing.
+Tests that use them must not talk to HFSS.
+"""
+import sys
+import types
+
+def install():
+    try:
+        import pythoncom, win32com.client
+        return
+    except ImportError:
+        pass
+    pythoncom = types.ModuleType('pythoncom')
+    pythoncom.com_error = type('com_error', (Exception,), {})
+    pythoncom._GetInterfaceCount = lambda: 0
+    pythoncom.CoInitialize = lambda: None
+    pythoncom.CoUninitialize = lambda: None
+    win32com = types.ModuleType('win32com')
+    client = types.ModuleType('win32com.client')
+    client.CDispatch = type('CDispatch', (object,), {})
+    def Dispatch(*args):
+        raise RuntimeError("no COM on this machine")
+    client.Dispatch = Dispatch
+    win32com.client = client
+    sys.modules.update({'pythoncom': pythoncom, 'win32com': win32com, 'win32com.client': client})
@@ -0,0 +1,93 @@
+import os, sys
+import unittest
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import com_stub
+com_stub.install()
+import bbq
+
+# LJ names in the order given to do_eBBQ; the rects sort in another order
+NAMES = ['LJ1', 'LJ2', 'LJ3']
+RECTS = ['rect_c', 'rect_a', 'rect_b']
+LJS   = numpy.array([8e-9, 10e-9, 12e-9])
+F0S   = numpy.array([4.5, 5.5, 6.5])
+PJ    = numpy.array([[0.90, 0.02, 0.01],  # mode m lives on junction m
+                     [0.03, 0.80, 0.02],
+                     [0.01, 0.04, 0.70]])
+
+
+def solution(f0s, PJ):
+    """ an eBBQ_solution as do_eBBQ stores it: pJ_ columns from a dict, U_E and U_H consistent with PJ """
+    rows = []
+    for f0, pj in zip(f0s, PJ):
+        row = dict(('pJ_' + rect, p) for rect, p in zip(RECTS, pj))
+        row.update({'freq': f0, 'modeQ': 1e6, 'U_E': 1., 'U_H': 1 - 2*pj.sum()})
+        rows += [pandas.Series(row)]
+    return pandas.DataFrame(rows)
+
+def meta_data(LJs):
+    return pandas.Series({'junc_rect': RECTS, 'junc_LJ_var_name': NAMES, 'LJs': dict(zip(NAMES, LJs))})
+
+def analysis(variations):
+    """ a BbqAnalysis of {variation: LJs}, the solutions found with epr_perturbed from the first one """
+    bbqa = bbq.BbqAnalysis.__new__(bbq.BbqAnalysis)
+    bbqa.variations     = sorted(variations)
+    bbqa.sols           = {}
+    bbqa.hfss_variables = {}
+    metas = {}
+    for variation, LJs in variations.items():
+        f0s, PJs, _ = bbq.epr_perturbed(F0S, PJ, bbq.fluxQ**2/LJS, LJs/LJS - 1)
+        bbqa.sols[variation] = solution(f0s, PJs)
+        bbqa.hfss_variables[variation] = pandas.Series(dict(('_' + j, '%gnH' % (LJ*1e9)) for j, LJ in zip(NAMES, LJs)))
+        metas[variation] = meta_data(LJs)
+    bbqa.meta_data = pandas.DataFrame(metas)
+    bbqa.nmodes    = len(F0S)
+    return bbqa
+
+
+class JunctionOrderTest(unittest.TestCase):
+    def test_epr_inputs(self):
+        bbqa = analysis({'0': LJS})
+        f0s, PJs, LJs = bbqa.get_epr_inputs('0')
+        numpy.testing.assert_allclose(f0s, F0S)
+        numpy.testing.assert_allclose(PJs, PJ)
+        numpy.testing.assert_allclose(LJs, LJS)
+
+    def test_scan_LJ(self):
+        bbqa = analysis({'0': LJS})
+        scan = bbqa.scan_LJ('0', {'LJ2': [11e-9]})
+        numpy.testing.assert_allclose(scan[['LJ_' + j for j in NAMES]].values[0], [8e-9, 11e-9, 12e-9])
+        shift = scan[['f0_0', 'f0_1', 'f0_2']].values[0] - F0S
+        self.assertEqual(numpy.argmax(numpy.abs(shift)), 1) # only the mode on LJ2 moves much
+        numpy.testing.assert_allclose(scan['pJ_1_LJ2'], PJ[1, 1]/1.1/(1 - PJ[1].dot([0, 0.1/1.1, 0])))
+
+    def test_check_LJ_scan(self):
+        bbqa   = analysis({'0': LJS, '1': LJS*[1, 1.1, 1], '2': LJS*[1.05, 1, 0.9]})
+        errors = bbqa.check_LJ_scan('0')
+        self.assertEqual(list(errors.index), ['1', '2'])
+        numpy.testing.assert_allclose(errors[['dLJ_' + j for j in NAMES]].values, [[0, 0.1, 0], [0.05, 0, -0.1]], atol=1e-12)
+        results = errors.drop(['dLJ_' + j for j in NAMES], axis=1)
+        self.assertTrue(any(c.startswith('pJ_') for c in results.columns))
+        numpy.testing.assert_allclose(results.values, 0, atol=1e-9)
+
+    def test_monte_carlo(self):
+        bbqa = analysis({'0': LJS})
+        mc   = bbqa.monte_carlo('0', sigma_LJ=[0, 0.5, 0], n_samples=2000, seed=0)
+        dLJ  = mc[['dLJ_' + j for j in NAMES]].values
+        self.assertTrue((dLJ[:, [0, 2]] == 0).all())
+        self.assertTrue(dLJ[:, 1].min() == -0.9) # clipped, as used
+        f0s, PJs, _ = bbq.epr_perturbed(F0S, PJ, bbq.fluxQ**2/LJS, dLJ)
+        numpy.testing.assert_allclose(mc[['f0_0', 'f0_1', 'f0_2']].values, f0s)
+
+    def test_monte_carlo_processes(self):
+        bbqa = analysis({'0': LJS})
+        serial   = bbqa.monte_carlo('0', n_samples=1000, chunk_size=300, seed=1)
+        parallel = bbqa.monte_carlo('0', n_samples=1000, chunk_size=300, seed=1, processes=2)
+        numpy.testing.assert_allclose(serial.values, parallel.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
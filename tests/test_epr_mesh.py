@@ -0,0 +1,120 @@
+import os, sys, shutil, tempfile
+import unittest
+import numpy
+from scipy.constants import epsilon_0, mu_0
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import epr_mesh
+from field_export import FieldExporter, FieldArchive
+
+
+def cube_mesh(n=2, size=1.):
+    """ nodes and tetrahedra (6 per cube, conforming) of an n x n x n grid of cubes """
+    x = numpy.linspace(0, size, n + 1)
+    nodes = numpy.array([(a, b, c) for a in x for b in x for c in x])
+    index = lambda i, j, k: (i*(n + 1) + j)*(n + 1) + k
+    tets = []
+    for i in range(n):
+        for j in range(n):
+            for k in range(n):
+                corner = lambda d: index(i + d[0], j + d[1], k + d[2])
+                for path in [(0, 1, 2), (0, 2, 1), (1, 0, 2), (1, 2, 0), (2, 0, 1), (2, 1, 0)]:
+                    step, tet = [0, 0, 0], [corner((0, 0, 0))]
+                    for axis in path:
+                        step[axis] = 1
+                        tet.append(corner(step))
+                    tets.append(tet)
+    return nodes, numpy.array(tets)
+
+def write_ensight(path, nodes, tets, parts):
+    """ EnSight Gold ASCII case, one part per {name: tet mask}, each with its own (repeated) nodes """
+    with open(os.path.join(path, "mesh.geo"), "w") as f:
+        f.write("mesh plot\nexported\nnode id given\nelement id off\nextents\n")
+        for lo, hi in zip(nodes.min(axis=0), nodes.max(axis=0)):
+            f.write("%12.5e%12.5e\n" % (lo, hi))
+        for number, (name, mask) in enumerate(parts):
+            used, local = numpy.unique(tets[mask], return_inverse=True)
+            f.write("part\n%10d\n%s\ncoordinates\n%10d\n" % (number + 1, name, len(used)))
+            f.write("".join("%10d\n" % (i + 1) for i in used))
+            for axis in range(3):
+                f.write("".join("%12.5e\n" % x for x in nodes[used, axis]))
+            f.write("tetra4\n%10d\n" % mask.sum())
+            f.write("".join("%10d%10d%10d%10d\n" % tuple(t + 1) for t in local.reshape(-1, 4)))
+    with open(os.path.join(path, "mesh.case"), "w") as f:
+        f.write("FORMAT\ntype: ensight gold\nGEOMETRY\nmodel: mesh.geo\n")
+
+
+class FakeCalculator(object):
+    def __init__(self, export):
+        self.export = export
+    def CreateFieldPlot(self, args, field_type):
+        self.created = args
+    def ExportFieldPlot(self, name, solution_plot, fn):
+        self.export(os.path.dirname(fn))
+    def DeleteFieldPlot(self, names):
+        self.deleted = names
+
+class FakeModeler(object):
+    materials = {"substrate": "silicon", "box": "vacuum"}
+    def get_objects_in_group(self, group):
+        return sorted(self.materials)
+    def get_material(self, obj):
+        return self.materials[obj]
+
+class FakeDesign(object):
+    def __init__(self, calculator):
+        self._fields_calc, self.modeler, self.parent, self.variables = calculator, FakeModeler(), None, {"w": "1mm"}
+    def get_variable_value(self, name):
+        return self.variables[name]
+    def set_variable(self, name, value):
+        self.variables[name] = value
+
+class FakeSetup(object):
+    solution_name = "Setup1 : LastAdaptive"
+    def __init__(self, calculator):
+        self.parent = FakeDesign(calculator)
+    def get_solutions(self):
+        return None
+
+
+class MeshExportCrossCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_export_to_cross_check(self):
+        nodes_mm, tets = cube_mesh()                                     # the export is in mm
+        centroid_z = nodes_mm[tets].mean(axis=1)[:, 2]
+        parts = [("substrate", centroid_z < 0.5), ("box", centroid_z > 0.5)]
+        setup = FakeSetup(FakeCalculator(lambda path: write_ensight(path, nodes_mm, tets, parts)))
+        exporter = FieldExporter(setup, self.path)
+
+        # fields on the mesh nodes, as the calculator exports them: in m, in their own order
+        points = 1e-3*nodes_mm[numpy.random.RandomState(0).permutation(len(nodes_mm))]
+        E0, H0, J0 = numpy.array([1, 2j, 0]), numpy.array([0, 0, 3e-3]), 5.
+        junc = points[(numpy.abs(points[:, 2] - 0.5e-3) < 1e-12) & (points[:, 0] < 0.6e-3) & (points[:, 1] < 0.6e-3)]
+        info = exporter.manifest["variations"].setdefault("0", {"surfaces": {}})
+        info["points"] = exporter._save_points(points, "v0_points", None)
+        info["surfaces"]["junc"] = exporter._save_points(junc, "v0_junc_points", None)
+        exporter._save_field(numpy.tile(E0, (len(points), 1)), "0", 0, "E")
+        exporter._save_field(numpy.tile(H0, (len(points), 1)), "0", 0, "H")
+        exporter._save_field(numpy.tile([J0, 0, 0], (len(junc), 1)), "0", 0, "Jsurf", "junc")
+        mesh = exporter.export_mesh("0", ["w:=", "2mm"])
+        self.assertEqual(setup.parent.variables["w"], "1mm")              # restored after the plot
+        self.assertAlmostEqual(numpy.abs(mesh.nodes).max(), 1e-3)
+
+        V, A, junc_len, LJ = 1e-9, 0.25e-6, 0.5e-3, 10e-9
+        U_E = 0.5*epsilon_0*numpy.sum(numpy.abs(E0)**2)*(10*V/2 + V/2)
+        U_H = 0.5*mu_0*numpy.sum(numpy.abs(H0)**2)*V
+        import pandas as pd
+        sol = pd.DataFrame({"U_E": [U_E], "U_H": [U_H], "pJ_junc": [LJ*(J0*A/junc_len)**2/(2*U_E)]})
+        check = epr_mesh.cross_check(None, FieldArchive(self.path), sol, "0", eps_r={"silicon": 10},
+                                     junc_rects=["junc"], junc_lens=[junc_len], LJs=[LJ])
+        self.assertEqual(sorted(check.index.get_level_values("quantity")), ["U_E", "U_H", "pJ_junc"])
+        self.assertTrue(numpy.all(numpy.abs(check["rel_diff"]) < 1e-6), check)
+
+
+if __name__ == "__main__":
+    unittest.main()
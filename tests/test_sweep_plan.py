@@ -0,0 +1,50 @@
+import os, sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sweep_plan
+
+
+class PlanSweepSegmentsTest(unittest.TestCase):
+    def check_plan(self, segments, start, stop):
+        self.assertAlmostEqual(segments[0][0], start)
+        self.assertAlmostEqual(segments[-1][1], stop)
+        for (lo, hi, count), (next_lo, _, _) in zip(segments[:-1], segments[1:]):
+            self.assertEqual(hi, next_lo)
+        for lo, hi, count in segments:
+            self.assertTrue(lo < hi and count >= 2)
+
+    def step_at(self, segments, f):
+        for lo, hi, count in segments:
+            if lo < f < hi:
+                return (hi - lo) / (count - 1)
+
+    def test_very_different_Q(self):
+        # a Q=1e6 window inside the low flank of a Q=100 window
+        segments = sweep_plan.plan_sweep_segments(4, 10, [6.5, 7.0], [1e6, 100])
+        self.check_plan(segments, 4, 10)
+        self.assertTrue(sum(count for lo, hi, count in segments) < 500)
+        self.assertTrue(self.step_at(segments, 6.5) <= 1.001*6.5e-6/4)
+        for f in (6.35, 6.45, 6.6, 7.0, 7.6):  # the Q=100 window keeps its own step, on both flanks
+            self.assertTrue(numpy.isclose(self.step_at(segments, f), 0.07/4, rtol=0.05), f)
+        self.assertTrue(self.step_at(segments, 5) > 0.1)
+
+    def test_nested_windows(self):
+        # same centre: only the inner window gets the fine step
+        segments = sweep_plan.plan_sweep_segments(4, 10, [7.0, 7.0], [100, 1e4])
+        self.check_plan(segments, 4, 10)
+        self.assertTrue(self.step_at(segments, 7.0) <= 1.001*7e-4/4)
+        self.assertTrue(numpy.isclose(self.step_at(segments, 6.5), 0.07/4, rtol=0.05))
+        self.assertTrue(numpy.isclose(self.step_at(segments, 7.5), 0.07/4, rtol=0.05))
+
+    def test_points_near_uniform_count(self):
+        freqs, Qs = [4.5, 6.2, 6.20005, 8.8], [2e4, 1e5, 1e5, 500]
+        points = sweep_plan.sweep_segment_points(sweep_plan.plan_sweep_segments(4, 10, freqs, Qs))
+        self.assertTrue(numpy.all(numpy.diff(points) > 0))
+        uniform = 6 / (min(f/Q for f, Q in zip(freqs, Qs)) / 4)
+        self.assertTrue(len(points) < uniform / 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os, sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import com_stub
+com_stub.install()
+import bbq
+from vectfit import vector_fit
+
+
+def lc_impedance(freq, LJ, C, Q):
+    """ a junction LJ across a capacitor C, with a parallel R for the Q, seen from its port """
+    s = 2j*numpy.pi*freq
+    w0 = 1/numpy.sqrt(LJ*C)
+    return 1/(1/(s*LJ) + s*C + w0*C/Q)
+
+
+class ZBBQParticipationsTest(unittest.TestCase):
+    LJ, C, Q = 10e-9, 100e-15, 1e4
+
+    def setUp(self):
+        self.f0 = 1/(2*numpy.pi*numpy.sqrt(self.LJ*self.C))
+        self.freq = numpy.linspace(0.6*self.f0, 1.4*self.f0, 2000)
+        self.Z = lc_impedance(self.freq, self.LJ, self.C, self.Q)[:, None, None]
+
+    def test_fit_order_above_mode_count(self):
+        for n_poles in (2, 8, 20):
+            fit = vector_fit(self.freq, self.Z, n_poles=n_poles)
+            f0s, PJ, SIGN, Qs = bbq.zBBQ_participations(fit, [self.LJ], (self.freq[0], self.freq[-1]))
+            self.assertEqual(len(f0s), 1, "n_poles=%d: %s" % (n_poles, f0s))
+            self.assertAlmostEqual(f0s[0]/self.f0, 1, places=6)
+            self.assertAlmostEqual(PJ[0, 0], 1, places=4)
+            self.assertAlmostEqual(Qs[0]/self.Q, 1, places=3)
+
+    def test_thresholds(self):
+        fit = vector_fit(self.freq, self.Z, n_poles=20)
+        self.assertTrue((fit.poles.imag > 0).sum() > 1)
+        f0s = bbq.zBBQ_participations(fit, [self.LJ], pj_tol=0, min_Q=0)[0]
+        self.assertTrue(len(f0s) > 1) # the left-over poles
+        f0s = bbq.zBBQ_participations(fit, [self.LJ], min_Q=2*self.Q)[0]
+        self.assertEqual(len(f0s), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+"""
+Streaming Touchstone (.sNp) reader and writer for large frequency sweeps.
+
+Files are processed one chunk of frequency points at a time, so a sweep of
+any size can be archived or reloaded (into memory-mapped .npy files) without
+ever holding more than one chunk in memory. Supports the Touchstone 1.x
+S/Y/Z formats MA, DB and RI, any frequency unit, and renormalization of S
+parameters to a new reference impedance. Noise parameters are not supported.
+
+Does not need HFSS: see HfssFrequencySweep.export_touchstone for the export.
+"""
+from __future__ import division
+import re
+from itertools import islice
+import numpy
+from numpy.lib.format import open_memmap
+
+FREQ_UNITS = {"HZ": 1., "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9}
+CHUNK_SIZE = 10000 # frequency points
+
+
+def read_options(path):
+    """
+    :return: dict with the options line of the file: freq_unit, param, fmt, R
+    and the number of ports (from the .sNp extension)
+    """
+    match = re.search(r"\.[sSyYzZ](\d+)[pP]$", path)
+    if match is None:
+        raise ValueError("Can't tell the number of ports of %s, expected a .sNp file" % path)
+    options = {"n_ports": int(match.group(1)), "freq_unit": "GHZ", "param": "S", "fmt": "MA", "R": 50.}
+    with open(path) as f:
+        for line in f:
+            line = line.split("!")[0].strip()
+            if line.startswith("["):
+                raise ValueError("Touchstone 2.0 files are not supported: %s" % path)
+            if line.startswith("#"):
+                tokens = line[1:].upper().split()
+                for i, token in enumerate(tokens):
+                    if token in FREQ_UNITS:
+                        options["freq_unit"] = token
+                    elif token in ("S", "Y", "Z"):
+                        options["param"] = token
+                    elif token in ("MA", "DB", "RI"):
+                        options["fmt"] = token
+                    elif token == "R":
+                        options["R"] = float(tokens[i+1])
+                break
+            if line:
+                break
+    return options
+
+def iter_touchstone(path, chunk_size=CHUNK_SIZE, z0=None):
+    """
+    Yields (freq [Hz], data [chunk x port x port] complex) chunks of the file.
+    Y and Z data is returned in ohm / siemens (not normalized to R).
+    z0: renormalize S parameters to this reference impedance
+    """
+    options = read_options(path)
+    n = options["n_ports"]
+    n_values = 1 + 2*n*n
+    lines_per_point = 1 if n <= 2 else n*((n + 3)//4)
+    leftover = numpy.zeros(0)
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, chunk_size*lines_per_point))
+            if not lines:
+                break
+            text = "".join(line.split("!")[0] + "\n" if "!" in line else line
+                           for line in lines if not line.lstrip().startswith("#"))
+            if not text.strip():
+                continue
+            values = numpy.concatenate([leftover, numpy.fromstring(text, sep=" ")])
+            n_points = len(values)//n_values
+            leftover = values[n_points*n_values:]
+            if n_points:
+                yield _unpack(values[:n_points*n_values].reshape(n_points, n_values), options, z0)
+    if len(leftover):
+        raise ValueError("%s ends with an incomplete frequency point" % path)
+
+def read_touchstone(path, out=None, chunk_size=CHUNK_SIZE, z0=None):
+    """
+    :param out: if given, the data is streamed into the memory-mapped files
+    out + "_freq.npy" and out + "_data.npy" (two passes over the file), and
+    memory-mapped arrays are returned. Otherwise the arrays are built in memory.
+    :return: freq [Hz], data [freq x port x port] complex
+    """
+    if out is None:
+        chunks = list(iter_touchstone(path, chunk_size, z0))
+        return (numpy.concatenate([c[0] for c in chunks]),
+                numpy.concatenate([c[1] for c in chunks]))
+    n = read_options(path)["n_ports"]
+    n_points = sum(len(freq) for freq, data in iter_touchstone(path, chunk_size))
+    freq = open_memmap(out + "_freq.npy", mode="w+", dtype=float, shape=(n_points,))
+    data = open_memmap(out + "_data.npy", mode="w+", dtype=complex, shape=(n_points, n, n))
+    start = 0
+    for freq_chunk, data_chunk in iter_touchstone(path, chunk_size, z0):
+        freq[start:start+len(freq_chunk)] = freq_chunk
+        data[start:start+len(freq_chunk)] = data_chunk
+        start += len(freq_chunk)
+    freq.flush()
+    data.flush()
+    return freq, data
+
+def load_npy(out):
+    """ memory-mapped freq, data written by read_touchstone(..., out=out) """
+    return (numpy.load(out + "_freq.npy", mmap_mode="r"),
+            numpy.load(out + "_data.npy", mmap_mode="r"))
+
+def write_touchstone(path, freq, data=None, param="S", fmt="RI", R=50., freq_unit="GHZ",
+                     chunk_size=CHUNK_SIZE, comments=None, precision=12):
+    """
+    :param freq: freq [Hz] together with data [freq x port x port] (numpy arrays or
+    memory-mapped arrays, written one chunk at a time), or, with data=None, an
+    iterable of (freq, data) chunks such as iter_touchstone(...)
+    :param path: should end in .sNp, N the number of ports
+    Y and Z data is given in ohm / siemens and normalized to R in the file.
+    """
+    if data is None:
+        chunks = freq
+    else:
+        chunks = ((freq[i:i+chunk_size], data[i:i+chunk_size]) for i in range(0, len(freq), chunk_size))
+    param, fmt, freq_unit = param.upper(), fmt.upper(), freq_unit.upper()
+    with open(path, "w") as f:
+        for comment in comments or []:
+            f.write("! %s\n" % comment)
+        f.write("# %s %s %s R %g\n" % (freq_unit, param, fmt, R))
+        line_format = None
+        for freq_chunk, data_chunk in chunks:
+            n = data_chunk.shape[-1]
+            if line_format is None:
+                line_format = _line_format(n, precision)
+            values = _pack(numpy.asarray(freq_chunk), numpy.asarray(data_chunk), param, fmt, R, freq_unit)
+            f.write("\n".join(line_format % tuple(row) for row in values))
+            f.write("\n")
+
+def renormalize_s(S, z_old, z_new):
+    """ S [... x port x port] referenced to the real impedance z_old, renormalized to z_new """
+    eye = numpy.eye(S.shape[-1])
+    Z = numpy.linalg.solve(eye - S, eye + S) * z_old
+    return numpy.linalg.solve(Z + z_new*eye, Z - z_new*eye)
+
+
+def _unpack(values, options, z0):
+    n = options["n_ports"]
+    a, b = values[:, 1::2], values[:, 2::2]
+    if options["fmt"] == "RI":
+        data = a + 1j*b
+    else:
+        mag = a if options["fmt"] == "MA" else 10**(a/20)
+        data = mag * numpy.exp(1j*numpy.deg2rad(b))
+    data = data.reshape(-1, n, n)
+    if n == 2: # 2-ports are written as 11 21 12 22
+        data = data.transpose(0, 2, 1)
+    if options["param"] == "Z":
+        data = data * options["R"]
+    elif options["param"] == "Y":
+        data = data / options["R"]
+    elif z0 is not None and z0 != options["R"]:
+        data = renormalize_s(data, options["R"], z0)
+    return values[:, 0]*FREQ_UNITS[options["freq_unit"]], data
+
+def _pack(freq, data, param, fmt, R, freq_unit):
+    if param == "Z":
+        data = data / R
+    elif param == "Y":
+        data = data * R
+    if data.shape[-1] == 2:
+        data = data.transpose(0, 2, 1)
+    data = data.reshape(len(freq), -1)
+    if fmt == "RI":
+        a, b = data.real, data.imag
+    else:
+        a = numpy.abs(data) if fmt == "MA" else 20*numpy.log10(numpy.abs(data))
+        b = numpy.rad2deg(numpy.angle(data))
+    values = numpy.empty((len(freq), 1 + 2*data.shape[1]))
+    values[:, 0] = freq / FREQ_UNITS[freq_unit]
+    values[:, 1::2], values[:, 2::2] = a, b
+    return values
+
+def _line_format(n, precision):
+    """ % format of one frequency point: one line for n <= 2, else a matrix row per line,
+    at most 4 pairs per line """
+    pair = "%.{0}g %.{0}g".format(precision)
+    number = "%.{0}g".format(precision)
+    if n <= 2:
+        return " ".join([number] + [pair]*(n*n))
+    rows = []
+    for i in range(n):
+        lines = [" ".join([pair]*len(range(k, min(k+4, n)))) for k in range(0, n, 4)]
+        rows.append("\n".join(lines))
+    return number + " " + "\n".join(rows)
@@ -0,0 +1,200 @@
+"""
+Vector fitting of frequency responses, e.g. the Y or Z matrices of a
+driven-modal sweep, to a rational model with common poles
+
+    H(s) = sum_n r_n / (s - p_n) + d + s e
+
+Uses the relaxed (Gustavsen, IEEE Trans. Power Del. 21, 1587 (2006)) and fast
+(Deschrijver et al., IEEE MWCL 18, 383 (2008)) formulation: the pole
+relocation solves one small QR problem per response element, and the residues
+of all elements are found in a single least-squares solve, so it scales to
+many ports and thousands of frequency points.
+
+The poles give the mode frequencies and Qs, so a single fast sweep can stand
+in for an eigenmode solve:
+    fit = fit_sweep(sweep, "Z", n_poles=12)
+    freqs, Qs = fit.resonances()
+"""
+from __future__ import division
+import numpy
+
+
+class VectorFit(object):
+    """
+    Result of vector_fit.
+        poles      [n_poles] complex, in rad/s
+        residues   [n_poles, ...] complex, one set per response element
+        d, e       [...] constant and proportional terms
+        rms_error  rms deviation of the model from the data
+        rel_error  rms_error relative to the rms of the data
+        ok         rel_error < tol
+    """
+    def __init__(self, poles, residues, d, e, rms_error, rel_error, tol):
+        self.poles = poles
+        self.residues = residues
+        self.d = d
+        self.e = e
+        self.rms_error = rms_error
+        self.rel_error = rel_error
+        self.ok = rel_error < tol
+
+    def __call__(self, freq):
+        """ the model at freq [Hz], shape [freq, ...] """
+        s = 2j*numpy.pi*numpy.asarray(freq, dtype=float)
+        shape = self.residues.shape[1:]
+        residues = self.residues.reshape(len(self.poles), -1)
+        H = (1/(s[:, None] - self.poles[None, :])).dot(residues)
+        H += self.d.reshape(1, -1) + s[:, None]*self.e.reshape(1, -1)
+        return H.reshape((len(s),) + shape)
+
+    def resonances(self, freq_range=None, residue_tol=1e-4):
+        """
+        :param residue_tol: poles whose residue norm (over all response elements)
+        is below residue_tol times the largest one are left-over poles of an
+        over-ordered fit, not modes, and are dropped
+        :return: freqs [Hz], Qs of the poles in the upper half plane, sorted by
+        frequency, Q = Im(p) / (2 |Re(p)|) as for HFSS eigenmodes
+        """
+        norms = numpy.sqrt(numpy.sum(numpy.abs(self.residues.reshape(len(self.poles), -1))**2, axis=1))
+        keep = (self.poles.imag > 0) & (norms > residue_tol*norms.max())
+        poles = self.poles[keep]
+        poles = poles[numpy.argsort(poles.imag)]
+        freqs = poles.imag/(2*numpy.pi)
+        Qs = poles.imag/(2*numpy.abs(poles.real))
+        if freq_range is not None:
+            keep = (freqs >= freq_range[0]) & (freqs <= freq_range[1])
+            freqs, Qs = freqs[keep], Qs[keep]
+        return freqs, Qs
+
+
+def vector_fit(freq, H, n_poles=20, n_iter=10, poles=None, fit_e=False, weight=None, tol=1e-3):
+    """
+    :param freq: [K] frequencies in Hz
+    :param H: [K, ...] complex responses; all elements share the same poles
+    :param n_poles: number of starting poles (complex pairs spread over the band),
+    if poles is not given
+    :param poles: starting poles in rad/s
+    :param fit_e: fit the proportional term s*e as well
+    :param weight: [K] or [K, ...] weights, default 1
+    :param tol: relative rms error under which the fit is flagged ok
+    :rtype: VectorFit
+    """
+    freq = numpy.asarray(freq, dtype=float)
+    H = numpy.asarray(H, dtype=complex)
+    shape = H.shape[1:]
+    F = H.reshape(len(freq), -1)
+    W = numpy.ones(F.shape) if weight is None else numpy.broadcast_to(
+        numpy.asarray(weight, dtype=float).reshape(len(freq), -1), F.shape)
+
+    # work in normalized frequency, s_n = s/w0, for conditioning
+    w0 = 2*numpy.pi*freq.max()
+    s = 2j*numpy.pi*freq/w0
+    if poles is None:
+        poles = _starting_poles(freq.min()*2*numpy.pi/w0, 1., n_poles)
+    else:
+        poles = numpy.asarray(poles, dtype=complex)/w0
+    poles = _sort_poles(poles)
+
+    for i in range(n_iter):
+        poles = _relocate_poles(s, F, W, poles, fit_e)
+    residues, d, e = _fit_residues(s, F, W, poles, fit_e)
+
+    model = (1/(s[:, None] - poles[None, :])).dot(residues) + d[None, :] + s[:, None]*e[None, :]
+    rms_error = numpy.sqrt(numpy.mean(numpy.abs(model - F)**2))
+    rel_error = rms_error/numpy.sqrt(numpy.mean(numpy.abs(F)**2))
+    return VectorFit(poles*w0, (residues*w0).reshape((len(poles),) + shape),
+                     d.reshape(shape), (e/w0).reshape(shape), rms_error, rel_error, tol)
+
+def fit_sweep(sweep, param="Z", z0=None, **kwargs):
+    """
+    Vector fit of the Y or Z matrix of an HfssFrequencySweep
+    (see HfssFrequencySweep.get_network_matrices); kwargs go to vector_fit.
+    """
+    freq, matrices = sweep.get_network_matrices(param, z0=z0)
+    return vector_fit(freq, matrices[param], **kwargs)
+
+
+def _starting_poles(w_min, w_max, n_poles):
+    """ lightly damped complex pairs linearly spread over the band """
+    beta = numpy.linspace(max(w_min, 1e-3*w_max), w_max, max(n_poles//2, 1))
+    poles = -beta/100 + 1j*beta
+    return numpy.concatenate([poles, poles.conj()])
+
+def _sort_poles(poles):
+    """ real poles first, then complex pairs as (p, p*) with Im(p) > 0 """
+    real = poles[numpy.abs(poles.imag) <= 1e-12*numpy.abs(poles)].real
+    upper = poles[poles.imag > 1e-12*numpy.abs(poles)]
+    pairs = numpy.empty(2*len(upper), dtype=complex)
+    pairs[0::2], pairs[1::2] = upper, upper.conj()
+    return numpy.concatenate([real.astype(complex), pairs])
+
+def _basis(s, poles):
+    """
+    Real-coefficient basis: 1/(s-p) for real poles, and
+    1/(s-p) + 1/(s-p*),  j/(s-p) - j/(s-p*)  for complex pairs
+    """
+    Phi = 1/(s[:, None] - poles[None, :])
+    cplx = numpy.nonzero(poles.imag > 0)[0]
+    first, second = Phi[:, cplx], Phi[:, cplx+1]
+    Phi[:, cplx], Phi[:, cplx+1] = first + second, 1j*(first - second)
+    return Phi
+
+def _to_complex_residues(c, poles):
+    """ inverse of the pair basis of _basis: c [n_poles, ...] real -> complex residues """
+    c = c.astype(complex)
+    cplx = numpy.nonzero(poles.imag > 0)[0]
+    r = c[cplx] + 1j*c[cplx+1]
+    c[cplx], c[cplx+1] = r, r.conj()
+    return c
+
+def _relocate_poles(s, F, W, poles, fit_e):
+    K, Nc = F.shape
+    N = len(poles)
+    Phi = _basis(s, poles)
+    Dk = numpy.column_stack([Phi, numpy.ones(K)])
+    n_direct = N + 1 + int(fit_e)
+    direct = numpy.column_stack([Phi, numpy.ones(K)] + ([s] if fit_e else []))
+    scale = numpy.sqrt(numpy.sum(numpy.abs(W*F)**2))/K
+
+    AA = numpy.zeros((Nc*(N + 1), N + 1))
+    bb = numpy.zeros(Nc*(N + 1))
+    for n in range(Nc):
+        A = numpy.column_stack([W[:, n, None]*direct, -(W[:, n]*F[:, n])[:, None]*Dk])
+        A = numpy.vstack([A.real, A.imag])
+        if n == Nc - 1: # relaxation: integral criterion on sigma, in the last block
+            A = numpy.vstack([A, numpy.concatenate([numpy.zeros(n_direct), scale*numpy.sum(Dk, axis=0).real])])
+        Q, R = numpy.linalg.qr(A)
+        AA[n*(N + 1):(n + 1)*(N + 1)] = R[n_direct:, n_direct:]
+        if n == Nc - 1:
+            bb[n*(N + 1):] = Q[-1, n_direct:]*K*scale
+
+    col_norm = numpy.sqrt(numpy.sum(AA**2, axis=0))
+    col_norm[col_norm == 0] = 1
+    x = numpy.linalg.lstsq(AA/col_norm, bb, rcond=None)[0]/col_norm
+    C, D = x[:N], x[N]
+    if abs(D) < 1e-8:
+        D = 1e-8 if D >= 0 else -1e-8
+
+    # zeros of sigma = eigenvalues of (A - b c / d), in real block form
+    Lambda = numpy.diag(poles.real).astype(float)
+    b = numpy.ones(N)
+    for m in numpy.nonzero(poles.imag > 0)[0]:
+        Lambda[m, m+1], Lambda[m+1, m] = poles[m].imag, -poles[m].imag
+        b[m], b[m+1] = 2, 0
+    new_poles = numpy.linalg.eigvals(Lambda - numpy.outer(b, C)/D)
+    new_poles = new_poles.real*numpy.where(new_poles.real > 0, -1, 1) + 1j*new_poles.imag # flip unstable poles
+    return _sort_poles(new_poles)
+
+def _fit_residues(s, F, W, poles, fit_e):
+    """ residues of all elements in one least-squares solve, assuming the same weight for all elements """
+    K, Nc = F.shape
+    N = len(poles)
+    w = W[:, 0]
+    A = w[:, None]*numpy.column_stack([_basis(s, poles), numpy.ones(K)] + ([s] if fit_e else []))
+    A = numpy.vstack([A.real, A.imag])
+    B = numpy.vstack([(w[:, None]*F).real, (w[:, None]*F).imag])
+    col_norm = numpy.sqrt(numpy.sum(A**2, axis=0))
+    x = numpy.linalg.lstsq(A/col_norm, B, rcond=None)[0]/col_norm[:, None]
+    residues = _to_complex_residues(x[:N], poles)
+    e = x[N+1] if fit_e else numpy.zeros(Nc)
+    return residues, x[N].astype(complex), e.astype(complex)